@@ -0,0 +1,180 @@
+import asyncio
+import importlib.util
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import httpx
+
+from upstream import (
+    ACCEPT_ENCODING,
+    HOST_PLATFORMS,
+    PLATFORM_HEADERS,
+    LatencyMetrics,
+    json_loads,
+)
+
+# HTTP/2 требует пакета h2 (httpx[http2] в requirements.txt); без него —
+# HTTP/1.1, например в окружении, собранном без requirements
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+class AsyncUpstreamClient:
+    """
+    Асинхронный HTTP-клиент площадок на httpx.AsyncClient для массового
+    опроса подписок.
+
+    Все запросы идут через один пул соединений (с HTTP/2, если он
+    доступен, — тогда сотни запросов мультиплексируются в несколько
+    соединений), а число одновременных запросов к каждому хосту
+    ограничено семафором, чтобы тысячи подписок не обрушили площадку.
+
+    Args:
+        per_host_limit: Сколько запросов к одному хосту выполнять одновременно
+        max_connections: Общий предел соединений пула
+        connect_timeout: Таймаут установки соединения, в секундах
+        read_timeout: Таймаут чтения ответа, в секундах
+        metrics: LatencyMetrics для замеров задержек (общие с UpstreamClient)
+    """
+
+    def __init__(
+        self,
+        per_host_limit=8,
+        max_connections=50,
+        connect_timeout=5,
+        read_timeout=20,
+        metrics=None,
+    ):
+        self.per_host_limit = per_host_limit
+        self.metrics = metrics or LatencyMetrics()
+        self._limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+        )
+        self._timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self._client = None
+        self._semaphores = {}
+
+    def _get_client(self):
+        # Клиент создаётся внутри цикла событий, в котором будет работать
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                http2=HTTP2_AVAILABLE,
+                limits=self._limits,
+                timeout=self._timeout,
+            )
+        return self._client
+
+    def _semaphore(self, host):
+        semaphore = self._semaphores.get(host)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.per_host_limit)
+            self._semaphores[host] = semaphore
+        return semaphore
+
+    def _headers(self, host, headers):
+        request_headers = {"Accept-Encoding": ACCEPT_ENCODING}
+        request_headers.update(PLATFORM_HEADERS.get(HOST_PLATFORMS.get(host), {}))
+        request_headers.update(headers or {})
+        return request_headers
+
+    async def request(self, method, url, headers=None, **kwargs):
+        host = urlsplit(url).hostname
+        async with self._semaphore(host):
+            started = time.monotonic()
+            error = True
+            try:
+                response = await self._get_client().request(
+                    method, url, headers=self._headers(host, headers), **kwargs
+                )
+                error = response.status_code >= 500
+                return response
+            finally:
+                self.metrics.record(host, time.monotonic() - started, error)
+
+    async def get_json(self, url, project=None, headers=None, **kwargs):
+        """
+        GET-запрос со сжатым ответом и разбором через orjson прямо из
+        bytes, без промежуточной строки; project сразу оставляет от данных
+        только нужные поля, чтобы полный ответ не жил дольше разбора.
+
+        Тело читается целиком, а не потоком: у orjson нет инкрементального
+        разбора, а склейка кусков в буфер перед json_loads давала тот же
+        пик памяти, что и response.content. Страница каталога — не больше
+        нескольких сотен КБ, так что потоковый разбор не окупил бы
+        отдельную зависимость.
+
+        Returns:
+            Кортеж (response, data); data — None, если статус не 200
+        """
+        response = await self.request("GET", url, headers=headers, **kwargs)
+        if response.status_code != 200:
+            return response, None
+        data = json_loads(response.content)
+        return response, project(data) if project else data
+
+    async def get(self, url, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request("POST", url, **kwargs)
+
+
+class PollScheduler:
+    """
+    Один цикл asyncio в отдельном потоке, в котором живут все поллеры
+    подписок, — вместо отдельного потока ОС на каждую подписку.
+
+    Блокирующие шаги (отправка сообщений через очередь Telegram, работа
+    с файлами) поллеры выполняют через run_blocking в общем пуле потоков.
+
+    Args:
+        blocking_workers: Размер пула потоков для блокирующих шагов
+        thread_initializer: Вызывается в каждом потоке пула при старте
+    """
+
+    def __init__(self, blocking_workers=16, thread_initializer=None):
+        self._executor = ThreadPoolExecutor(
+            max_workers=blocking_workers,
+            thread_name_prefix="poller",
+            initializer=thread_initializer,
+        )
+        self._loop = asyncio.new_event_loop()
+        self._loop.set_default_executor(self._executor)
+        self._tasks = {}
+        threading.Thread(target=self._loop.run_forever, daemon=True).start()
+
+    def schedule(self, key, coro):
+        """Запускает корутину поллера; повторный запуск с тем же ключом заменяет старый"""
+
+        def start():
+            previous = self._tasks.get(key)
+            if previous is not None:
+                previous.cancel()
+            task = self._loop.create_task(coro)
+            self._tasks[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+
+        self._loop.call_soon_threadsafe(start)
+
+    def cancel(self, key):
+        def stop():
+            task = self._tasks.pop(key, None)
+            if task is not None:
+                task.cancel()
+
+        self._loop.call_soon_threadsafe(stop)
+
+    def _forget(self, key, task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        if not task.cancelled() and task.exception() is not None:
+            print(f"❌ Поллер {key} завершился с ошибкой: {task.exception()}")
+
+    def active(self):
+        return len(self._tasks)
+
+    async def run_blocking(self, func, *args):
+        """Выполняет блокирующую функцию в пуле потоков, не останавливая цикл"""
+        return await self._loop.run_in_executor(None, func, *args)
@@ -0,0 +1,102 @@
+_HANDLER = None  # ключ узла префиксного дерева, под которым лежит обработчик
+
+
+class CallbackRouter:
+    """
+    Маршрутизатор callback-запросов: один общий обработчик в telebot
+    вместо десятков лямбд call.data.startswith(...), которые telebot
+    проверяет по очереди для каждого нажатия.
+
+    Точные значения call.data ищутся в словаре, префиксы — в префиксном
+    дереве, поэтому стоимость маршрутизации зависит только от длины
+    call.data, а не от числа обработчиков. Префиксы не могут быть
+    вложенными (например, "year_" и "year_from_"): неоднозначная
+    регистрация сразу падает с ValueError при запуске бота, а не
+    зависит от порядка объявления обработчиков.
+    """
+
+    def __init__(self):
+        self._exact = {}
+        self._trie = {}
+
+    def exact(self, data):
+        """Декоратор: обработчик для call.data == data"""
+
+        def decorator(handler):
+            self._check_exact(data)
+            self._exact[data] = handler
+            return handler
+
+        return decorator
+
+    def prefix(self, prefix):
+        """Декоратор: обработчик для call.data, начинающихся с prefix"""
+
+        def decorator(handler):
+            if not prefix:
+                raise ValueError("Пустой префикс callback_data")
+            self._check_prefix(prefix)
+            node = self._trie
+            for char in prefix:
+                node = node.setdefault(char, {})
+            node[_HANDLER] = handler
+            return handler
+
+        return decorator
+
+    def _find_prefix(self, data):
+        """Обработчик префикса, с которого начинается data, или None"""
+        node = self._trie
+        for char in data:
+            node = node.get(char)
+            if node is None:
+                return None
+            if _HANDLER in node:
+                return node[_HANDLER]
+        return None
+
+    def _check_exact(self, data):
+        if data in self._exact:
+            raise ValueError(f"callback_data {data!r} уже зарегистрирован")
+        if self._find_prefix(data) is not None:
+            raise ValueError(f"callback_data {data!r} перекрывается префиксом")
+
+    def _check_prefix(self, prefix):
+        if self._find_prefix(prefix) is not None:
+            raise ValueError(
+                f"Префикс {prefix!r} совпадает с уже зарегистрированным или вложен в него"
+            )
+        node = self._trie
+        for char in prefix:
+            node = node.get(char)
+            if node is None:
+                break
+        else:
+            raise ValueError(
+                f"Префикс {prefix!r} является началом уже зарегистрированного префикса"
+            )
+        for data in self._exact:
+            if data.startswith(prefix):
+                raise ValueError(
+                    f"Префикс {prefix!r} перекрывает callback_data {data!r}"
+                )
+
+    def resolve(self, data):
+        """Обработчик для call.data или None"""
+        if data is None:
+            return None
+        handler = self._exact.get(data)
+        if handler is not None:
+            return handler
+        return self._find_prefix(data)
+
+    def dispatch(self, call):
+        handler = self.resolve(call.data)
+        if handler is None:
+            print(f"⚠️ Нет обработчика для callback_data: {call.data}")
+            return
+        handler(call)
+
+    def install(self, bot):
+        """Регистрирует маршрутизатор в боте как единственный callback-обработчик"""
+        bot.register_callback_query_handler(self.dispatch, func=lambda call: True)
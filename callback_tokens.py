@@ -0,0 +1,69 @@
+import base64
+import hashlib
+import json
+import time
+
+from shared_state import BoundedDict
+
+
+class CallbackRegistry:
+    """
+    Реестр коротких токенов для callback_data.
+
+    Вместо названий марок и моделей (корейский текст занимает 3 байта на
+    символ и упирается в лимит Telegram в 64 байта) кнопка несёт только
+    токен, а весь контекст шага — марка, модель, поколение — хранится
+    в реестре и достаётся по токену за O(1), без разбора текста сообщения.
+
+    Токен — хэш содержимого узла, поэтому одна и та же кнопка всегда
+    получает один и тот же токен. Узлы хранятся в WizardStateStore:
+    в памяти с вытеснением (LRU) и в SQLite, чтобы кнопки в старых
+    сообщениях работали и после перезапуска бота.
+
+    Каждая выдача токена и каждое успешное нажатие продлевают запись в
+    реестре (не чаще раза в refresh_interval секунд), поэтому живые
+    кнопки не устаревают по TTL и не вытесняются из памяти первыми.
+
+    Args:
+        store: WizardStateStore для хранения узлов
+        refresh_interval: Как часто продлевать один и тот же токен, в секундах
+    """
+
+    def __init__(self, store, refresh_interval=3600):
+        self.store = store
+        self.refresh_interval = refresh_interval
+        self._refreshed = BoundedDict(store.max_sessions)  # токен -> время продления
+
+    @staticmethod
+    def make_token(node):
+        raw = json.dumps(node, ensure_ascii=False, sort_keys=True).encode("utf-8")
+        digest = hashlib.blake2b(raw, digest_size=6).digest()
+        return base64.urlsafe_b64encode(digest).decode("ascii")
+
+    def token(self, node):
+        """Токен (8 символов) для узла, узел сохраняется в реестре"""
+        token = self.make_token(node)
+        self._touch(token, node)
+        return token
+
+    def resolve(self, token):
+        """Узел по токену или None, если токен неизвестен или устарел"""
+        node = self.store.get(token)
+        if node is None:
+            return None
+        node = dict(node)
+        self._touch(token, node)
+        return node
+
+    def _touch(self, token, node):
+        """Сохраняет узел заново, продлевая TTL, если давно не продлевали"""
+        now = time.time()
+        refreshed_at = self._refreshed.get(token)
+        if (
+            refreshed_at is not None
+            and now - refreshed_at < self.refresh_interval
+            and token in self.store
+        ):
+            return
+        self.store[token] = node
+        self._refreshed[token] = now
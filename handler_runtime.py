@@ -0,0 +1,219 @@
+import heapq
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from telebot import types
+
+from outbound import QueuedTeleBot
+
+# Сколько ждать ответа обработчика на нажатие кнопки, прежде чем снять
+# «часики» пустым answerCallbackQuery
+CALLBACK_ACK_DELAY = 0.3
+
+# Повторное нажатие той же кнопки в течение этого времени игнорируется
+CALLBACK_DEBOUNCE = 1.0
+
+
+class KeyedExecutor:
+    """
+    Пул потоков, в котором задачи с одним ключом (user_id) выполняются
+    строго по очереди, а задачи разных ключей — параллельно.
+
+    После каждой задачи ключ заново встаёт в очередь пула, поэтому
+    пользователь с длинной очередью не занимает поток в ущерб остальным.
+
+    Args:
+        workers: Количество потоков
+        on_error: Вызывается с исключением, если задача упала
+    """
+
+    def __init__(self, workers=32, on_error=None):
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="handler"
+        )
+        self._mailboxes = {}  # key -> deque задач
+        self._lock = threading.Lock()
+        self._on_error = on_error
+
+    def submit(self, key, func, *args, **kwargs):
+        with self._lock:
+            mailbox = self._mailboxes.get(key)
+            if mailbox is not None:
+                # Для ключа уже запущена обработка — она дойдёт и до этой задачи
+                mailbox.append((func, args, kwargs))
+                return
+            self._mailboxes[key] = deque([(func, args, kwargs)])
+        self._executor.submit(self._run_next, key)
+
+    def _run_next(self, key):
+        with self._lock:
+            func, args, kwargs = self._mailboxes[key].popleft()
+        try:
+            func(*args, **kwargs)
+        except Exception as e:
+            if self._on_error is not None:
+                self._on_error(e)
+            else:
+                print(f"❌ Ошибка в обработчике: {e}")
+        with self._lock:
+            if not self._mailboxes[key]:
+                del self._mailboxes[key]
+                return
+        self._executor.submit(self._run_next, key)
+
+
+class CallbackAcker:
+    """
+    Снимает индикатор загрузки с нажатой кнопки, если обработчик не ответил
+    на callback-запрос за CALLBACK_ACK_DELAY секунд.
+
+    Telegram принимает только один ответ на callback-запрос, поэтому
+    обработчик сначала вызывает claim(): если ответ уже отправлен
+    автоматически, текст всплывающего уведомления придётся отправить
+    обычным сообщением в чат.
+
+    Args:
+        answer: Функция answer_callback_query(callback_query_id)
+        delay: Задержка автоматического ответа, в секундах
+        max_answered: Сколько автоматически отвеченных запросов помнить
+    """
+
+    def __init__(self, answer, delay=CALLBACK_ACK_DELAY, max_answered=10000):
+        self._answer = answer
+        self.delay = delay
+        self.max_answered = max_answered
+        self._pending = {}  # callback_query_id -> chat_id
+        self._answered = OrderedDict()  # callback_query_id -> chat_id
+        self._deadlines = []  # (deadline, callback_query_id)
+        self._cond = threading.Condition()
+        threading.Thread(target=self._loop, daemon=True).start()
+
+    def track(self, call):
+        chat_id = call.message.chat.id if call.message else None
+        with self._cond:
+            self._pending[call.id] = chat_id
+            heapq.heappush(self._deadlines, (time.monotonic() + self.delay, call.id))
+            self._cond.notify()
+
+    def claim(self, callback_query_id):
+        """
+        Returns:
+            tuple: (True, None), если обработчик может ответить сам, или
+            (False, chat_id), если пустой ответ уже отправлен
+        """
+        with self._cond:
+            if self._pending.pop(callback_query_id, None) is not None or (
+                callback_query_id not in self._answered
+            ):
+                return True, None
+            return False, self._answered.pop(callback_query_id)
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                if not self._deadlines:
+                    self._cond.wait()
+                    continue
+                deadline, callback_query_id = self._deadlines[0]
+                if deadline > now:
+                    self._cond.wait(deadline - now)
+                    continue
+                heapq.heappop(self._deadlines)
+                if callback_query_id not in self._pending:
+                    continue  # обработчик уже ответил сам
+                self._answered[callback_query_id] = self._pending.pop(callback_query_id)
+                while len(self._answered) > self.max_answered:
+                    self._answered.popitem(last=False)
+            try:
+                self._answer(callback_query_id)
+            except Exception as e:
+                print(f"⚠️ Не удалось ответить на callback {callback_query_id}: {e}")
+
+
+class CallbackDebouncer:
+    """
+    Отсеивает повторные нажатия одной и той же кнопки (двойной тап),
+    чтобы они не запускали второй раз тот же запрос к площадке.
+
+    Args:
+        window: Окно, в течение которого нажатие считается повтором, в секундах
+    """
+
+    def __init__(self, window=CALLBACK_DEBOUNCE):
+        self.window = window
+        self._seen = OrderedDict()  # (user_id, message, data) -> время нажатия
+        self._lock = threading.Lock()
+
+    def is_duplicate(self, call):
+        message = call.message.message_id if call.message else call.inline_message_id
+        key = (call.from_user.id, message, call.data)
+        now = time.monotonic()
+        with self._lock:
+            # Записи добавляются по времени, поэтому устаревшие всегда в начале
+            while self._seen:
+                oldest_key, seen_at = next(iter(self._seen.items()))
+                if now - seen_at < self.window:
+                    break
+                del self._seen[oldest_key]
+            if key in self._seen:
+                return True
+            self._seen[key] = now
+            return False
+
+
+class HandlerRuntimeBot(QueuedTeleBot):
+    """
+    TeleBot, выполняющий обработчики в KeyedExecutor: обновления одного
+    пользователя обрабатываются по порядку, а медленный запрос к Encar
+    или KCar у одного пользователя не задерживает кнопки остальных.
+    Нажатия кнопок подтверждаются сразу через CallbackAcker, а повторные
+    нажатия той же кнопки отбрасываются CallbackDebouncer.
+
+    Args:
+        handler_workers: Количество потоков для обработчиков
+        callback_debounce: Окно подавления повторных нажатий, в секундах
+    """
+
+    def __init__(
+        self, *args, handler_workers=32, callback_debounce=CALLBACK_DEBOUNCE, **kwargs
+    ):
+        super().__init__(*args, **kwargs)
+        self.callback_debouncer = CallbackDebouncer(callback_debounce)
+        self.handler_executor = KeyedExecutor(
+            workers=handler_workers, on_error=self._handle_exception
+        )
+        self.callback_acker = CallbackAcker(super().answer_callback_query)
+
+    def _handle_exception(self, exc):
+        if self.exception_handler is not None and self.exception_handler.handle(exc):
+            return
+        print(f"❌ Ошибка в обработчике: {exc}")
+
+    def _exec_task(self, task, *args, **kwargs):
+        update = args[0] if args else None
+        user = getattr(update, "from_user", None)
+        if not self.threaded or user is None:
+            return super()._exec_task(task, *args, **kwargs)
+
+        if isinstance(update, types.CallbackQuery):
+            self.callback_acker.track(update)
+            if self.callback_debouncer.is_duplicate(update):
+                # Повтор просто получает пустой ответ от CallbackAcker
+                return
+        self.handler_executor.submit(user.id, task, *args, **kwargs)
+
+    def answer_callback_query(
+        self, callback_query_id, text=None, show_alert=None, url=None, cache_time=None
+    ):
+        owned, chat_id = self.callback_acker.claim(callback_query_id)
+        if owned:
+            return super().answer_callback_query(
+                callback_query_id, text, show_alert, url, cache_time
+            )
+        # Пустой ответ уже ушёл — показываем текст обычным сообщением
+        if text and chat_id is not None:
+            self.send_message(chat_id, text)
+        return True
@@ -0,0 +1,279 @@
+import base64
+import functools
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from telebot import types
+
+# Размер страницы клавиатуры марок/моделей и страницы «Популярные»
+KEYBOARD_PAGE_SIZE = 24
+POPULAR_PAGE_SIZE = 12
+ROW_WIDTH = 2
+NAV_ROW_WIDTH = 4
+
+KEYBOARD_PAGE_PREFIX = "kbpage_"
+
+MONTH_NAMES = [
+    "Январь",
+    "Февраль",
+    "Март",
+    "Апрель",
+    "Май",
+    "Июнь",
+    "Июль",
+    "Август",
+    "Сентябрь",
+    "Октябрь",
+    "Ноябрь",
+    "Декабрь",
+]
+
+# Цены в миллионах вон; в API цена передаётся в десятках тысяч (1 млн = 100)
+PRICE_STEPS = (1, 5, 10, 15, 20, 25, 30, 35, 40, 45, 50, 60, 70, 80, 90, 100)
+
+# Кнопка клавиатуры: текст, callback_data и популярность (число объявлений)
+KeyboardItem = namedtuple("KeyboardItem", ["label", "callback_data", "popularity"])
+
+
+def taxonomy_version(raw_items):
+    """Версия справочника — хэш ответа площадки, из которого строится клавиатура"""
+    raw = json.dumps(raw_items, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def _bucket_letter(label):
+    return (label.strip()[:1] or "#").upper()
+
+
+def _alphabet_pages(items, page_size):
+    """
+    Раскладывает кнопки по страницам по первой букве: буква целиком
+    попадает на одну страницу, если помещается. Возвращает список
+    (заголовок, кнопки), например ("A–C", [...]).
+    """
+    items = sorted(items, key=lambda item: item.label.casefold())
+    pages = []
+    current, letters = [], []
+    for letter in OrderedDict((_bucket_letter(i.label), None) for i in items):
+        group = [i for i in items if _bucket_letter(i.label) == letter]
+        for start in range(0, len(group), page_size):
+            chunk = group[start : start + page_size]
+            if current and len(current) + len(chunk) > page_size:
+                pages.append((letters, current))
+                current, letters = [], []
+            current.extend(chunk)
+            if letter not in letters:
+                letters.append(letter)
+    if current:
+        pages.append((letters, current))
+    return [
+        (letters[0] if len(letters) == 1 else f"{letters[0]}–{letters[-1]}", chunk)
+        for letters, chunk in pages
+    ]
+
+
+class PagedKeyboardCache:
+    """
+    Кэш постраничных клавиатур марок и моделей.
+
+    Клавиатура строится один раз на версию справочника (см.
+    taxonomy_version) и хранится в виде уже сериализованных страниц:
+    первая страница — самые популярные позиции, дальше — по алфавиту
+    с группировкой по первой букве. Повторное открытие шага — поиск в
+    кэше и отправка одной небольшой страницы, а переключение страниц
+    (callback kbpage_<id>_<n>) не обращается к площадке вовсе.
+
+    Кнопки несут токены CallbackRegistry, а токен продлевается, только
+    когда клавиатура строится заново. Поэтому клавиатура старше max_age
+    не отдаётся из lookup и перестраивается — с продлёнными токенами.
+
+    Args:
+        max_keyboards: Сколько клавиатур хранить (LRU)
+        max_age: Через сколько секунд клавиатура перестраивается
+            (None — без ограничения)
+    """
+
+    def __init__(self, max_keyboards=256, max_age=None):
+        self.max_keyboards = max_keyboards
+        self.max_age = max_age
+        self._keyboards = OrderedDict()  # keyboard_id -> [json страницы]
+        self._built_at = {}  # keyboard_id -> время построения
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _keyboard_id(name, version):
+        digest = hashlib.blake2b(f"{name}:{version}".encode("utf-8"), digest_size=6)
+        return base64.urlsafe_b64encode(digest.digest()).decode("ascii")
+
+    def lookup(self, name, raw_items):
+        """Первая страница готовой клавиатуры или None, если её нужно построить"""
+        keyboard_id = self._keyboard_id(name, taxonomy_version(raw_items))
+        with self._lock:
+            pages = self._keyboards.get(keyboard_id)
+            if pages is None:
+                return None
+            if (
+                self.max_age is not None
+                and time.time() - self._built_at[keyboard_id] >= self.max_age
+            ):
+                return None
+            self._keyboards.move_to_end(keyboard_id)
+            return pages[0]
+
+    def store(self, name, raw_items, items):
+        """
+        Строит клавиатуру из кнопок и кладёт в кэш.
+
+        Args:
+            name: Имя справочника, например "encar_brands" или "kcar_models_HD"
+            raw_items: Ответ площадки, по которому определяется версия
+            items: Список KeyboardItem
+
+        Returns:
+            str: Первая страница в виде JSON для reply_markup
+        """
+        keyboard_id = self._keyboard_id(name, taxonomy_version(raw_items))
+        pages = self._build_pages(keyboard_id, items)
+        with self._lock:
+            self._keyboards[keyboard_id] = pages
+            self._built_at[keyboard_id] = time.time()
+            self._keyboards.move_to_end(keyboard_id)
+            while len(self._keyboards) > self.max_keyboards:
+                evicted, _ = self._keyboards.popitem(last=False)
+                self._built_at.pop(evicted, None)
+        return pages[0]
+
+    def page(self, callback_data):
+        """Страница по callback_data kbpage_<id>_<n> или None, если её уже нет"""
+        payload = callback_data[len(KEYBOARD_PAGE_PREFIX) :]
+        keyboard_id, _, page = payload.rpartition("_")
+        with self._lock:
+            pages = self._keyboards.get(keyboard_id)
+        if pages is None or not page.isdigit() or int(page) >= len(pages):
+            return None
+        return pages[int(page)]
+
+    def _build_pages(self, keyboard_id, items):
+        if len(items) <= KEYBOARD_PAGE_SIZE:
+            return [self._render(items, [], 0, keyboard_id)]
+
+        pages = []
+        popular = sorted(
+            (item for item in items if item.popularity),
+            key=lambda item: item.popularity,
+            reverse=True,
+        )[:POPULAR_PAGE_SIZE]
+        if popular:
+            pages.append(("⭐ Популярные", popular))
+        pages.extend(_alphabet_pages(items, KEYBOARD_PAGE_SIZE))
+
+        titles = [title for title, _ in pages]
+        return [
+            self._render(chunk, titles, index, keyboard_id)
+            for index, (_, chunk) in enumerate(pages)
+        ]
+
+    @staticmethod
+    def _render(items, titles, current, keyboard_id):
+        markup = types.InlineKeyboardMarkup(row_width=ROW_WIDTH)
+        markup.add(
+            *[
+                types.InlineKeyboardButton(item.label, callback_data=item.callback_data)
+                for item in items
+            ]
+        )
+        if len(titles) > 1:
+            nav = [
+                types.InlineKeyboardButton(
+                    f"· {title} ·" if index == current else title,
+                    callback_data=f"{KEYBOARD_PAGE_PREFIX}{keyboard_id}_{index}",
+                )
+                for index, title in enumerate(titles)
+            ]
+            for start in range(0, len(nav), NAV_ROW_WIDTH):
+                markup.row(*nav[start : start + NAV_ROW_WIDTH])
+        return json.dumps(markup.to_dict(), ensure_ascii=False)
+
+
+def build_keyboard(buttons, row_width=3, header=None):
+    """
+    Собирает клавиатуру и сразу сериализует её для reply_markup.
+
+    Args:
+        buttons: Список пар (текст, callback_data)
+        row_width: Сколько кнопок в ряду
+        header: Необязательная пара (текст, callback_data) для отдельной
+            первой строки, например «Любой»
+
+    Returns:
+        str: JSON клавиатуры
+    """
+    markup = types.InlineKeyboardMarkup(row_width=row_width)
+    if header is not None:
+        markup.row(types.InlineKeyboardButton(header[0], callback_data=header[1]))
+    markup.add(
+        *[
+            types.InlineKeyboardButton(text, callback_data=data)
+            for text, data in buttons
+        ]
+    )
+    return json.dumps(markup.to_dict(), ensure_ascii=False)
+
+
+# Клавиатуры шагов мастера зависят только от своих параметров, поэтому
+# каждая строится один раз и дальше отдаётся из кэша готовой строкой
+
+
+@functools.lru_cache(maxsize=None)
+def year_keyboard(callback_prefix, start_year, end_year, row_width=3):
+    """Годы от start_year до end_year включительно: callback_prefix + год"""
+    return build_keyboard(
+        [
+            (str(year), f"{callback_prefix}{year}")
+            for year in range(start_year, end_year + 1)
+        ],
+        row_width,
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def month_keyboard(callback_prefix):
+    """«Любой месяц» и 12 месяцев: callback_prefix + номер месяца (0 — любой)"""
+    return build_keyboard(
+        [
+            (name, f"{callback_prefix}{number}")
+            for number, name in enumerate(MONTH_NAMES, start=1)
+        ],
+        row_width=3,
+        header=("Любой месяц", f"{callback_prefix}0"),
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def mileage_keyboard(callback_prefix, values, above=-1, row_width=3):
+    """Пробеги из values больше above: callback_prefix + пробег"""
+    return build_keyboard(
+        [
+            (f"{value} км", f"{callback_prefix}{value}")
+            for value in values
+            if value > above
+        ],
+        row_width,
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def price_keyboard(callback_prefix, above=0):
+    """«Любая» и цены из PRICE_STEPS больше above млн: callback_prefix + цена"""
+    return build_keyboard(
+        [
+            (f"{price} млн", f"{callback_prefix}{price * 100}")
+            for price in PRICE_STEPS
+            if price > above
+        ],
+        row_width=3,
+        header=("Любая", f"{callback_prefix}any"),
+    )
@@ -0,0 +1,78 @@
+import sys
+from dataclasses import dataclass
+
+
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _intern(value):
+    # Марки, модели и комплектации повторяются в тысячах объявлений —
+    # храним одну копию каждой строки
+    return sys.intern(value) if isinstance(value, str) else ""
+
+
+@dataclass(slots=True, frozen=True)
+class Listing:
+    """
+    Объявление из каталога Encar в компактном виде.
+
+    Вместо словаря из JSON со всеми вложенными списками (Photos, Trust,
+    ServiceMark, ...) хранятся только поля, которые нужны поллеру и
+    уведомлениям: числа — как int, марка/модель/комплектация —
+    интернированные строки, фотографии — кортеж пар
+    (location, updatedDate) в порядке показа.
+
+    Attributes:
+        id: Id объявления
+        manufacturer: Марка (Manufacturer)
+        model: Модель (Model)
+        badge: Комплектация (Badge)
+        year: Год выпуска (FormYear)
+        mileage: Пробег, км
+        price: Цена в десятках тысяч вон
+        photos: Фотографии для альбома
+    """
+
+    id: int
+    manufacturer: str
+    model: str
+    badge: str
+    year: int
+    mileage: int
+    price: int
+    photos: tuple = ()
+
+    @classmethod
+    def from_encar(cls, item, photo_limit=None):
+        """
+        Объявление из элемента SearchResults.
+
+        Args:
+            item: Элемент SearchResults из ответа каталога
+            photo_limit: Сколько первых фотографий сохранить (None — все)
+        """
+        photos = sorted(
+            (photo for photo in item.get("Photos") or [] if photo.get("location")),
+            key=lambda photo: photo.get("ordering", 0),
+        )[:photo_limit]
+        return cls(
+            id=_int(item.get("Id")),
+            manufacturer=_intern(item.get("Manufacturer")),
+            model=_intern(item.get("Model")),
+            badge=_intern(item.get("Badge")),
+            year=_int(item.get("FormYear")),
+            mileage=_int(item.get("Mileage")),
+            price=_int(item.get("Price")),
+            photos=tuple(
+                (photo["location"], photo.get("updatedDate", "")) for photo in photos
+            ),
+        )
+
+    @property
+    def name(self):
+        """Название для перевода и вывода: «марка модель комплектация»"""
+        return f"{self.manufacturer} {self.model} {self.badge}"
@@ -1,18 +1,43 @@
+import asyncio
+import functools
 import json
 import time
 import telebot
 import os
-import requests
 import urllib.parse
 import re
+import sys
 from telebot import types
 from telebot.handler_backends import State, StatesGroup
-from telebot.storage import StateMemoryStorage
 from dotenv import load_dotenv
 from datetime import datetime
 from translations import translations
-from bs4 import BeautifulSoup
+from wizard_state import WizardStateStorage, WizardStateStore
+from shared_state import BoundedDict, StripedLock, snapshot_dict
+from outbound import PRIORITY_ALERT, set_thread_priority
+from handler_runtime import HandlerRuntimeBot
+from callback_router import CallbackRouter
+from callback_tokens import CallbackRegistry
+from upstream import UpstreamClient
+from platforms import EncarAdapter, KBChaChaChaAdapter, KCarAdapter
+from taxonomy import SingleFlight, TaxonomyCache
+from taxonomy_snapshot import read_snapshot, write_snapshot
+from prefetch import Prefetcher
+from async_upstream import AsyncUpstreamClient, PollScheduler
+from keyboards import (
+    KEYBOARD_PAGE_PREFIX,
+    KeyboardItem,
+    PagedKeyboardCache,
+    build_keyboard,
+    mileage_keyboard,
+    month_keyboard,
+    price_keyboard,
+    year_keyboard,
+)
 import threading
+import hashlib
+import uuid
+from collections import OrderedDict
 
 # Путь до файла
 REQUESTS_FILE = "requests.json"
@@ -21,9 +46,124 @@ ACCESS_FILE = "access.json"
 # Глобальный словарь всех запросов пользователей
 user_requests = {}
 
+# Блокировки общего состояния. Изменения одного пользователя или одного
+# объявления выполняются по очереди, разных — параллельно. Файловые
+# операции сериализуются отдельными блокировками.
+user_locks = StripedLock()
+listing_locks = StripedLock()
+access_lock = threading.RLock()
+requests_file_lock = threading.RLock()
+watches_file_lock = threading.Lock()
+
 # Множество для отслеживания уже проверенных автомобилей
 checked_ids = set()
 
+# Сколько объявлений помнить в ценах и истории; самые давние вытесняются
+LISTING_MEMORY_SIZE = int(os.getenv("LISTING_MEMORY_SIZE", 50000))
+
+# Последняя известная цена по каждому Id (для уведомлений о снижении цены)
+car_prices = BoundedDict(LISTING_MEMORY_SIZE)
+
+# История объявлений: Id -> статус, цена и чаты, которым оно было отправлено
+listing_history = BoundedDict(LISTING_MEMORY_SIZE)
+
+# Сколько последних объявлений подписки держим в снимке результатов
+SNAPSHOT_PAGE_SIZE = 50
+
+# Сообщать ли пользователям о проданных/снятых автомобилях
+NOTIFY_SOLD = os.getenv("NOTIFY_SOLD", "0") == "1"
+
+# Фотографии объявлений Encar: адрес CDN и сколько снимков слать альбомом
+ENCAR_PHOTO_BASE = "https://ci.encar.com/carpicture"
+ENCAR_ALBUM_SIZE = 4
+
+# file_id фотографий, уже загруженных в Telegram: повторная отправка той же
+# фотографии другому подписчику не требует новой загрузки по ссылке.
+# Ключ — адрес фото (для Encar вместе с updatedDate)
+PHOTO_CACHE_FILE = "photo_file_ids.json"
+PHOTO_CACHE_SIZE = 5000
+# Файл перезаписывается не чаще раза в столько секунд
+PHOTO_CACHE_SAVE_INTERVAL = 30
+photo_file_ids = OrderedDict()
+photo_cache_lock = threading.Lock()
+_photo_cache_save_timer = None
+
+# Окно дайджеста: новые объявления подписки с включённым дайджестом
+# копятся это время и уходят одним сообщением
+DIGEST_WINDOW = int(os.getenv("DIGEST_WINDOW", 15 * 60))
+
+# Отслеживаемые автомобили: Id -> чаты и последнее известное состояние карточки
+WATCHES_FILE = "watches.json"
+car_watches = {}
+
+# Интервал опроса отслеживаемых автомобилей и пауза между запросами к Encar
+WATCH_POLL_INTERVAL = 600
+ENCAR_REQUEST_DELAY = 0.5
+
+# Общий HTTP-клиент для всех площадок: пул keep-alive соединений на хост,
+# заголовки площадки, таймауты и метрики задержек
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", 5))
+UPSTREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", 20))
+upstream = UpstreamClient(
+    connect_timeout=UPSTREAM_CONNECT_TIMEOUT, read_timeout=UPSTREAM_READ_TIMEOUT
+)
+
+# Одинаковые одновременные запросы справочников (марки, модели, поколения)
+# выполняются один раз, остальные вызовы получают тот же результат
+taxonomy_requests = SingleFlight()
+
+# Справочники площадок меняются редко: отдаём их из кэша сразу, а
+# устаревшие записи обновляем в фоне. Кэш переживает перезапуск
+TAXONOMY_CACHE_FILE = "taxonomy_cache.json"
+TAXONOMY_CACHE_TTL = int(os.getenv("TAXONOMY_CACHE_TTL", 6 * 60 * 60))
+taxonomy_cache = TaxonomyCache(
+    TAXONOMY_CACHE_FILE, ttl=TAXONOMY_CACHE_TTL, flight=taxonomy_requests
+)
+
+# Деревья справочников площадок целиком в памяти: фоновый обход раз в сутки,
+# шаги мастера отвечают из индекса без запросов к площадке
+TAXONOMY_CRAWL_INTERVAL = int(os.getenv("TAXONOMY_CRAWL_INTERVAL", 24 * 60 * 60))
+TAXONOMY_CRAWL_CONCURRENCY = int(os.getenv("TAXONOMY_CRAWL_CONCURRENCY", 4))
+
+# Площадки: справочник, поиск и карточки за общим интерфейсом, с общими
+# HTTP-клиентом, кэшем справочников и индексом дерева
+encar = EncarAdapter(
+    upstream,
+    taxonomy_cache,
+    concurrency=TAXONOMY_CRAWL_CONCURRENCY,
+    photo_limit=ENCAR_ALBUM_SIZE,
+    request_delay=ENCAR_REQUEST_DELAY,
+)
+kbchachacha = KBChaChaChaAdapter(
+    upstream, taxonomy_cache, concurrency=TAXONOMY_CRAWL_CONCURRENCY
+)
+kcar = KCarAdapter(upstream, taxonomy_cache, concurrency=TAXONOMY_CRAWL_CONCURRENCY)
+PLATFORMS = {adapter.name: adapter for adapter in (encar, kbchachacha, kcar)}
+TAXONOMY_INDEXES = {name: adapter.index for name, adapter in PLATFORMS.items()}
+
+# Снимок всех справочников на диске: загружается при запуске, поэтому мастер
+# отвечает сразу и работает, даже если площадки недоступны. Обновляется после
+# каждого обхода; собрать заново: python main.py export-taxonomy
+TAXONOMY_SNAPSHOT_FILE = os.getenv("TAXONOMY_SNAPSHOT_FILE", "taxonomy.snapshot")
+_taxonomy_snapshot_lock = threading.Lock()
+
+# Поллеры подписок: один цикл asyncio вместо потока на каждую подписку,
+# запросы к площадкам — через асинхронный клиент с лимитом на хост
+POLL_INTERVAL = 300
+UPSTREAM_PER_HOST_LIMIT = int(os.getenv("UPSTREAM_PER_HOST_LIMIT", 8))
+POLLER_WORKERS = int(os.getenv("POLLER_WORKERS", 16))
+async_upstream = AsyncUpstreamClient(
+    per_host_limit=UPSTREAM_PER_HOST_LIMIT,
+    connect_timeout=UPSTREAM_CONNECT_TIMEOUT,
+    read_timeout=UPSTREAM_READ_TIMEOUT,
+    metrics=upstream.metrics,
+)
+# Уведомления поллеров пропускают вперёд ответы на нажатия кнопок
+poll_scheduler = PollScheduler(
+    blocking_workers=POLLER_WORKERS,
+    thread_initializer=lambda: set_thread_priority(PRIORITY_ALERT),
+)
+
 # Словарь переводов цветов для KbChaChaCha
 KBCHACHA_COLOR_TRANSLATIONS = {
     "검정색": {"ru": "Чёрный", "code": "006001"},
@@ -91,7 +231,7 @@ def load_access():
 
 def save_access():
     try:
-        with open(ACCESS_FILE, "w", encoding="utf-8") as f:
+        with access_lock, open(ACCESS_FILE, "w", encoding="utf-8") as f:
             json.dump(list(ACCESS), f, ensure_ascii=False, indent=2)
     except Exception as e:
         print(f"⚠️ Ошибка при сохранении access.json: {e}")
@@ -115,16 +255,136 @@ COLOR_TRANSLATIONS = {
     "청옥색": "Бирюзовый",
 }
 
+# Шкалы пробега в мастерах поиска
+ENCAR_MILEAGE_STEPS = tuple(range(0, 200001, 10000))
+MILEAGE_FROM_STEPS = (0, 10000, 20000, 30000, 50000, 70000, 100000)
+MILEAGE_TO_STEPS = (50000, 100000, 150000, 200000, 250000, 300000)
+
+# Клавиатуры выбора цвета не меняются — строим их один раз при запуске
+ENCAR_COLOR_KEYBOARD = build_keyboard(
+    [(ru, f"color_{kr}") for kr, ru in COLOR_TRANSLATIONS.items()],
+    row_width=2,
+    header=("Любой", "color_all"),
+)
+KBCHACHA_COLOR_KEYBOARD = build_keyboard(
+    [
+        (info["ru"], f"kbcha_color_{kr_name}")
+        for kr_name, info in KBCHACHA_COLOR_TRANSLATIONS.items()
+        if kr_name != "Любой"
+    ],
+    row_width=2,
+    header=("Любой", "kbcha_color_Любой"),
+)
+KCAR_COLOR_KEYBOARD = build_keyboard(
+    [
+        (ru_name, f"kcar_color_{kr_name}")
+        for kr_name, ru_name in KCAR_COLOR_TRANSLATIONS.items()
+        if kr_name != "Любой"
+    ],
+    row_width=2,
+    header=("Любой", "kcar_color_Любой"),
+)
+
 # Загружаем переменные из .env
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 
+# Альтернативный адрес Bot API (локальный telegram-bot-api или заглушка
+# для тестов), в формате https://host/bot{0}/{1}
+BOT_API_URL = os.getenv("BOT_API_URL")
+if BOT_API_URL:
+    telebot.apihelper.API_URL = BOT_API_URL
+
+# Режим вебхука: если задан WEBHOOK_URL, обновления принимает FastAPI/uvicorn
+# вместо long polling. Procfile по умолчанию объявляет worker для long
+# polling. На Heroku вебхук работает только в web-процессе (туда приходит
+# трафик и задан PORT): замените в Procfile строку на
+# `web: python3 main.py`, задайте WEBHOOK_URL и WEBHOOK_SECRET и выполните
+# `heroku ps:scale worker=0 web=1`
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+# Обязателен в режиме вебхука: Telegram присылает его в заголовке
+# X-Telegram-Bot-Api-Secret-Token, остальные запросы отклоняются
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", os.getenv("WEBHOOK_PORT", 8080)))
+WEBHOOK_MAX_PENDING = int(os.getenv("WEBHOOK_MAX_PENDING", 1000))
+
+# Хранилище состояний мастера: TTL на сессию, ограничение по памяти и
+# SQLite-файл, чтобы незавершённый поиск пережил перезапуск.
+# Пустой WIZARD_STATE_DB — хранить только в памяти.
+WIZARD_STATE_DB = os.getenv("WIZARD_STATE_DB", "wizard_state.db")
+WIZARD_SESSION_TTL = int(os.getenv("WIZARD_SESSION_TTL", 6 * 3600))
+WIZARD_MAX_SESSIONS = int(os.getenv("WIZARD_MAX_SESSIONS", 5000))
+
 # FSM-хранилище
-state_storage = StateMemoryStorage()
+state_storage = WizardStateStorage(
+    WizardStateStore(
+        "fsm",
+        ttl=WIZARD_SESSION_TTL,
+        max_sessions=WIZARD_MAX_SESSIONS,
+        db_path=WIZARD_STATE_DB or None,
+    )
+)
+
+# Сколько обработчиков выполнять параллельно (обновления одного
+# пользователя всё равно обрабатываются по порядку)
+HANDLER_WORKERS = int(os.getenv("HANDLER_WORKERS", 32))
+# Окно, в котором повторное нажатие той же кнопки игнорируется, в секундах
+CALLBACK_DEBOUNCE = float(os.getenv("CALLBACK_DEBOUNCE", 1.0))
+
+# Инициализация бота. Все исходящие сообщения идут через общую очередь
+# с ограничением частоты и повторами при ответе 429 от Telegram, а
+# обработчики выполняются в пуле с очередью на каждого пользователя
+bot = HandlerRuntimeBot(
+    BOT_TOKEN,
+    state_storage=state_storage,
+    handler_workers=HANDLER_WORKERS,
+    callback_debounce=CALLBACK_DEBOUNCE,
+)
+
+# Все callback-запросы идут через один обработчик с префиксным деревом
+callback_router = CallbackRouter()
+callback_router.install(bot)
+user_search_data = WizardStateStore(
+    "search",
+    ttl=WIZARD_SESSION_TTL,
+    max_sessions=WIZARD_MAX_SESSIONS,
+    db_path=WIZARD_STATE_DB or None,
+)
+
+# Короткие токены кнопок выбора марки/модели/поколения: контекст шага
+# хранится здесь, а в callback_data — только токен
+CALLBACK_TOKEN_TTL = int(os.getenv("CALLBACK_TOKEN_TTL", 30 * 24 * 3600))
+# Как часто продлеваются токены; с тем же периодом перестраиваются
+# закэшированные клавиатуры, чтобы их токены тоже продлевались
+CALLBACK_TOKEN_REFRESH = int(os.getenv("CALLBACK_TOKEN_REFRESH", 3600))
+callback_registry = CallbackRegistry(
+    WizardStateStore(
+        "callback",
+        ttl=CALLBACK_TOKEN_TTL,
+        max_sessions=20000,
+        db_path=WIZARD_STATE_DB or None,
+    ),
+    refresh_interval=CALLBACK_TOKEN_REFRESH,
+)
+
+
+def pack_callback(prefix, **node):
+    """callback_data вида prefix + короткий токен узла"""
+    return f"{prefix}{callback_registry.token(node)}"
+
 
-# Инициализация бота
-bot = telebot.TeleBot(BOT_TOKEN, state_storage=state_storage)
-user_search_data = {}
+def unpack_callback(call, prefix):
+    """Контекст кнопки по токену из call.data или None, если кнопка устарела"""
+    node = callback_registry.resolve(call.data[len(prefix) :])
+    if node is None:
+        bot.answer_callback_query(call.id, "Кнопка устарела, начните поиск заново.")
+    return node
+
+
+# Готовые постраничные клавиатуры марок и моделей всех площадок
+taxonomy_keyboards = PagedKeyboardCache(max_age=CALLBACK_TOKEN_REFRESH)
 
 # Загружаем список пользователей с доступом сразу при старте
 ACCESS = load_access()
@@ -144,12 +404,12 @@ def is_authorized(user_id):
         f"🔍 DEBUG [is_authorized] - Проверка доступа для user_id: {user_id} (тип: {type(user_id)})"
     )
     print(f"🔍 DEBUG [is_authorized] - Always allowed: {always_allowed}")
-    print(f"🔍 DEBUG [is_authorized] - ACCESS: {ACCESS}")
 
     # Если пользователь в списке always_allowed, но его нет в ACCESS, добавляем
     if user_id in always_allowed and user_id not in ACCESS:
-        ACCESS.add(user_id)
-        save_access()
+        with access_lock:
+            ACCESS.add(user_id)
+            save_access()
         print(f"✅ Пользователь {user_id} автоматически добавлен в список доступа")
 
     result = user_id in ACCESS
@@ -201,39 +461,41 @@ def translate_smartly(text):
 
 
 def load_requests():
-    global user_requests
-    if os.path.exists(REQUESTS_FILE):
+    """
+    Читает запросы из файла при запуске. Дальше источник истины — память:
+    обработчики меняют user_requests под user_locks и только сохраняют
+    его, не перечитывая файл. Запросы каждого пользователя добавляются
+    под его блокировкой, а общий словарь не очищается.
+    """
+    with requests_file_lock:
+        if not os.path.exists(REQUESTS_FILE):
+            return
         try:
             with open(REQUESTS_FILE, "r", encoding="utf-8") as f:
-                user_requests = json.load(f)
+                loaded = json.load(f)
         except Exception as e:
             print(f"⚠️ Не удалось загрузить запросы: {e}")
-            user_requests = {}
-    else:
-        user_requests = {}
+            return
+    for user_id, requests_list in loaded.items():
+        with user_locks(user_id):
+            user_requests.setdefault(str(user_id), requests_list)
 
 
 def save_requests(new_data):
-    global user_requests
-    try:
-        if os.path.exists(REQUESTS_FILE):
-            with open(REQUESTS_FILE, "r", encoding="utf-8") as f:
-                content = f.read().strip()
-                existing_data = json.loads(content) if content else {}
-        else:
-            existing_data = {}
-
-        for user_id, new_requests in new_data.items():
-            # Убедимся, что user_id — строка
-            user_id_str = str(user_id)
-            existing_data[user_id_str] = new_requests
-
-        user_requests = existing_data  # Обновляем глобальные данные
-
-        with open(REQUESTS_FILE, "w", encoding="utf-8") as f:
-            json.dump(user_requests, f, ensure_ascii=False, indent=2)
-    except Exception as e:
-        print(f"⚠️ Ошибка сохранения запросов: {e}")
+    # Пока пишем файл, другие потоки могут менять запросы — работаем с копией.
+    # Копия снимается под блокировкой файла, чтобы более старый снимок не
+    # записался поверх более нового
+    with requests_file_lock:
+        new_data = {
+            str(user_id): reqs for user_id, reqs in snapshot_dict(new_data).items()
+        }
+        tmp_path = f"{REQUESTS_FILE}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(new_data, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, REQUESTS_FILE)
+        except Exception as e:
+            print(f"⚠️ Ошибка сохранения запросов: {e}")
 
 
 # FSM: Состояния формы
@@ -248,140 +510,78 @@ class CarForm(StatesGroup):
 
 
 def get_manufacturers():
-    url = "https://encar-proxy.habsida.net/api/nav?count=true&q=(And.Hidden.N._.SellType.%EC%9D%BC%EB%B0%98._.CarType.A.)&inav=%7CMetadata%7CSort"
-    headers = {"User-Agent": "Mozilla/5.0"}
-    try:
-        response = requests.get(url, headers=headers)
-        data = response.json()
-        manufacturers = (
-            data.get("iNav", {})
-            .get("Nodes", [])[2]
-            .get("Facets", [])[0]
-            .get("Refinements", {})
-            .get("Nodes", [])[0]
-            .get("Facets", [])
-        )
-        manufacturers.sort(key=lambda x: x.get("Metadata", {}).get("EngName", [""])[0])
-        return manufacturers
-    except Exception as e:
-        print("Ошибка при получении марок:", e)
-        return []
+    return encar.taxonomy()
 
 
 def get_models_by_brand(manufacturer):
-    url = f"https://encar-proxy.habsida.net/api/nav?count=true&q=(And.Hidden.N._.SellType.%EC%9D%BC%EB%B0%98._.(C.CarType.A._.Manufacturer.{manufacturer}.))&inav=%7CMetadata%7CSort"
-    headers = {"User-Agent": "Mozilla/5.0"}
-    try:
-        response = requests.get(url, headers=headers)
-        data = response.json()
-        all_manufacturers = (
-            data.get("iNav", {})
-            .get("Nodes", [])[2]
-            .get("Facets", [])[0]
-            .get("Refinements", {})
-            .get("Nodes", [])[0]
-            .get("Facets", [])
-        )
-        selected_manufacturer = next(
-            (item for item in all_manufacturers if item.get("IsSelected")), None
-        )
-        if selected_manufacturer:
-            return (
-                selected_manufacturer.get("Refinements", {})
-                .get("Nodes", [])[0]
-                .get("Facets", [])
-            )
-        return []
-    except Exception as e:
-        print(f"Ошибка при получении моделей для {manufacturer}:", e)
-        return []
+    return encar.taxonomy(manufacturer)
 
 
 def get_generations_by_model(manufacturer, model_group):
-    url = f"https://encar-proxy.habsida.net/api/nav?count=true&q=(And.Hidden.N._.SellType.%EC%9D%BC%EB%B0%98._.(C.CarType.A._.(C.Manufacturer.{manufacturer}._.ModelGroup.{model_group}.)))&inav=%7CMetadata%7CSort"
-    headers = {"User-Agent": "Mozilla/5.0"}
-    try:
-        response = requests.get(url, headers=headers)
-        data = response.json()
-        all_manufacturers = (
-            data.get("iNav", {})
-            .get("Nodes", [])[2]
-            .get("Facets", [])[0]
-            .get("Refinements", {})
-            .get("Nodes", [])[0]
-            .get("Facets", [])
-        )
-        selected_manufacturer = next(
-            (item for item in all_manufacturers if item.get("IsSelected")), None
-        )
-        if not selected_manufacturer:
-            return []
-        model_group_data = (
-            selected_manufacturer.get("Refinements", {})
-            .get("Nodes", [])[0]
-            .get("Facets", [])
-        )
-        selected_model = next(
-            (item for item in model_group_data if item.get("IsSelected")), None
-        )
-        if not selected_model:
-            return []
-        return (
-            selected_model.get("Refinements", {}).get("Nodes", [])[0].get("Facets", [])
-        )
-    except Exception as e:
-        print(f"Ошибка при получении поколений для {manufacturer}, {model_group}:", e)
-        return []
+    return encar.taxonomy(manufacturer, model_group)
 
 
 def get_trims_by_generation(manufacturer, model_group, model):
-    url = f"https://encar-proxy.habsida.net/api/nav?count=true&q=(And.Hidden.N._.(C.CarType.A._.(C.Manufacturer.{manufacturer}._.(C.ModelGroup.{model_group}._.Model.{model}.))))&inav=%7CMetadata%7CSort"
-    headers = {"User-Agent": "Mozilla/5.0"}
+    return encar.taxonomy(manufacturer, model_group, model)
+
+
+# Пока пользователь выбирает марку, модель или поколение, в фоне прогреваем
+# следующий шаг для самых частых вариантов из сохранённых запросов
+PREFETCH_TOP_N = int(os.getenv("PREFETCH_TOP_N", 3))
+PREFETCH_BUDGET = int(os.getenv("PREFETCH_BUDGET", 10))
+encar_prefetch = Prefetcher(
+    {1: get_models_by_brand, 2: get_generations_by_model, 3: get_trims_by_generation},
+    top_n=PREFETCH_TOP_N,
+    budget=PREFETCH_BUDGET,
+    is_warm=lambda path: encar.index.children(*path) is not None,
+)
+
+
+def saved_request_paths():
+    """Пути (марка, модель, поколение) всех сохранённых запросов Encar"""
+    with requests_file_lock:
+        requests_snapshot = [list(reqs) for reqs in user_requests.values()]
+    return [
+        (req["manufacturer"], req["model_group"], req["model"])
+        for reqs in requests_snapshot
+        for req in reqs
+        if req.get("manufacturer") and req.get("model_group") and req.get("model")
+    ]
+
+
+def save_taxonomy_snapshot():
+    with _taxonomy_snapshot_lock:
+        try:
+            size = write_snapshot(TAXONOMY_SNAPSHOT_FILE, TAXONOMY_INDEXES)
+            print(f"💾 Снимок справочников сохранён: {size // 1024} КБ")
+        except Exception as e:
+            print(f"⚠️ Ошибка при сохранении {TAXONOMY_SNAPSHOT_FILE}: {e}")
+
+
+def load_taxonomy_snapshot():
     try:
-        response = requests.get(url, headers=headers)
-        data = response.json()
-        all_manufacturers = (
-            data.get("iNav", {})
-            .get("Nodes", [])[1]
-            .get("Facets", [])[0]
-            .get("Refinements", {})
-            .get("Nodes", [])[0]
-            .get("Facets", [])
-        )
-        selected_manufacturer = next(
-            (item for item in all_manufacturers if item.get("IsSelected")), None
-        )
-        if not selected_manufacturer:
-            return []
-        model_group_data = (
-            selected_manufacturer.get("Refinements", {})
-            .get("Nodes", [])[0]
-            .get("Facets", [])
-        )
-        selected_model_group = next(
-            (item for item in model_group_data if item.get("IsSelected")), None
-        )
-        if not selected_model_group:
-            return []
-        model_data = (
-            selected_model_group.get("Refinements", {})
-            .get("Nodes", [])[0]
-            .get("Facets", [])
-        )
-        selected_model = next(
-            (item for item in model_data if item.get("IsSelected")), None
-        )
-        if not selected_model:
-            return []
-        return (
-            selected_model.get("Refinements", {}).get("Nodes", [])[0].get("Facets", [])
-        )
+        created_at = read_snapshot(TAXONOMY_SNAPSHOT_FILE, TAXONOMY_INDEXES)
     except Exception as e:
+        print(f"⚠️ Не удалось загрузить {TAXONOMY_SNAPSHOT_FILE}: {e}")
+        return
+    if created_at is not None:
         print(
-            f"Ошибка при получении комплектаций для {manufacturer}, {model_group}, {model}:",
-            e,
+            f"🌳 Справочники из снимка от "
+            f"{datetime.fromtimestamp(created_at).strftime('%Y-%m-%d %H:%M')}: "
+            + ", ".join(f"{name} {len(ix)}" for name, ix in TAXONOMY_INDEXES.items())
         )
-        return []
+
+
+def export_taxonomy():
+    """Полный обход справочников всех площадок и запись снимка"""
+    for name, index in TAXONOMY_INDEXES.items():
+        started = time.monotonic()
+        count, fetched, failed = index.crawl(full=True)
+        print(
+            f"🌳 {name}: {count} узлов, запрошено веток {fetched}, "
+            f"с ошибкой {failed}, {time.monotonic() - started:.0f} с"
+        )
+    save_taxonomy_snapshot()
 
 
 @bot.message_handler(commands=["start"])
@@ -452,8 +652,9 @@ def handle_add_user(message):
 def process_user_id_input(message):
     try:
         new_user_id = int(message.text.strip())
-        ACCESS.add(new_user_id)
-        save_access()
+        with access_lock:
+            ACCESS.add(new_user_id)
+            save_access()
         bot.send_message(
             message.chat.id,
             f"✅ Пользователю с ID {new_user_id} разрешён доступ к боту.",
@@ -462,7 +663,7 @@ def process_user_id_input(message):
         bot.send_message(message.chat.id, "⚠️ Введите корректный числовой ID.")
 
 
-@bot.callback_query_handler(func=lambda call: call.data == "start")
+@callback_router.exact("start")
 def handle_start_callback(call):
     user_id = call.from_user.id
 
@@ -470,7 +671,6 @@ def handle_start_callback(call):
     print(
         f"🔍 DEBUG [handle_start_callback] - User ID: {user_id} (тип: {type(user_id)})"
     )
-    print(f"🔍 DEBUG [handle_start_callback] - ACCESS содержит: {ACCESS}")
     print(f"🔍 DEBUG [handle_start_callback] - user_id в ACCESS: {user_id in ACCESS}")
 
     if not is_authorized(user_id):
@@ -486,7 +686,7 @@ def handle_start_callback(call):
     start_handler(call.message)
 
 
-@bot.callback_query_handler(func=lambda call: call.data == "my_requests")
+@callback_router.exact("my_requests")
 def handle_my_requests(call):
     if not is_authorized(call.from_user.id):
         bot.answer_callback_query(call.id, "❌ У вас нет доступа к боту.")
@@ -494,7 +694,6 @@ def handle_my_requests(call):
 
     user_id = str(call.from_user.id)
     requests_list = user_requests.get(user_id, [])
-    load_requests()
 
     if not requests_list:
         bot.answer_callback_query(call.id, "У вас пока нет сохранённых запросов.")
@@ -515,26 +714,78 @@ def handle_my_requests(call):
             f"Цвет: {color}"
         )
 
-        markup = types.InlineKeyboardMarkup()
-        markup.add(
-            types.InlineKeyboardButton(
-                f"🗑 Удалить запрос #{idx}", callback_data=f"delete_request_{idx - 1}"
-            )
-        )
         bot.send_message(
-            call.message.chat.id, text, parse_mode="Markdown", reply_markup=markup
+            call.message.chat.id,
+            text,
+            parse_mode="Markdown",
+            reply_markup=get_request_markup(idx, req),
+        )
+
+
+def get_request_markup(idx, req):
+    markup = types.InlineKeyboardMarkup()
+    markup.add(
+        types.InlineKeyboardButton(
+            f"🗑 Удалить запрос #{idx}", callback_data=f"delete_request_{idx - 1}"
+        )
+    )
+    digest_label = "📰 Дайджест: вкл" if req.get("digest") else "📰 Дайджест: выкл"
+    markup.add(
+        types.InlineKeyboardButton(
+            digest_label, callback_data=f"digest_toggle_{idx - 1}"
         )
+    )
+    return markup
+
 
+@callback_router.prefix("digest_toggle_")
+def handle_digest_toggle(call):
+    user_id = str(call.from_user.id)
+    index = int(call.data.split("_")[2])
+    with user_locks(user_id):
+        if user_id not in user_requests or index >= len(user_requests[user_id]):
+            bot.answer_callback_query(call.id, "⚠️ Запрос не найден.")
+            return
+        req = user_requests[user_id][index]
+        req["digest"] = not req.get("digest", False)
+        enabled = req["digest"]
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("delete_request_"))
+    save_requests(user_requests)
+    bot.edit_message_reply_markup(
+        chat_id=call.message.chat.id,
+        message_id=call.message.message_id,
+        reply_markup=get_request_markup(index + 1, req),
+    )
+    bot.answer_callback_query(
+        call.id,
+        (
+            f"Новые объявления будут приходить одним сообщением раз в {DIGEST_WINDOW // 60} мин."
+            if enabled
+            else "Новые объявления будут приходить сразу."
+        ),
+    )
+
+
+def get_subscription(user_id, subscription_id):
+    """Поиск сохранённого запроса пользователя по его id"""
+    for req in user_requests.get(str(user_id), []):
+        if req.get("id") == subscription_id:
+            return req
+    return None
+
+
+@callback_router.prefix("delete_request_")
 def handle_delete_request(call):
     user_id = str(call.from_user.id)
     index = int(call.data.split("_")[2])
-    if user_id not in user_requests or index >= len(user_requests[user_id]):
-        bot.answer_callback_query(call.id, "⚠️ Запрос не найден.")
-        return
+    with user_locks(user_id):
+        if user_id not in user_requests or index >= len(user_requests[user_id]):
+            bot.answer_callback_query(call.id, "⚠️ Запрос не найден.")
+            return
 
-    removed = user_requests[user_id].pop(index)
+        removed = user_requests[user_id].pop(index)
+        if removed.get("id"):
+            poll_scheduler.cancel(removed["id"])
 
     markup = types.InlineKeyboardMarkup()
     markup.add(
@@ -549,22 +800,26 @@ def handle_delete_request(call):
 
     print(f"🗑 Удалён запрос пользователя {user_id}: {removed}")
     save_requests(user_requests)
-    load_requests()
 
 
-@bot.callback_query_handler(func=lambda call: call.data == "delete_all_requests")
+@callback_router.exact("delete_all_requests")
 def handle_delete_all_requests(call):
     user_id = str(call.from_user.id)
-    if user_id in user_requests:
-        user_requests[user_id] = []
+    with user_locks(user_id):
+        has_requests = user_id in user_requests
+        if has_requests:
+            for req in user_requests[user_id]:
+                if req.get("id"):
+                    poll_scheduler.cancel(req["id"])
+            user_requests[user_id] = []
+    if has_requests:
         save_requests(user_requests)
-        load_requests()
         bot.send_message(call.message.chat.id, "✅ Все ваши запросы успешно удалены.")
     else:
         bot.send_message(call.message.chat.id, "⚠️ У вас нет сохранённых запросов.")
 
 
-@bot.callback_query_handler(func=lambda call: call.data == "search_car")
+@callback_router.exact("search_car")
 def handle_search_car(call):
     # Создаем клавиатуру с выбором площадок
     markup = types.InlineKeyboardMarkup(row_width=1)
@@ -579,7 +834,20 @@ def handle_search_car(call):
     )
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("platform_"))
+@callback_router.prefix(KEYBOARD_PAGE_PREFIX)
+def handle_keyboard_page(call):
+    markup = taxonomy_keyboards.page(call.data)
+    if markup is None:
+        bot.answer_callback_query(call.id, "Кнопка устарела, начните поиск заново.")
+        return
+    bot.edit_message_reply_markup(
+        chat_id=call.message.chat.id,
+        message_id=call.message.message_id,
+        reply_markup=markup,
+    )
+
+
+@callback_router.prefix("platform_")
 def handle_platform_selection(call):
     platform = call.data.split("_")[1]
 
@@ -597,38 +865,52 @@ def handle_encar_search(call):
         bot.answer_callback_query(call.id, "Не удалось загрузить марки.")
         return
 
-    markup = types.InlineKeyboardMarkup(row_width=2)
-    for item in manufacturers:  # Удалено ограничение [:10]
-        kr_name = item.get("DisplayValue", "Без названия")
-        eng_name = item.get("Metadata", {}).get("EngName", [""])[0]
-        callback_data = f"brand_{eng_name}_{kr_name}"
-        display_text = f"{eng_name}"
-        markup.add(
-            types.InlineKeyboardButton(display_text, callback_data=callback_data)
-        )
+    markup = taxonomy_keyboards.lookup("encar_brands", manufacturers)
+    if markup is None:
+        items = []
+        for item in manufacturers:
+            kr_name = item.get("DisplayValue", "Без названия")
+            eng_name = item.get("Metadata", {}).get("EngName", [""])[0]
+            callback_data = pack_callback(
+                "brand_", brand_eng=eng_name, brand_kr=kr_name
+            )
+            display_text = f"{eng_name}"
+            items.append(
+                KeyboardItem(display_text, callback_data, item.get("Count", 0))
+            )
+        markup = taxonomy_keyboards.store("encar_brands", manufacturers, items)
 
     bot.send_message(
         call.message.chat.id, "Выбери марку автомобиля:", reply_markup=markup
     )
+    encar_prefetch.after_step(call.from_user.id, ())
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("brand_"))
+@callback_router.prefix("brand_")
 def handle_brand_selection(call):
-    _, eng_name, kr_name = call.data.split("_", 2)
+    node = unpack_callback(call, "brand_")
+    if node is None:
+        return
+    eng_name, kr_name = node["brand_eng"], node["brand_kr"]
     models = get_models_by_brand(kr_name)
     if not models:
         bot.answer_callback_query(call.id, "Не удалось загрузить модели.")
         return
 
-    markup = types.InlineKeyboardMarkup(row_width=2)
-    for item in models:
-        model_kr = item.get("DisplayValue", "Без названия")
-        model_eng = item.get("Metadata", {}).get("EngName", [""])[0]
-        callback_data = f"model_{model_eng}_{model_kr}"
-        display_text = f"{model_eng}"
-        markup.add(
-            types.InlineKeyboardButton(display_text, callback_data=callback_data)
-        )
+    markup = taxonomy_keyboards.lookup(f"encar_models_{kr_name}", models)
+    if markup is None:
+        items = []
+        for item in models:
+            model_kr = item.get("DisplayValue", "Без названия")
+            model_eng = item.get("Metadata", {}).get("EngName", [""])[0]
+            callback_data = pack_callback(
+                "model_", **node, model_eng=model_eng, model_kr=model_kr
+            )
+            display_text = f"{model_eng}"
+            items.append(
+                KeyboardItem(display_text, callback_data, item.get("Count", 0))
+            )
+        markup = taxonomy_keyboards.store(f"encar_models_{kr_name}", models, items)
 
     bot.edit_message_text(
         f"Марка: {eng_name} ({kr_name})\nТеперь выбери модель:",
@@ -636,23 +918,16 @@ def handle_brand_selection(call):
         message_id=call.message.message_id,
         reply_markup=markup,
     )
+    encar_prefetch.after_step(call.from_user.id, (kr_name,))
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("model_"))
+@callback_router.prefix("model_")
 def handle_model_selection(call):
-    _, model_eng, model_kr = call.data.split("_", 2)
-    message_text = call.message.text
-    # Получаем марку из предыдущего текста сообщения
-    brand_line = next(
-        (line for line in message_text.split("\n") if "Марка:" in line), ""
-    )
-    brand_part = brand_line.replace("Марка:", "").strip()
-    if " (" in brand_part:
-        brand_eng, brand_kr = brand_part.split(" (")
-        brand_kr = brand_kr.rstrip(")")
-    else:
-        brand_eng = brand_part
-        brand_kr = ""
+    node = unpack_callback(call, "model_")
+    if node is None:
+        return
+    brand_eng, brand_kr = node["brand_eng"], node["brand_kr"]
+    model_eng, model_kr = node["model_eng"], node["model_kr"]
 
     generations = get_generations_by_model(brand_kr, model_kr)
     if not generations:
@@ -684,7 +959,9 @@ def handle_model_selection(call):
 
         period = f"({start_date} — {end_date})" if start_date else ""
 
-        callback_data = f"generation_{gen_eng}_{gen_kr}"
+        callback_data = pack_callback(
+            "generation_", **node, gen_eng=gen_eng, gen_kr=gen_kr
+        )
         translated_gen_kr = translate_smartly(gen_kr)
         translated_gen_eng = translate_smartly(gen_eng)
 
@@ -705,12 +982,17 @@ def handle_model_selection(call):
         message_id=call.message.message_id,
         reply_markup=markup,
     )
+    encar_prefetch.after_step(call.from_user.id, (brand_kr, model_kr))
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("generation_"))
+@callback_router.prefix("generation_")
 def handle_generation_selection(call):
-    _, generation_eng, generation_kr = call.data.split("_", 2)
-    message_text = call.message.text
+    node = unpack_callback(call, "generation_")
+    if node is None:
+        return
+    brand_eng, brand_kr = node["brand_eng"], node["brand_kr"]
+    model_eng, model_kr = node["model_eng"], node["model_kr"]
+    generation_eng, generation_kr = node["gen_eng"], node["gen_kr"]
 
     # Выводим оригинальные данные для отладки
     print(
@@ -718,33 +1000,7 @@ def handle_generation_selection(call):
     )
     print(f"🔍 DEBUG [handle_generation_selection] - generation_kr: '{generation_kr}'")
 
-    # Получаем информацию о марке и модели из сообщения
-    brand_line = next(
-        (line for line in message_text.split("\n") if "Марка:" in line), ""
-    )
-    model_line = next(
-        (line for line in message_text.split("\n") if "Модель:" in line), ""
-    )
-
-    # Парсим информацию о марке
-    brand_info = brand_line.replace("Марка:", "").strip()
-    if " (" in brand_info and ")" in brand_info:
-        brand_eng, brand_kr = brand_info.split(" (", 1)
-        brand_kr = brand_kr.rstrip(")")
-    else:
-        brand_eng = brand_info
-        brand_kr = ""
-
-    # Парсим информацию о модели
-    model_info = model_line.replace("Модель:", "").strip()
-    if " (" in model_info and ")" in model_info:
-        model_eng, model_kr = model_info.split(" (", 1)
-        model_kr = model_kr.rstrip(")")
-    else:
-        model_eng = model_info
-        model_kr = ""
-
-    # Логгируем извлеченные данные
+    # Логгируем данные из реестра кнопок
     print(
         f"🔍 DEBUG [handle_generation_selection] - brand_eng: '{brand_eng}', brand_kr: '{brand_kr}'"
     )
@@ -752,24 +1008,29 @@ def handle_generation_selection(call):
         f"🔍 DEBUG [handle_generation_selection] - model_eng: '{model_eng}', model_kr: '{model_kr}'"
     )
 
-    # Получаем поколения для определения дат
-    generations = get_generations_by_model(brand_kr, model_kr)
-    if not generations:
-        print(f"❌ DEBUG [handle_generation_selection] - Не удалось получить поколения")
-        bot.answer_callback_query(call.id, "Не удалось определить поколение.")
-        return
+    # Даты поколения берём из индекса справочника, а пока ветка не
+    # проиндексирована — из списка поколений модели
+    selected_generation = encar.index.node(brand_kr, model_kr, generation_kr)
+    if selected_generation is None:
+        generations = get_generations_by_model(brand_kr, model_kr)
+        if not generations:
+            print(
+                f"❌ DEBUG [handle_generation_selection] - Не удалось получить поколения"
+            )
+            bot.answer_callback_query(call.id, "Не удалось определить поколение.")
+            return
 
-    # Ищем информацию о данном поколении среди полученных
-    selected_generation = next(
-        (
-            g
-            for g in generations
-            if (g.get("DisplayValue") == generation_kr)
-            or (generation_kr in g.get("DisplayValue", ""))
-            or (generation_eng in g.get("Metadata", {}).get("EngName", [""])[0])
-        ),
-        None,
-    )
+        # Ищем информацию о данном поколении среди полученных
+        selected_generation = next(
+            (
+                g
+                for g in generations
+                if (g.get("DisplayValue") == generation_kr)
+                or (generation_kr in g.get("DisplayValue", ""))
+                or (generation_eng in g.get("Metadata", {}).get("EngName", [""])[0])
+            ),
+            None,
+        )
 
     # Инициализируем переменные для хранения годов
     start_year, end_year = None, None
@@ -959,7 +1220,9 @@ def handle_generation_selection(call):
     for item in trims:
         trim_kr = item.get("DisplayValue", "")
         trim_eng = item.get("Metadata", {}).get("EngName", [""])[0]
-        callback_data = f"trim_{trim_eng}_{trim_kr}"
+        callback_data = pack_callback(
+            "trim_", **node, trim_eng=trim_eng, trim_kr=trim_kr
+        )
 
         # Используем translate_smartly для перевода названия комплектации
         translated_trim_kr = translate_smartly(trim_kr)
@@ -1001,11 +1264,12 @@ def handle_generation_selection(call):
     )
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("trim_"))
+@callback_router.prefix("trim_")
 def handle_trim_selection(call):
-    parts = call.data.split("_", 2)
-    trim_eng = parts[1]
-    trim_kr = parts[2] if len(parts) > 2 else parts[1]
+    node = unpack_callback(call, "trim_")
+    if node is None:
+        return
+    trim_eng, trim_kr = node["trim_eng"], node["trim_kr"]
 
     print(f"✅ DEBUG [handle_trim_selection] - raw data:")
     print(f"trim_eng: {trim_eng}")
@@ -1035,59 +1299,14 @@ def handle_trim_selection(call):
     )
     print(json.dumps(user_search_data[user_id], indent=2, ensure_ascii=False))
 
-    year_markup = types.InlineKeyboardMarkup(row_width=4)
-
-    # Формируем кнопки с годами для выбора - от 2000 до текущего
-    # Отображаем каждый год без пропусков
-    year_range = list(range(start_year, end_year + 1))
-
-    print(
-        f"✅ DEBUG [handle_trim_selection] - Формируем кнопки для годов: {year_range}"
-    )
-
-    # Формируем кнопки с годами для выбора
-    for y in year_range:
-        year_markup.add(
-            types.InlineKeyboardButton(str(y), callback_data=f"year_from_{y}")
-        )
+    # Кнопки с годами для выбора - от 2000 до текущего, каждый год без пропусков
+    year_markup = year_keyboard("year_from_", start_year, end_year, row_width=4)
 
-    # Получаем информацию о выбранном автомобиле для отображения
-    message_text = call.message.text
-    brand_line = next(
-        (line for line in message_text.split("\n") if "Марка:" in line), ""
-    )
-    model_line = next(
-        (line for line in message_text.split("\n") if "Модель:" in line), ""
-    )
-    generation_line = next(
-        (line for line in message_text.split("\n") if "Поколение:" in line), ""
-    )
-
-    # Парсим информацию из текста сообщения
-    brand_info = brand_line.replace("Марка:", "").strip()
-    if " (" in brand_info and ")" in brand_info:
-        brand_eng, brand_kr = brand_info.split(" (", 1)
-        brand_kr = brand_kr.rstrip(")")
-    else:
-        brand_eng = brand_info
-        brand_kr = ""
-
-    model_info = model_line.replace("Модель:", "").strip()
-    if " (" in model_info and ")" in model_info:
-        model_eng, model_kr = model_info.split(" (", 1)
-        model_kr = model_kr.rstrip(")")
-    else:
-        model_eng = model_info
-        model_kr = ""
-
-    generation_info = generation_line.replace("Поколение:", "").strip()
-    if "(" in generation_info and ")" in generation_info:
-        parts = generation_info.rsplit("(", 1)
-        generation_eng = parts[0].strip()
-        generation_kr = parts[1].replace(")", "").strip()
-    else:
-        generation_eng = generation_info
-        generation_kr = ""
+    # Информация о выбранном автомобиле для отображения — из реестра кнопок
+    brand_eng, brand_kr = node["brand_eng"], node["brand_kr"]
+    model_eng, model_kr = node["model_eng"], node["model_kr"]
+    generation_eng = translate_smartly(node["gen_eng"])
+    generation_kr = translate_smartly(node["gen_kr"])
 
     # Используем translate_smartly для перевода названий комплектаций
     translated_trim_eng = translate_smartly(trim_eng)
@@ -1104,7 +1323,7 @@ def handle_trim_selection(call):
     )
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("year_from_"))
+@callback_router.prefix("year_from_")
 def handle_year_from_selection(call):
     year_from = int(call.data.split("_")[2])
     user_id = call.from_user.id
@@ -1119,36 +1338,7 @@ def handle_year_from_selection(call):
     print(json.dumps(user_search_data[user_id], indent=2, ensure_ascii=False))
 
     # Показываем выбор месяца для начального года
-    month_markup = types.InlineKeyboardMarkup(row_width=3)
-
-    # Добавляем опцию "Любой месяц"
-    month_markup.add(
-        types.InlineKeyboardButton(
-            "Любой месяц", callback_data=f"month_from_{year_from}_0"
-        )
-    )
-
-    # Добавляем все месяцы (1-12)
-    for month in range(1, 13):
-        month_name = [
-            "Январь",
-            "Февраль",
-            "Март",
-            "Апрель",
-            "Май",
-            "Июнь",
-            "Июль",
-            "Август",
-            "Сентябрь",
-            "Октябрь",
-            "Ноябрь",
-            "Декабрь",
-        ][month - 1]
-        month_markup.add(
-            types.InlineKeyboardButton(
-                f"{month_name}", callback_data=f"month_from_{year_from}_{month}"
-            )
-        )
+    month_markup = month_keyboard(f"month_from_{year_from}_")
 
     # Сообщение о выборе месяца
     bot.edit_message_text(
@@ -1159,7 +1349,7 @@ def handle_year_from_selection(call):
     )
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("month_from_"))
+@callback_router.prefix("month_from_")
 def handle_month_from_selection(call):
     # Парсим данные из callback_data
     parts = call.data.split("_")
@@ -1183,27 +1373,20 @@ def handle_month_from_selection(call):
     )
 
     # Формируем диапазон лет от выбранного года до текущего года
-    year_markup = types.InlineKeyboardMarkup(row_width=4)
-
     # Если выбранный год начала > текущего года, показываем только текущий год
     if year_from > current_year:
         print(
             f"⚠️ DEBUG [handle_month_from_selection] - Выбранный год начала ({year_from}) > текущего года ({current_year}), корректируем"
         )
-        year_range = [current_year]
+        first_year = current_year
     else:
         # Отображаем каждый год от выбранного начального до текущего без пропусков
-        year_range = list(range(year_from, current_year + 1))
+        first_year = year_from
 
-    print(
-        f"✅ DEBUG [handle_month_from_selection] - Предлагаемые годы для выбора to: {list(year_range)}"
+    year_markup = year_keyboard(
+        f"year_to_{year_from}_", first_year, current_year, row_width=4
     )
 
-    for y in year_range:
-        year_markup.add(
-            types.InlineKeyboardButton(str(y), callback_data=f"year_to_{year_from}_{y}")
-        )
-
     # Отображаем информацию о выбранном месяце в сообщении
     month_name = (
         "любой"
@@ -1235,7 +1418,7 @@ def handle_month_from_selection(call):
     )
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("year_to_"))
+@callback_router.prefix("year_to_")
 def handle_year_to_selection(call):
     year_from = int(call.data.split("_")[2])
     year_to = int(call.data.split("_")[3])
@@ -1259,36 +1442,7 @@ def handle_year_to_selection(call):
     print(json.dumps(user_search_data[user_id], indent=2, ensure_ascii=False))
 
     # Показываем выбор месяца для конечного года
-    month_markup = types.InlineKeyboardMarkup(row_width=3)
-
-    # Добавляем опцию "Любой месяц"
-    month_markup.add(
-        types.InlineKeyboardButton(
-            "Любой месяц", callback_data=f"month_to_{year_from}_{year_to}_0"
-        )
-    )
-
-    # Добавляем все месяцы (1-12)
-    for month in range(1, 13):
-        month_name = [
-            "Январь",
-            "Февраль",
-            "Март",
-            "Апрель",
-            "Май",
-            "Июнь",
-            "Июль",
-            "Август",
-            "Сентябрь",
-            "Октябрь",
-            "Ноябрь",
-            "Декабрь",
-        ][month - 1]
-        month_markup.add(
-            types.InlineKeyboardButton(
-                f"{month_name}", callback_data=f"month_to_{year_from}_{year_to}_{month}"
-            )
-        )
+    month_markup = month_keyboard(f"month_to_{year_from}_{year_to}_")
 
     # Добавляем информацию о периоде поиска
     period_info = f"Доступный период поиска: 2000-{current_year}"
@@ -1301,7 +1455,7 @@ def handle_year_to_selection(call):
     )
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("month_to_"))
+@callback_router.prefix("month_to_")
 def handle_month_to_selection(call):
     # Парсим данные из callback_data
     parts = call.data.split("_")
@@ -1368,13 +1522,7 @@ def handle_month_to_selection(call):
     )
 
     # Показываем выбор пробега
-    mileage_markup = types.InlineKeyboardMarkup(row_width=4)
-    for value in range(0, 200001, 10000):
-        mileage_markup.add(
-            types.InlineKeyboardButton(
-                f"{value} км", callback_data=f"mileage_from_{value}"
-            )
-        )
+    mileage_markup = mileage_keyboard("mileage_from_", ENCAR_MILEAGE_STEPS, row_width=4)
 
     # Отображаем полный выбранный диапазон дат
     date_range_text = (
@@ -1392,7 +1540,7 @@ def handle_month_to_selection(call):
     )
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("mileage_from_"))
+@callback_router.prefix("mileage_from_")
 def handle_mileage_from(call):
     mileage_from = int(call.data.split("_")[2])
 
@@ -1411,13 +1559,9 @@ def handle_mileage_from(call):
         )
     )
 
-    mileage_markup = types.InlineKeyboardMarkup(row_width=4)
-    for value in range(mileage_from + 10000, 200001, 10000):
-        mileage_markup.add(
-            types.InlineKeyboardButton(
-                f"{value} км", callback_data=f"mileage_to_{mileage_from}_{value}"
-            )
-        )
+    mileage_markup = mileage_keyboard(
+        f"mileage_to_{mileage_from}_", ENCAR_MILEAGE_STEPS, mileage_from, row_width=4
+    )
 
     bot.send_message(
         call.message.chat.id,
@@ -1426,7 +1570,7 @@ def handle_mileage_from(call):
     )
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("mileage_to_"))
+@callback_router.prefix("mileage_to_")
 def handle_mileage_to(call):
     mileage_from = int(call.data.split("_")[2])
     mileage_to = int(call.data.split("_")[3])
@@ -1446,22 +1590,14 @@ def handle_mileage_to(call):
         )
     )
 
-    markup = types.InlineKeyboardMarkup(row_width=2)
-    # Добавляем кнопку "Любой цвет"
-    markup.add(types.InlineKeyboardButton("Любой", callback_data="color_all"))
-
-    # Добавляем остальные цвета
-    for kr, ru in COLOR_TRANSLATIONS.items():
-        markup.add(types.InlineKeyboardButton(ru, callback_data=f"color_{kr}"))
-
     bot.send_message(
         call.message.chat.id,
         f"Пробег: от {mileage_from} км до {mileage_to} км\nТеперь выберите цвет автомобиля:",
-        reply_markup=markup,
+        reply_markup=ENCAR_COLOR_KEYBOARD,
     )
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("color_"))
+@callback_router.prefix("color_")
 def handle_color_selection(call):
     selected_color_kr = call.data.split("_", 1)[1]
     message_text = call.message.text
@@ -1551,27 +1687,8 @@ def handle_color_selection(call):
     print(f"mileage_from: {mileage_from}")
     print(f"mileage_to: {mileage_to}")
 
-    # Показываем выбор минимальной цены
-    markup = types.InlineKeyboardMarkup(row_width=3)
-
-    # Добавляем кнопку "Любая" для минимальной цены
-    markup.add(types.InlineKeyboardButton("Любая", callback_data="price_from_any"))
-
-    # Добавляем кнопки с диапазоном цен от 1 до 100 млн вон
-    price_ranges = [1, 5, 10, 15, 20, 25, 30, 35, 40, 45, 50, 60, 70, 80, 90, 100]
-    buttons = []
-    for price in price_ranges:
-        price_param = price * 100  # Конвертация в параметр API (1 млн = 100)
-        buttons.append(
-            types.InlineKeyboardButton(
-                f"{price} млн", callback_data=f"price_from_{price_param}"
-            )
-        )
-
-    # Добавляем кнопки группами по 3
-    for i in range(0, len(buttons), 3):
-        row = buttons[i : i + 3]
-        markup.row(*row)
+    # Показываем выбор минимальной цены: «Любая» и цены от 1 до 100 млн вон
+    markup = price_keyboard("price_from_")
 
     bot.edit_message_text(
         f"Марка: {manufacturer} ({model_group})\n"
@@ -1734,14 +1851,14 @@ def build_encar_url(
     # Формируем окончательный URL
     url = (
         f"https://encar-proxy.habsida.net/api/catalog?count=true&q={query}"
-        f"&sr=%7CModifiedDate%7C0%7C1"
+        f"&sr=%7CModifiedDate%7C0%7C{SNAPSHOT_PAGE_SIZE}"
     )
 
     print(f"📡 Сформирован URL: {url}")
     return url
 
 
-def check_for_new_cars(
+async def check_for_new_cars(
     user_id,  # Переименовываем параметр в user_id
     chat_id,  # Добавляем отдельный параметр chat_id для отправки сообщений
     manufacturer,
@@ -1755,6 +1872,7 @@ def check_for_new_cars(
     color,
     price_from=None,
     price_to=None,
+    subscription_id=None,
 ):
     url = build_encar_url(
         manufacturer,
@@ -1771,93 +1889,724 @@ def check_for_new_cars(
         price_to=price_to,
     )
 
-    while True:
-        try:
-            response = requests.get(url, headers={"User-Agent": "Mozilla/5.0"})
+    # Снимок результатов предыдущего опроса (None до первого опроса)
+    previous_snapshot = None
+
+    # Id, которые были в снимках этой подписки и пропали из них, с ценой
+    # на момент пропажи: только такие объявления могут «вернуться в продажу»
+    # для этого чата
+    dropped_ids = BoundedDict(LISTING_MEMORY_SIZE)
+
+    # Новые объявления, ожидающие отправки дайджестом, и время первого из них
+    digest_buffer = []
+    digest_started_at = None
+
+    while True:
+        try:
+            # Подписку удалили — поллер больше не нужен
+            subscription = get_subscription(user_id, subscription_id)
+            if subscription_id is not None and subscription is None:
+                print(f"🛑 Подписка {subscription_id} удалена, опрос остановлен")
+                return
+
+            try:
+                response, cars = await encar.search_async(async_upstream, url)
+            except ValueError as json_err:
+                print(f"❌ Ошибка парсинга JSON: {json_err}")
+                await asyncio.sleep(POLL_INTERVAL)
+                continue
+
+            if response.status_code != 200:
+                print(f"❌ API вернул статус {response.status_code}: {response.text}")
+                await asyncio.sleep(POLL_INTERVAL)
+                continue
+
+            snapshot = build_result_snapshot(cars)
+
+            # Результаты не изменились — сравнивать нечего
+            if previous_snapshot and snapshot["hash"] == previous_snapshot["hash"]:
+                if digest_buffer and time.time() - digest_started_at >= DIGEST_WINDOW:
+                    await poll_scheduler.run_blocking(
+                        send_digest_notification, chat_id, digest_buffer
+                    )
+                    digest_buffer = []
+                await asyncio.sleep(POLL_INTERVAL)
+                continue
+
+            digest_enabled = bool(subscription and subscription.get("digest"))
+
+            added, removed, changed = diff_result_snapshots(previous_snapshot, snapshot)
+            cars_by_id = {car.id: car for car in cars}
+
+            to_notify, relisted, price_drops = [], [], []
+            for car_id in added:
+                car = cars_by_id[car_id]
+                # Проверка и отметка Id должны быть атомарными, иначе две
+                # подписки с одним автомобилем отправят его дважды
+                with listing_locks(car_id):
+                    is_new = car_id not in checked_ids
+                    checked_ids.add(car_id)
+                    old_price = car_prices.get(car_id)
+                    car_prices[car_id] = car.price
+                    # «Снова в продаже» — только если объявление раньше было
+                    # в этой подписке и карточка подтвердила продажу
+                    entry = listing_history.get(car_id)
+                    dropped_price = dropped_ids.pop(car_id, None)
+                    is_relisted = (
+                        dropped_price is not None
+                        and entry is not None
+                        and entry["status"] in ("sold", "relisted")
+                    )
+                    if is_relisted:
+                        entry["status"] = "relisted"
+
+                if is_new:
+                    # При первом опросе отправляем только самое свежее объявление,
+                    # остальные просто запоминаем
+                    if previous_snapshot is not None or car is cars[0]:
+                        if digest_enabled:
+                            if not digest_buffer:
+                                digest_started_at = time.time()
+                            digest_buffer.append(car)
+                        else:
+                            to_notify.append(car)
+                elif is_relisted:
+                    relisted.append((car, old_price))
+                elif previous_snapshot is not None:
+                    # Уже известное объявление вернулось в окно снимка — обычно
+                    # из-за снижения цены, которое обновляет ModifiedDate.
+                    # Сравниваем с ценой, которую видела эта подписка, а если
+                    # она его не видела — с последней известной ценой
+                    reference = (
+                        dropped_price if dropped_price is not None else old_price
+                    )
+                    if reference is not None and car.price < reference:
+                        price_drops.append((car, reference))
+
+            # Карточки новых объявлений запрашиваем параллельно
+            details = await fetch_encar_details([car.id for car in to_notify])
+            for car in to_notify:
+                await poll_scheduler.run_blocking(
+                    send_new_car_notification, chat_id, car, details.get(car.id)
+                )
+
+            for car, old_price in relisted:
+                await poll_scheduler.run_blocking(
+                    functools.partial(
+                        send_price_change_notification,
+                        chat_id,
+                        car,
+                        old_price,
+                        relisted=True,
+                    )
+                )
+
+            for car, old_price in price_drops:
+                await poll_scheduler.run_blocking(
+                    send_price_change_notification, chat_id, car, old_price
+                )
+
+            for car_id, old_price, new_price in changed:
+                with listing_locks(car_id):
+                    car_prices[car_id] = new_price
+                if new_price < old_price:
+                    await poll_scheduler.run_blocking(
+                        send_price_change_notification,
+                        chat_id,
+                        cars_by_id[car_id],
+                        old_price,
+                    )
+
+            previous_prices = (
+                dict(zip(previous_snapshot["ids"], previous_snapshot["prices"]))
+                if removed
+                else {}
+            )
+            for car_id in removed:
+                # Запоминаем цену, по которой подписка видела объявление последний раз
+                dropped_ids[car_id] = previous_prices[car_id]
+                await poll_scheduler.run_blocking(check_removed_listing, car_id)
+
+            # Отправляем накопленное, когда окно истекло или дайджест выключили
+            if digest_buffer and (
+                not digest_enabled or time.time() - digest_started_at >= DIGEST_WINDOW
+            ):
+                await poll_scheduler.run_blocking(
+                    send_digest_notification, chat_id, digest_buffer
+                )
+                digest_buffer = []
+
+            previous_snapshot = snapshot
+            await asyncio.sleep(POLL_INTERVAL)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"🔧 Общая ошибка при проверке новых авто: {e}")
+            await asyncio.sleep(POLL_INTERVAL)
+
+
+async def fetch_encar_details(car_ids):
+    """
+    Карточки объявлений Encar, запрошенные одновременно.
+
+    Returns:
+        Словарь Id -> данные карточки; недоступные карточки в него не попадают
+    """
+
+    async def fetch(car_id):
+        try:
+            return car_id, await encar.detail_async(async_upstream, car_id)
+        except Exception as e:
+            print(f"⚠️ Не удалось получить карточку {car_id}: {e}")
+        return car_id, None
+
+    results = await asyncio.gather(*(fetch(car_id) for car_id in car_ids))
+    return {car_id: data for car_id, data in results if data is not None}
+
+
+def build_result_snapshot(cars):
+    """
+    Компактный снимок результатов подписки: отсортированные Id, цены и хэш.
+
+    Args:
+        cars: Список Listing из ответа каталога
+
+    Returns:
+        Словарь с ключами ids, prices и hash
+    """
+    pairs = sorted((car.id, car.price) for car in cars)
+    ids = tuple(car_id for car_id, _ in pairs)
+    prices = tuple(price for _, price in pairs)
+    return {"ids": ids, "prices": prices, "hash": hash((ids, prices))}
+
+
+def diff_result_snapshots(old, new):
+    """
+    Сравнение двух снимков за линейное время (слияние отсортированных Id).
+
+    Returns:
+        Кортеж (added, removed, changed), где changed — список
+        (Id, старая цена, новая цена)
+    """
+    if old is None:
+        return list(new["ids"]), [], []
+
+    added, removed, changed = [], [], []
+    old_ids, old_prices = old["ids"], old["prices"]
+    new_ids, new_prices = new["ids"], new["prices"]
+    i = j = 0
+
+    while i < len(old_ids) and j < len(new_ids):
+        if old_ids[i] == new_ids[j]:
+            if old_prices[i] != new_prices[j]:
+                changed.append((new_ids[j], old_prices[i], new_prices[j]))
+            i += 1
+            j += 1
+        elif old_ids[i] < new_ids[j]:
+            removed.append(old_ids[i])
+            i += 1
+        else:
+            added.append(new_ids[j])
+            j += 1
+
+    removed.extend(old_ids[i:])
+    added.extend(new_ids[j:])
+    return added, removed, changed
+
+
+def record_listing_delivery(car_id, chat_id, price):
+    """Запоминаем в истории, какому чату было отправлено объявление"""
+    with listing_locks(car_id):
+        entry = listing_history.setdefault(
+            car_id,
+            {"status": "active", "price": price, "chats": set(), "sold_at": None},
+        )
+        entry["price"] = price
+        entry["chats"].add(chat_id)
+
+
+def check_removed_listing(car_id):
+    """
+    Объявление пропало из результатов подписки. Оно могло быть продано,
+    а могло просто выйти за пределы снимка или фильтров — уточняем по
+    карточке автомобиля и только тогда отмечаем продажу в истории.
+    """
+    entry = listing_history.get(car_id)
+    if entry and entry["status"] == "sold":
+        return
+
+    try:
+        response = encar.detail_response(car_id)
+        if response.status_code == 200:
+            status = response.json().get("advertisement", {}).get("status", "")
+            if status == "ADVERTISE":
+                # Объявление просто вышло за пределы снимка; повторное
+                # появление в результатах уже не будет «возвращением в продажу»
+                with listing_locks(car_id):
+                    if entry and entry["status"] == "relisted":
+                        entry["status"] = "active"
+                return
+        elif response.status_code != 404:
+            return
+    except Exception as e:
+        print(f"⚠️ Не удалось проверить статус объявления {car_id}: {e}")
+        return
+
+    with listing_locks(car_id):
+        entry = listing_history.setdefault(
+            car_id,
+            {"status": "active", "price": None, "chats": set(), "sold_at": None},
+        )
+        # Другая подписка могла уже отметить продажу, пока мы ждали ответа
+        if entry["status"] == "sold":
+            return
+        entry["status"] = "sold"
+        entry["sold_at"] = datetime.now().isoformat()
+        chats = list(entry["chats"])
+    print(f"🏁 Объявление {car_id} продано или снято с продажи")
+
+    if NOTIFY_SOLD:
+        for chat_id in chats:
+            bot.send_message(
+                chat_id,
+                f"🏁 Автомобиль продан или снят с продажи.\n\n"
+                f"👉 <a href='https://fem.encar.com/cars/detail/{car_id}'>Ссылка на автомобиль</a>",
+                parse_mode="HTML",
+            )
+
+
+def format_number(n):
+    return f"{int(n):,}".replace(",", " ")
+
+
+def get_notification_markup(car_id=None):
+    markup = types.InlineKeyboardMarkup()
+    if car_id is not None:
+        markup.add(
+            types.InlineKeyboardButton(
+                "👁 Следить за этим автомобилем",
+                callback_data=f"watch_{car_id}",
+            )
+        )
+    markup.add(
+        types.InlineKeyboardButton(
+            "➕ Добавить новый автомобиль в поиск",
+            callback_data="search_car",
+        )
+    )
+    markup.add(
+        types.InlineKeyboardButton(
+            "🏠 Вернуться в главное меню",
+            callback_data="start",
+        )
+    )
+    return markup
+
+
+def send_new_car_notification(chat_id, car, details_data=None):
+    """
+    Отправка уведомления о новом автомобиле с подробностями из Encar.
+    Если карточка уже получена (details_data), повторно её не запрашиваем.
+    """
+    if details_data is None:
+        details_data = encar.detail(car.id)
+
+    if details_data is not None:
+        specs = details_data.get("spec", {})
+        displacement = specs.get("displacement", "Не указано")
+
+        # Получаем и переводим дополнительные данные
+        fuel_type = translate_smartly(specs.get("fuelType", ""))
+        transmission = translate_smartly(specs.get("transmission", ""))
+        options = specs.get("options", [])
+        translated_options = (
+            [translate_smartly(opt) for opt in options[:5]] if options else []
+        )
+
+        options_text = ", ".join(translated_options)
+        options_display = f"\n🔧 Опции: {options_text}" if options_text else ""
+
+        extra_text = f"\n🏎️ Объём двигателя: {displacement}cc{options_display}\n\n👉 <a href='https://fem.encar.com/cars/detail/{car.id}'>Ссылка на автомобиль</a>"
+    else:
+        extra_text = "\nℹ️ Не удалось получить подробности о машине."
+
+    # Переводим название автомобиля
+    translated_name = translate_smartly(car.name)
+    price = car.price
+    mileage = car.mileage
+    year = car.year or ""
+
+    formatted_mileage = format_number(mileage)
+    formatted_price = format_number(price * 10000)
+
+    text = (
+        f"✅ Новое поступление по вашему запросу!\n\n<b>{translated_name}</b> {year} г.\nПробег: {formatted_mileage} км\nЦена: ₩{formatted_price}"
+        + extra_text
+    )
+    send_encar_album(chat_id, car.photos)
+    bot.send_message(
+        chat_id,
+        text,
+        parse_mode="HTML",
+        reply_markup=get_notification_markup(car.id),
+    )
+    record_listing_delivery(car.id, chat_id, price)
+
+
+def load_photo_cache():
+    global photo_file_ids
+    if os.path.exists(PHOTO_CACHE_FILE):
+        try:
+            with open(PHOTO_CACHE_FILE, "r", encoding="utf-8") as f:
+                photo_file_ids = OrderedDict(json.load(f))
+        except Exception as e:
+            print(f"⚠️ Не удалось загрузить {PHOTO_CACHE_FILE}: {e}")
+            photo_file_ids = OrderedDict()
+
+
+def save_photo_cache():
+    """Записывает кэш file_id на диск (через временный файл)"""
+    global _photo_cache_save_timer
+    with photo_cache_lock:
+        _photo_cache_save_timer = None
+        data = list(photo_file_ids.items())
+    tmp_path = f"{PHOTO_CACHE_FILE}.tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(tmp_path, PHOTO_CACHE_FILE)
+    except Exception as e:
+        print(f"⚠️ Ошибка при сохранении {PHOTO_CACHE_FILE}: {e}")
+
+
+def remember_photo_file_id(key, file_id):
+    global _photo_cache_save_timer
+    with photo_cache_lock:
+        photo_file_ids[key] = file_id
+        photo_file_ids.move_to_end(key)
+        while len(photo_file_ids) > PHOTO_CACHE_SIZE:
+            photo_file_ids.popitem(last=False)
+        # Новые file_id копятся и записываются одним файлом по таймеру
+        if _photo_cache_save_timer is None:
+            _photo_cache_save_timer = threading.Timer(
+                PHOTO_CACHE_SAVE_INTERVAL, save_photo_cache
+            )
+            _photo_cache_save_timer.daemon = True
+            _photo_cache_save_timer.start()
+
+
+def get_photo_file_id(key):
+    with photo_cache_lock:
+        return photo_file_ids.get(key)
+
+
+def send_cached_photo(chat_id, photo_url, **kwargs):
+    """
+    send_photo по ссылке, но с повторным использованием file_id: Telegram
+    скачивает фотографию только при первой отправке
+    """
+    file_id = get_photo_file_id(photo_url)
+    if file_id:
+        try:
+            return bot.send_photo(chat_id, file_id, **kwargs)
+        except Exception as e:
+            print(f"⚠️ Сохранённый file_id не подошёл, отправляем по ссылке: {e}")
+
+    message = bot.send_photo(chat_id, photo_url, **kwargs)
+    if message and message.photo:
+        remember_photo_file_id(photo_url, message.photo[-1].file_id)
+    return message
+
+
+def send_encar_album(chat_id, photos):
+    """
+    Отправка первых фотографий объявления Encar альбомом (media group).
+    Для уже загруженных фотографий используем сохранённые file_id.
+
+    Args:
+        photos: Пары (location, updatedDate) из Listing.photos
+    """
+    photos = photos[:ENCAR_ALBUM_SIZE]
+    if not photos:
+        return
+
+    keys = [f"{location}@{updated}" for location, updated in photos]
+    media = []
+    for (location, _), key in zip(photos, keys):
+        source = get_photo_file_id(key) or f"{ENCAR_PHOTO_BASE}{location}"
+        media.append(types.InputMediaPhoto(source))
+
+    try:
+        if len(media) == 1:
+            messages = [bot.send_photo(chat_id, media[0].media)]
+        else:
+            messages = bot.send_media_group(chat_id, media)
+    except Exception as e:
+        print(f"⚠️ Не удалось отправить фотографии объявления: {e}")
+        return
+
+    for key, message in zip(keys, messages):
+        if message and message.photo and get_photo_file_id(key) is None:
+            remember_photo_file_id(key, message.photo[-1].file_id)
+
+
+def send_digest_notification(chat_id, cars):
+    """
+    Одно сообщение со всеми накопленными объявлениями вместо отдельного
+    сообщения (и запроса карточки) на каждый автомобиль
+    """
+    lines = []
+    for idx, car in enumerate(cars, 1):
+        name = translate_smartly(car.name)
+        lines.append(
+            f"{idx}. <b>{name}</b> {car.year or ''} г., "
+            f"{format_number(car.mileage)} км, "
+            f"₩{format_number(car.price * 10000)} — "
+            f"<a href='https://fem.encar.com/cars/detail/{car.id}'>ссылка</a>"
+        )
+
+    header = f"📰 Новые поступления по вашему запросу: {len(cars)}\n\n"
+    # Длинный дайджест делим на части, чтобы уложиться в лимит Telegram
+    chunks, current = [], header
+    for line in lines:
+        if len(current) + len(line) + 1 > 4000:
+            chunks.append(current)
+            current = ""
+        current += line + "\n"
+    chunks.append(current)
+
+    for idx, chunk in enumerate(chunks):
+        is_last = idx == len(chunks) - 1
+        bot.send_message(
+            chat_id,
+            chunk,
+            parse_mode="HTML",
+            disable_web_page_preview=True,
+            reply_markup=get_notification_markup() if is_last else None,
+        )
+
+    for car in cars:
+        record_listing_delivery(car.id, chat_id, car.price)
+
+
+def send_price_change_notification(chat_id, car, old_price, relisted=False):
+    """Уведомление о снижении цены или повторном размещении уже виденного авто"""
+    translated_name = translate_smartly(car.name)
+    price = car.price
+    mileage = car.mileage
+    year = car.year or ""
+
+    if relisted:
+        header = "🔁 Автомобиль снова в продаже!"
+    else:
+        header = "📉 Цена снижена!"
+
+    price_text = f"Цена: ₩{format_number(price * 10000)}"
+    if old_price and price < old_price:
+        diff_percent = (old_price - price) * 100 / old_price
+        price_text = (
+            f"Было: ₩{format_number(old_price * 10000)}\n"
+            f"Стало: ₩{format_number(price * 10000)} (−{diff_percent:.1f}%)"
+        )
+
+    text = (
+        f"{header}\n\n<b>{translated_name}</b> {year} г.\n"
+        f"Пробег: {format_number(mileage)} км\n"
+        f"{price_text}\n\n"
+        f"👉 <a href='https://fem.encar.com/cars/detail/{car.id}'>Ссылка на автомобиль</a>"
+    )
+    bot.send_message(
+        chat_id,
+        text,
+        parse_mode="HTML",
+        reply_markup=get_notification_markup(car.id),
+    )
+    record_listing_delivery(car.id, chat_id, price)
+
+
+def load_watches():
+    global car_watches
+    if os.path.exists(WATCHES_FILE):
+        try:
+            with open(WATCHES_FILE, "r", encoding="utf-8") as f:
+                car_watches = json.load(f)
+        except Exception as e:
+            print(f"⚠️ Не удалось загрузить {WATCHES_FILE}: {e}")
+            car_watches = {}
+    else:
+        car_watches = {}
+
+
+def save_watches():
+    try:
+        with watches_file_lock, open(WATCHES_FILE, "w", encoding="utf-8") as f:
+            json.dump(snapshot_dict(car_watches), f, ensure_ascii=False, indent=2)
+    except Exception as e:
+        print(f"⚠️ Ошибка при сохранении {WATCHES_FILE}: {e}")
+
+
+def get_watch_fingerprint(details_data):
+    """Значимые для пользователя поля карточки: цена, статус и фотографии"""
+    advertisement = details_data.get("advertisement", {})
+    photos = details_data.get("photos", []) or []
+    photos_key = "|".join(
+        f"{photo.get('path', '')}@{photo.get('updateDateTime', '')}" for photo in photos
+    )
+    return {
+        "price": advertisement.get("price"),
+        "status": advertisement.get("status"),
+        "photos": hashlib.sha1(photos_key.encode("utf-8")).hexdigest(),
+        "photos_count": len(photos),
+    }
+
 
-            if response.status_code != 200:
-                print(f"❌ API вернул статус {response.status_code}: {response.text}")
-                time.sleep(300)
-                continue
+@callback_router.prefix("watch_")
+def handle_watch_car(call):
+    if not is_authorized(call.from_user.id):
+        bot.answer_callback_query(call.id, "❌ У вас нет доступа к боту.")
+        return
 
-            try:
-                data = response.json()
-            except Exception as json_err:
-                print(f"❌ Ошибка парсинга JSON: {json_err}")
-                print(f"Ответ: {response.text}")
-                time.sleep(300)
-                continue
+    car_id = call.data.split("_", 1)[1]
+    chat_id = call.message.chat.id
 
-            cars = data.get("SearchResults", [])
-            new_cars = [car for car in cars if car["Id"] not in checked_ids]
+    with listing_locks(car_id):
+        watch = car_watches.setdefault(
+            car_id,
+            {"chats": [], "fingerprint": None, "etag": None, "last_modified": None},
+        )
+        already_watching = chat_id in watch["chats"]
+        if not already_watching:
+            watch["chats"].append(chat_id)
 
-            for car in new_cars:
-                checked_ids.add(car["Id"])
-                details_url = f"https://api.encar.com/v1/readside/vehicle/{car['Id']}"
-                details_response = requests.get(
-                    details_url, headers={"User-Agent": "Mozilla/5.0"}
-                )
+    if already_watching:
+        bot.answer_callback_query(call.id, "Вы уже следите за этим автомобилем.")
+        return
 
-                if details_response.status_code == 200:
-                    details_data = details_response.json()
-                    specs = details_data.get("spec", {})
-                    displacement = specs.get("displacement", "Не указано")
-
-                    # Получаем и переводим дополнительные данные
-                    fuel_type = translate_smartly(specs.get("fuelType", ""))
-                    transmission = translate_smartly(specs.get("transmission", ""))
-                    options = specs.get("options", [])
-                    translated_options = (
-                        [translate_smartly(opt) for opt in options[:5]]
-                        if options
-                        else []
-                    )
+    save_watches()
+    bot.answer_callback_query(
+        call.id,
+        "👁 Будем сообщать об изменении цены, статуса и фотографий.",
+    )
 
-                    options_text = ", ".join(translated_options)
-                    options_display = (
-                        f"\n🔧 Опции: {options_text}" if options_text else ""
-                    )
 
-                    extra_text = f"\n🏎️ Объём двигателя: {displacement}cc{options_display}\n\n👉 <a href='https://fem.encar.com/cars/detail/{car['Id']}'>Ссылка на автомобиль</a>"
-                else:
-                    extra_text = "\nℹ️ Не удалось получить подробности о машине."
+@callback_router.prefix("unwatch_")
+def handle_unwatch_car(call):
+    car_id = call.data.split("_", 1)[1]
+    chat_id = call.message.chat.id
 
-                name = f'{car.get("Manufacturer", "")} {car.get("Model", "")} {car.get("Badge", "")}'
-                # Переводим название автомобиля
-                translated_name = translate_smartly(name)
-                price = car.get("Price", 0)
-                mileage = car.get("Mileage", 0)
-                year = car.get("FormYear", "")
+    with listing_locks(car_id):
+        watch = car_watches.get(car_id)
+        is_watching = bool(watch) and chat_id in watch["chats"]
+        if is_watching:
+            watch["chats"].remove(chat_id)
+            if not watch["chats"]:
+                del car_watches[car_id]
 
-                def format_number(n):
-                    return f"{int(n):,}".replace(",", " ")
+    if not is_watching:
+        bot.answer_callback_query(call.id, "Вы не следите за этим автомобилем.")
+        return
 
-                formatted_mileage = format_number(mileage)
-                formatted_price = format_number(price * 10000)
+    save_watches()
+    bot.answer_callback_query(call.id, "Отслеживание автомобиля остановлено.")
+
+
+def poll_watched_car(car_id, watch):
+    """
+    Проверка одного отслеживаемого автомобиля. Используем условные запросы
+    (ETag / Last-Modified), а если сервер их не поддерживает — сравниваем
+    отпечаток значимых полей карточки.
+
+    Returns:
+        True, если состояние отслеживания изменилось и его нужно сохранить
+    """
+    headers = {}
+    if watch.get("etag"):
+        headers["If-None-Match"] = watch["etag"]
+    if watch.get("last_modified"):
+        headers["If-Modified-Since"] = watch["last_modified"]
+
+    response = encar.detail_response(car_id, headers=headers)
+
+    if response.status_code == 304:
+        return False
+    if response.status_code == 404:
+        notify_watchers(car_id, watch, ["🏁 Объявление снято с продажи."])
+        with listing_locks(car_id):
+            car_watches.pop(car_id, None)
+        return True
+    if response.status_code != 200:
+        print(f"⚠️ Карточка {car_id} вернула статус {response.status_code}")
+        return False
+
+    validators = (response.headers.get("ETag"), response.headers.get("Last-Modified"))
+    changed = validators != (watch.get("etag"), watch.get("last_modified"))
+    watch["etag"], watch["last_modified"] = validators
+
+    fingerprint = get_watch_fingerprint(response.json())
+    previous = watch.get("fingerprint")
+    watch["fingerprint"] = fingerprint
+
+    if previous is None or previous == fingerprint:
+        return changed or previous is None
+
+    changes = []
+    if previous["price"] != fingerprint["price"]:
+        old_price = previous["price"] or 0
+        new_price = fingerprint["price"] or 0
+        arrow = "📉" if new_price < old_price else "📈"
+        changes.append(
+            f"{arrow} Цена: ₩{format_number(old_price * 10000)} → ₩{format_number(new_price * 10000)}"
+        )
+    if previous["status"] != fingerprint["status"]:
+        changes.append(
+            f"📌 Статус: {previous['status'] or '—'} → {fingerprint['status'] or '—'}"
+        )
+    if previous["photos"] != fingerprint["photos"]:
+        changes.append(f"📷 Фотографии обновлены ({fingerprint['photos_count']} шт.)")
+
+    notify_watchers(car_id, watch, changes)
+    return True
 
-                text = (
-                    f"✅ Новое поступление по вашему запросу!\n\n<b>{translated_name}</b> {year} г.\nПробег: {formatted_mileage} км\nЦена: ₩{formatted_price}"
-                    + extra_text
-                )
-                markup = types.InlineKeyboardMarkup()
-                markup.add(
-                    types.InlineKeyboardButton(
-                        "➕ Добавить новый автомобиль в поиск",
-                        callback_data="search_car",
-                    )
-                )
-                markup.add(
-                    types.InlineKeyboardButton(
-                        "🏠 Вернуться в главное меню",
-                        callback_data="start",
-                    )
-                )
-                bot.send_message(chat_id, text, parse_mode="HTML", reply_markup=markup)
 
-            time.sleep(300)
+def notify_watchers(car_id, watch, changes):
+    text = (
+        "👁 Изменения по отслеживаемому автомобилю:\n\n"
+        + "\n".join(changes)
+        + f"\n\n👉 <a href='https://fem.encar.com/cars/detail/{car_id}'>Ссылка на автомобиль</a>"
+    )
+    markup = types.InlineKeyboardMarkup()
+    markup.add(
+        types.InlineKeyboardButton(
+            "🚫 Перестать следить", callback_data=f"unwatch_{car_id}"
+        )
+    )
+    for chat_id in list(watch["chats"]):
+        try:
+            bot.send_message(chat_id, text, parse_mode="HTML", reply_markup=markup)
         except Exception as e:
-            print(f"🔧 Общая ошибка при проверке новых авто: {e}")
-            time.sleep(300)
+            print(f"⚠️ Не удалось отправить изменения по {car_id} в {chat_id}: {e}")
+
+
+def watch_poller():
+    """
+    Фоновый опрос отслеживаемых автомобилей по собственному расписанию.
+    Каждый Id запрашивается один раз за цикл, сколько бы чатов за ним ни
+    следило, а все запросы идут через общую сессию с ограничением частоты.
+    Файл отслеживания перезаписывается один раз за цикл и только если
+    что-то изменилось.
+    """
+    set_thread_priority(PRIORITY_ALERT)
+
+    while True:
+        dirty = False
+        for car_id, watch in list(car_watches.items()):
+            try:
+                dirty = poll_watched_car(car_id, watch) or dirty
+            except Exception as e:
+                print(f"⚠️ Ошибка при проверке отслеживаемого авто {car_id}: {e}")
+        if dirty:
+            save_watches()
+        time.sleep(WATCH_POLL_INTERVAL)
 
 
 # Добавленный код для команд userlist и remove_user
@@ -1894,9 +2643,12 @@ def handle_remove_user(message):
             return
 
         user_id_to_remove = int(parts[1])
-        if user_id_to_remove in ACCESS:
-            ACCESS.remove(user_id_to_remove)
-            save_access()
+        with access_lock:
+            removed = user_id_to_remove in ACCESS
+            if removed:
+                ACCESS.remove(user_id_to_remove)
+                save_access()
+        if removed:
             bot.reply_to(
                 message, f"✅ Пользователь {user_id_to_remove} удалён из доступа."
             )
@@ -1909,85 +2661,22 @@ def handle_remove_user(message):
 # Функции для работы с KbChaChaCha
 def get_kbchachacha_manufacturers():
     """Получение списка производителей с KbChaChaCha"""
-    url = (
-        "https://www.kbchachacha.com/public/search/carMaker.json?page=1&sort=-orderDate"
-    )
-    headers = {"User-Agent": "Mozilla/5.0"}
-    try:
-        response = requests.get(url, headers=headers)
-        data = response.json()
-        # Получаем список как импортных, так и корейских производителей
-        import_manufacturers = data.get("result", {}).get(
-            "수입", []
-        )  # 수입 = импортные
-        korean_manufacturers = data.get("result", {}).get(
-            "국산", []
-        )  # 국산 = корейские
-
-        # Объединяем списки
-        all_manufacturers = korean_manufacturers + import_manufacturers
-
-        # Сортируем по имени производителя
-        all_manufacturers.sort(key=lambda x: x.get("makerName", ""))
-
-        return all_manufacturers
-    except Exception as e:
-        print("Ошибка при получении марок из KbChaChaCha:", e)
-        return []
+    return kbchachacha.taxonomy()
 
 
 def get_kbchachacha_models(maker_code):
     """Получение списка моделей по ID производителя с KbChaChaCha"""
-    url = f"https://www.kbchachacha.com/public/search/carClass.json?makerCode={maker_code}&page=1&sort=-orderDate"
-    headers = {"User-Agent": "Mozilla/5.0"}
-    try:
-        response = requests.get(url, headers=headers)
-        data = response.json()
-        models = data.get("result", {}).get("code", [])
-        # Сортируем по имени модели
-        models.sort(key=lambda x: x.get("className", ""))
-        return models
-    except Exception as e:
-        print(f"Ошибка при получении моделей с KbChaChaCha для {maker_code}:", e)
-        return []
+    return kbchachacha.taxonomy(maker_code)
 
 
 def get_kbchachacha_generations(maker_code, class_code):
     """Получение списка поколений по коду марки и модели с KbChaChaCha"""
-    url = f"https://www.kbchachacha.com/public/search/carName.json?makerCode={maker_code}&page=1&sort=-orderDate&classCode={class_code}"
-    headers = {"User-Agent": "Mozilla/5.0"}
-    try:
-        response = requests.get(url, headers=headers)
-        data = response.json()
-        generations = data.get("result", {}).get("code", [])
-        # Сортируем по порядку поколений
-        generations.sort(key=lambda x: x.get("carOrder", 999))
-        return generations
-    except Exception as e:
-        print(
-            f"Ошибка при получении поколений с KbChaChaCha для {maker_code}/{class_code}:",
-            e,
-        )
-        return []
+    return kbchachacha.taxonomy(maker_code, class_code)
 
 
 def get_kbchachacha_trims(maker_code, class_code, car_code):
     """Получение списка конфигураций по коду марки, модели и поколения с KbChaChaCha"""
-    url = f"https://www.kbchachacha.com/public/search/carModel.json?makerCode={maker_code}&page=1&sort=-orderDate&classCode={class_code}&carCode={car_code}"
-    headers = {"User-Agent": "Mozilla/5.0"}
-    try:
-        response = requests.get(url, headers=headers)
-        data = response.json()
-        trims = data.get("result", {}).get("codeModel", [])
-        # Сортируем по порядку конфигураций
-        trims.sort(key=lambda x: x.get("modelOrder", 999))
-        return trims
-    except Exception as e:
-        print(
-            f"Ошибка при получении конфигураций с KbChaChaCha для {maker_code}/{class_code}/{car_code}:",
-            e,
-        )
-        return []
+    return kbchachacha.taxonomy(maker_code, class_code, car_code)
 
 
 def handle_kbchachacha_search(call):
@@ -1998,24 +2687,27 @@ def handle_kbchachacha_search(call):
         return
 
     # Создаем клавиатуру с марками
-    markup = types.InlineKeyboardMarkup(row_width=2)
-    for item in manufacturers:
-        maker_name = item.get("makerName", "Без названия")
-        maker_code = item.get("makerCode", "")
-
-        # Добавляем перевод названия марки, если оно есть в словаре переводов
-        translated_name = translate_smartly(maker_name)
-
-        # Формируем текст для отображения
-        display_name = translated_name
-        if maker_name != translated_name and translated_name != maker_name:
-            display_name = f"{translated_name} ({maker_name})"
-
-        # Используем специальный префикс для отличия от других площадок
-        callback_data = f"kbcha_brand_{maker_code}_{maker_name}"
-        markup.add(
-            types.InlineKeyboardButton(display_name, callback_data=callback_data)
-        )
+    markup = taxonomy_keyboards.lookup("kbcha_brands", manufacturers)
+    if markup is None:
+        items = []
+        for item in manufacturers:
+            maker_name = item.get("makerName", "Без названия")
+            maker_code = item.get("makerCode", "")
+
+            # Добавляем перевод названия марки, если оно есть в словаре переводов
+            translated_name = translate_smartly(maker_name)
+
+            # Формируем текст для отображения
+            display_name = translated_name
+            if maker_name != translated_name and translated_name != maker_name:
+                display_name = f"{translated_name} ({maker_name})"
+
+            # Используем специальный префикс для отличия от других площадок
+            callback_data = pack_callback(
+                "kbcha_brand_", code=maker_code, name=maker_name
+            )
+            items.append(KeyboardItem(display_name, callback_data, 0))
+        markup = taxonomy_keyboards.store("kbcha_brands", manufacturers, items)
 
     bot.send_message(
         call.message.chat.id,
@@ -2024,12 +2716,14 @@ def handle_kbchachacha_search(call):
     )
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("kbcha_brand_"))
+@callback_router.prefix("kbcha_brand_")
 def handle_kbcha_brand_selection(call):
     # Парсим данные из callback_data
-    parts = call.data.split("_", 3)
-    maker_code = parts[2]
-    maker_name = parts[3] if len(parts) > 3 else "Неизвестно"
+    node = unpack_callback(call, "kbcha_brand_")
+    if node is None:
+        return
+    maker_code = node["code"]
+    maker_name = node["name"]
 
     # Сохраняем выбранную марку у пользователя для дальнейшего использования
     user_id = call.from_user.id
@@ -2052,23 +2746,26 @@ def handle_kbcha_brand_selection(call):
         return
 
     # Создаем клавиатуру с моделями
-    markup = types.InlineKeyboardMarkup(row_width=2)
-    for item in models:
-        class_name = item.get("className", "Без названия")
-        class_code = item.get("classCode", "")
-
-        # Добавляем перевод названия модели с использованием функции translate_smartly
-        translated_name = translate_smartly(class_name)
-
-        # Формируем текст для отображения
-        display_name = translated_name
-        if class_name != translated_name and translated_name != class_name:
-            display_name = f"{translated_name} ({class_name})"
-
-        callback_data = f"kbcha_model_{class_code}_{class_name}"
-        markup.add(
-            types.InlineKeyboardButton(display_name, callback_data=callback_data)
-        )
+    markup = taxonomy_keyboards.lookup(f"kbcha_models_{maker_code}", models)
+    if markup is None:
+        items = []
+        for item in models:
+            class_name = item.get("className", "Без названия")
+            class_code = item.get("classCode", "")
+
+            # Добавляем перевод названия модели с использованием функции translate_smartly
+            translated_name = translate_smartly(class_name)
+
+            # Формируем текст для отображения
+            display_name = translated_name
+            if class_name != translated_name and translated_name != class_name:
+                display_name = f"{translated_name} ({class_name})"
+
+            callback_data = pack_callback(
+                "kbcha_model_", code=class_code, name=class_name
+            )
+            items.append(KeyboardItem(display_name, callback_data, 0))
+        markup = taxonomy_keyboards.store(f"kbcha_models_{maker_code}", models, items)
 
     # Отображаем имя марки - либо переведенное, либо с переводом в скобках
     display_maker_name = translated_maker_name
@@ -2082,12 +2779,14 @@ def handle_kbcha_brand_selection(call):
     )
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("kbcha_model_"))
+@callback_router.prefix("kbcha_model_")
 def handle_kbcha_model_selection(call):
     # Парсим данные из callback_data
-    parts = call.data.split("_", 3)
-    class_code = parts[2]
-    class_name = parts[3] if len(parts) > 3 else "Неизвестно"
+    node = unpack_callback(call, "kbcha_model_")
+    if node is None:
+        return
+    class_code = node["code"]
+    class_name = node["name"]
 
     # Сохраняем выбранную модель у пользователя для дальнейшего использования
     user_id = call.from_user.id
@@ -2136,7 +2835,7 @@ def handle_kbcha_model_selection(call):
         else:
             display_text = f"{car_name} {year_period}"
 
-        callback_data = f"kbcha_gen_{car_code}_{car_name}"
+        callback_data = pack_callback("kbcha_gen_", code=car_code, name=car_name)
         markup.add(
             types.InlineKeyboardButton(display_text, callback_data=callback_data)
         )
@@ -2174,96 +2873,39 @@ def search_kbchachacha_cars(
     """
     Поиск автомобилей на KbChaChaCha
     """
-    # Базовый URL для поиска
-    url = f"https://www.kbchachacha.com/public/search/list.empty?makerCode={maker_code}&page=1&sort=-orderDate&classCode={class_code}&carCode={car_code}&modelCode={model_code}"
-
-    # Добавляем дополнительные параметры, если они указаны
-    if year_from and year_to:
-        url += f"&regiDay={year_from},{year_to}"
-
-    if mileage_from is not None and mileage_to is not None:
-        url += f"&km={mileage_from},{mileage_to}"
-
-    if color_code:
-        url += f"&color={color_code}"
-
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-    }
-
     try:
-        print(f"DEBUG: Отправка запроса на URL: {url}")
-        response = requests.get(url, headers=headers)
-        soup = BeautifulSoup(response.text, "html.parser")
-
-        # Ищем все блоки с автомобилями
-        car_areas = soup.select("div.list-in.type-wd-list div.area")
-
-        results = []
-        for area in car_areas[:5]:  # Ограничиваем до 5 результатов
-            try:
-                # Извлекаем данные об автомобиле
-                car_seq = area.get("data-car-seq", "")
-                car_link = f"https://www.kbchachacha.com/public/car/detail.kbc?carSeq={car_seq}"
-
-                # Извлекаем название автомобиля
-                car_title = area.select_one("div.con div.item strong.tit")
-                title = car_title.text.strip() if car_title else "Неизвестно"
-                # Переводим название автомобиля
-                translated_title = translate_smartly(title)
-
-                # Извлекаем данные о годе, пробеге и регионе
-                data_line = area.select_one("div.con div.item div.data-line")
-                details = (
-                    [span.text.strip() for span in data_line.select("span")]
-                    if data_line
-                    else []
-                )
-                year = details[0] if len(details) > 0 else "Неизвестно"
-                mileage = details[1] if len(details) > 1 else "Неизвестно"
-                region = details[2] if len(details) > 2 else "Неизвестно"
-                # Переводим регион
-                translated_region = translate_smartly(region)
-
-                # Извлекаем цену
-                price_elem = area.select_one(
-                    "div.con div.item div.sort-wrap strong.pay span.price"
-                )
-                price = price_elem.text.strip() if price_elem else "Неизвестно"
-
-                # Получаем ссылку на изображение
-                img_elem = area.select_one("div.thumnail a.item span.item__img img")
-                img_url = img_elem.get("src", "") if img_elem else ""
-
-                results.append(
-                    {
-                        "title": translated_title,
-                        "original_title": title,
-                        "year": year,
-                        "mileage": mileage,
-                        "region": translated_region,
-                        "original_region": region,
-                        "price": price,
-                        "link": car_link,
-                        "img_url": img_url,
-                    }
-                )
-            except Exception as e:
-                print(f"Ошибка при парсинге автомобиля: {e}")
-                continue
-
-        return results
+        cars = kbchachacha.search(
+            maker_code,
+            class_code,
+            car_code,
+            model_code,
+            year_from,
+            year_to,
+            mileage_from,
+            mileage_to,
+            color_code,
+        )
     except Exception as e:
         print(f"Ошибка при поиске автомобилей на KbChaChaCha: {e}")
         return []
 
+    # Переводим название и регион, оригиналы оставляем рядом
+    for car in cars:
+        car["original_title"] = car["title"]
+        car["title"] = translate_smartly(car["title"])
+        car["original_region"] = car["region"]
+        car["region"] = translate_smartly(car["region"])
+    return cars
+
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("kbcha_gen_"))
+@callback_router.prefix("kbcha_gen_")
 def handle_kbcha_generation_selection(call):
     # Парсим данные из callback_data
-    parts = call.data.split("_", 3)
-    car_code = parts[2]
-    car_name = parts[3] if len(parts) > 3 else "Неизвестно"
+    node = unpack_callback(call, "kbcha_gen_")
+    if node is None:
+        return
+    car_code = node["code"]
+    car_name = node["name"]
 
     # Сохраняем выбранное поколение у пользователя для дальнейшего использования
     user_id = call.from_user.id
@@ -2312,7 +2954,7 @@ def handle_kbcha_generation_selection(call):
             else model_name
         )
 
-        callback_data = f"kbcha_trim_{model_code}_{model_name}"
+        callback_data = pack_callback("kbcha_trim_", code=model_code, name=model_name)
         markup.add(
             types.InlineKeyboardButton(display_name, callback_data=callback_data)
         )
@@ -2341,12 +2983,14 @@ def handle_kbcha_generation_selection(call):
     )
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("kbcha_trim_"))
+@callback_router.prefix("kbcha_trim_")
 def handle_kbcha_trim_selection(call):
     # Парсим данные из callback_data
-    parts = call.data.split("_", 3)
-    model_code = parts[2]
-    model_name = parts[3] if len(parts) > 3 else "Неизвестно"
+    node = unpack_callback(call, "kbcha_trim_")
+    if node is None:
+        return
+    model_code = node["code"]
+    model_name = node["name"]
 
     print(f"✅ DEBUG kbcha_trim_selection - raw data:")
     print(f"model_code: {model_code}")
@@ -2445,16 +3089,8 @@ def handle_kbcha_trim_selection(call):
     user_search_data[user_id]["kbcha_generation_start_year"] = start_year
     user_search_data[user_id]["kbcha_generation_end_year"] = end_year
 
-    # Формируем список годов для выбора
-    markup = types.InlineKeyboardMarkup(row_width=3)
-
-    # Добавляем года от начала производства поколения до его конца или текущего года
-    for year in range(start_year, min(end_year, current_year) + 1):
-        markup.add(
-            types.InlineKeyboardButton(
-                f"{year}", callback_data=f"kbcha_year_from_{year}"
-            )
-        )
+    # Года от начала производства поколения до его конца или текущего года
+    markup = year_keyboard("kbcha_year_from_", start_year, min(end_year, current_year))
 
     # Форматируем отображаемые названия с переводами, если они доступны
     display_maker_name = (
@@ -2485,7 +3121,7 @@ def handle_kbcha_trim_selection(call):
     )
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("kbcha_year_from_"))
+@callback_router.prefix("kbcha_year_from_")
 def handle_kbcha_year_from_selection(call):
     # Парсим выбранный год
     year_from = call.data.split("_")[3]
@@ -2505,11 +3141,7 @@ def handle_kbcha_year_from_selection(call):
     year_from_int = int(year_from)
 
     # Формируем диапазон годов от выбранного года до конца производства поколения или текущего года
-    markup = types.InlineKeyboardMarkup(row_width=3)
-    for year in range(year_from_int, min(end_year, current_year) + 1):
-        markup.add(
-            types.InlineKeyboardButton(f"{year}", callback_data=f"kbcha_year_to_{year}")
-        )
+    markup = year_keyboard("kbcha_year_to_", year_from_int, min(end_year, current_year))
 
     bot.send_message(
         call.message.chat.id,
@@ -2518,7 +3150,7 @@ def handle_kbcha_year_from_selection(call):
     )
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("kbcha_year_to_"))
+@callback_router.prefix("kbcha_year_to_")
 def handle_kbcha_year_to_selection(call):
     # Парсим выбранный год
     year_to = call.data.split("_")[3]
@@ -2531,13 +3163,7 @@ def handle_kbcha_year_to_selection(call):
     user_search_data[user_id]["kbcha_year_to"] = year_to
 
     # Показываем выбор пробега от
-    markup = types.InlineKeyboardMarkup(row_width=3)
-    for mileage in [0, 10000, 20000, 30000, 50000, 70000, 100000]:
-        markup.add(
-            types.InlineKeyboardButton(
-                f"{mileage} км", callback_data=f"kbcha_mileage_from_{mileage}"
-            )
-        )
+    markup = mileage_keyboard("kbcha_mileage_from_", MILEAGE_FROM_STEPS)
 
     bot.send_message(
         call.message.chat.id,
@@ -2546,9 +3172,7 @@ def handle_kbcha_year_to_selection(call):
     )
 
 
-@bot.callback_query_handler(
-    func=lambda call: call.data.startswith("kbcha_mileage_from_")
-)
+@callback_router.prefix("kbcha_mileage_from_")
 def handle_kbcha_mileage_from_selection(call):
     # Парсим выбранный пробег
     mileage_from = call.data.split("_")[3]
@@ -2561,16 +3185,7 @@ def handle_kbcha_mileage_from_selection(call):
     user_search_data[user_id]["kbcha_mileage_from"] = mileage_from
 
     # Показываем выбор пробега до
-    markup = types.InlineKeyboardMarkup(row_width=3)
-    mileage_from_int = int(mileage_from)
-
-    for mileage in [50000, 100000, 150000, 200000, 250000, 300000]:
-        if mileage > mileage_from_int:
-            markup.add(
-                types.InlineKeyboardButton(
-                    f"{mileage} км", callback_data=f"kbcha_mileage_to_{mileage}"
-                )
-            )
+    markup = mileage_keyboard("kbcha_mileage_to_", MILEAGE_TO_STEPS, int(mileage_from))
 
     bot.send_message(
         call.message.chat.id,
@@ -2579,7 +3194,7 @@ def handle_kbcha_mileage_from_selection(call):
     )
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("kbcha_mileage_to_"))
+@callback_router.prefix("kbcha_mileage_to_")
 def handle_kbcha_mileage_to_selection(call):
     # Парсим выбранный пробег
     mileage_to = call.data.split("_")[3]
@@ -2592,19 +3207,7 @@ def handle_kbcha_mileage_to_selection(call):
     user_search_data[user_id]["kbcha_mileage_to"] = mileage_to
 
     # Показываем выбор цвета
-    markup = types.InlineKeyboardMarkup(row_width=2)
-
-    # Добавляем вариант "Любой"
-    markup.add(types.InlineKeyboardButton("Любой", callback_data="kbcha_color_Любой"))
-
-    # Добавляем доступные цвета
-    for kr_name, info in KBCHACHA_COLOR_TRANSLATIONS.items():
-        if kr_name != "Любой":  # Исключаем "Любой", так как мы его уже добавили выше
-            markup.add(
-                types.InlineKeyboardButton(
-                    info["ru"], callback_data=f"kbcha_color_{kr_name}"
-                )
-            )
+    markup = KBCHACHA_COLOR_KEYBOARD
 
     bot.send_message(
         call.message.chat.id,
@@ -2613,7 +3216,7 @@ def handle_kbcha_mileage_to_selection(call):
     )
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("kbcha_color_"))
+@callback_router.prefix("kbcha_color_")
 def handle_kbcha_color_selection(call):
     # Парсим выбранный цвет
     color_kr = call.data.split("_")[2]
@@ -2715,7 +3318,7 @@ def handle_kbcha_color_selection(call):
     # Отправляем изображение если есть, или текст если изображения нет
     if car["img_url"] and car["img_url"] != "":
         try:
-            bot.send_photo(
+            send_cached_photo(
                 call.message.chat.id, car["img_url"], caption=caption, parse_mode="HTML"
             )
         except Exception:
@@ -2752,125 +3355,22 @@ def handle_kbcha_color_selection(call):
 # Функции для работы с KCar
 def get_kcar_manufacturers():
     """Получение списка производителей с KCar"""
-    url = "https://api.kcar.com/bc/search/group/mnuftr"
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
-        "Content-Type": "application/json",
-    }
-    payload = {"wr_eq_sell_dcd": "ALL", "wr_in_multi_columns": "cntr_rgn_cd|cntr_cd"}
-
-    try:
-        response = requests.post(url, headers=headers, json=payload)
-        data = response.json()
-        manufacturers = data.get("data", [])
-
-        # Сортируем по имени производителя на английском
-        manufacturers.sort(key=lambda x: x.get("mnuftrEnm", ""))
-
-        return manufacturers
-    except Exception as e:
-        print("Ошибка при получении марок из KCar:", e)
-        return []
+    return kcar.taxonomy()
 
 
 def get_kcar_models(maker_code):
     """Получение списка моделей для выбранной марки с KCar"""
-    url = "https://api.kcar.com/bc/search/group/modelGrp"
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
-        "Content-Type": "application/json",
-    }
-    payload = {
-        "wr_eq_sell_dcd": "ALL",
-        "wr_in_multi_columns": "cntr_rgn_cd|cntr_cd",
-        "wr_eq_mnuftr_cd": maker_code,
-    }
-
-    try:
-        response = requests.post(url, headers=headers, json=payload)
-        data = response.json()
-        models = data.get("data", [])
-
-        # Сортируем по имени модели
-        models.sort(key=lambda x: x.get("modelGrpNm", ""))
-
-        # Отфильтровываем модели с count > 0, так как они реально представлены в списке
-        models = [model for model in models if model.get("count", 0) > 0]
-
-        return models
-    except Exception as e:
-        print(f"Ошибка при получении моделей с KCar для {maker_code}:", e)
-        return []
+    return kcar.taxonomy(maker_code)
 
 
 def get_kcar_generations(maker_code, model_code):
     """Получение списка поколений для выбранной модели с KCar"""
-    url = "https://api.kcar.com/bc/search/group/model"
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
-        "Content-Type": "application/json",
-    }
-    payload = {
-        "wr_eq_sell_dcd": "ALL",
-        "wr_in_multi_columns": "cntr_rgn_cd|cntr_cd",
-        "wr_eq_mnuftr_cd": maker_code,
-        "wr_eq_model_grp_cd": model_code,
-    }
-
-    try:
-        response = requests.post(url, headers=headers, json=payload)
-        data = response.json()
-        generations = data.get("data", [])
-
-        # Сортируем поколения по количеству автомобилей в наличии (по убыванию)
-        generations.sort(key=lambda x: x.get("count", 0), reverse=True)
-
-        # Отфильтровываем поколения с count > 0
-        generations = [gen for gen in generations if gen.get("count", 0) > 0]
-
-        return generations
-    except Exception as e:
-        print(
-            f"Ошибка при получении поколений с KCar для {maker_code}/{model_code}:", e
-        )
-        return []
+    return kcar.taxonomy(maker_code, model_code)
 
 
 def get_kcar_configurations(maker_code, model_group_code, model_code):
     """Получение списка конфигураций для выбранного поколения с KCar"""
-    url = "https://api.kcar.com/bc/search/group/grd"
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
-        "Content-Type": "application/json",
-    }
-    payload = {
-        "wr_eq_sell_dcd": "ALL",
-        "wr_in_multi_columns": "cntr_rgn_cd|cntr_cd",
-        "wr_eq_mnuftr_cd": maker_code,
-        "wr_eq_model_grp_cd": model_group_code,
-        "wr_eq_model_cd": model_code,
-    }
-
-    try:
-        response = requests.post(url, headers=headers, json=payload)
-        data = response.json()
-        configurations = data.get("data", [])
-
-        # Сортируем конфигурации по количеству автомобилей в наличии (по убыванию)
-        configurations.sort(key=lambda x: x.get("count", 0), reverse=True)
-
-        # Отфильтровываем конфигурации с count > 0
-        configurations = [
-            config for config in configurations if config.get("count", 0) > 0
-        ]
-
-        return configurations
-    except Exception as e:
-        print(
-            f"Ошибка при получении конфигураций с KCar для {maker_code}/{model_group_code}/{model_code}:",
-            e,
-        )
-        return []
+    return kcar.taxonomy(maker_code, model_group_code, model_code)
 
 
 def handle_kcar_search(call):
@@ -2882,42 +3382,49 @@ def handle_kcar_search(call):
         return
 
     # Создаем клавиатуру с марками
-    markup = types.InlineKeyboardMarkup(row_width=2)
-    for item in manufacturers:
-        maker_name = item.get("mnuftrEnm", "Без названия")
-        maker_code = item.get("mnuftrCd", "")
-
-        # Получаем корейское название (если доступно)
-        kr_maker_name = item.get("mnuftrNm", "")
-
-        # Переводим корейское название, если оно есть
-        translated_kr_name = ""
-        if kr_maker_name:
-            translated_kr_name = translate_smartly(kr_maker_name)
-
-        # Формируем отображаемое имя
-        display_name = maker_name
-        if kr_maker_name and translated_kr_name != kr_maker_name:
-            display_name = f"{maker_name} ({translated_kr_name})"
-
-        # Используем специальный префикс для отличия от других площадок
-        callback_data = f"kcar_brand_{maker_code}_{maker_name}"
-        markup.add(
-            types.InlineKeyboardButton(display_name, callback_data=callback_data)
-        )
+    markup = taxonomy_keyboards.lookup("kcar_brands", manufacturers)
+    if markup is None:
+        items = []
+        for item in manufacturers:
+            maker_name = item.get("mnuftrEnm", "Без названия")
+            maker_code = item.get("mnuftrCd", "")
+
+            # Получаем корейское название (если доступно)
+            kr_maker_name = item.get("mnuftrNm", "")
+
+            # Переводим корейское название, если оно есть
+            translated_kr_name = ""
+            if kr_maker_name:
+                translated_kr_name = translate_smartly(kr_maker_name)
+
+            # Формируем отображаемое имя
+            display_name = maker_name
+            if kr_maker_name and translated_kr_name != kr_maker_name:
+                display_name = f"{maker_name} ({translated_kr_name})"
+
+            # Используем специальный префикс для отличия от других площадок
+            callback_data = pack_callback(
+                "kcar_brand_", code=maker_code, name=maker_name
+            )
+            items.append(
+                KeyboardItem(display_name, callback_data, item.get("count", 0))
+            )
+        markup = taxonomy_keyboards.store("kcar_brands", manufacturers, items)
 
     bot.send_message(
         call.message.chat.id, "Выберите марку автомобиля:", reply_markup=markup
     )
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("kcar_brand_"))
+@callback_router.prefix("kcar_brand_")
 def handle_kcar_brand_selection(call):
     """Обработчик выбора марки автомобиля на KCar"""
     # Парсим данные из callback_data
-    parts = call.data.split("_", 3)
-    maker_code = parts[2]
-    maker_name = parts[3] if len(parts) > 3 else "Неизвестно"
+    node = unpack_callback(call, "kcar_brand_")
+    if node is None:
+        return
+    maker_code = node["code"]
+    maker_name = node["name"]
 
     # Сохраняем выбранную марку у пользователя для дальнейшего использования
     user_id = call.from_user.id
@@ -2937,23 +3444,31 @@ def handle_kcar_brand_selection(call):
         return
 
     # Создаем клавиатуру с моделями
-    markup = types.InlineKeyboardMarkup(row_width=2)
-    for item in models:
-        model_name = item.get("modelGrpNm", "Без названия")
-        model_code = item.get("modelGrpCd", "")
-
-        # Переводим название модели
-        translated_model_name = translate_smartly(model_name)
-
-        # Формируем отображаемое имя
-        display_name = model_name
-        if model_name != translated_model_name and translated_model_name != model_name:
-            display_name = f"{translated_model_name} ({model_name})"
-
-        callback_data = f"kcar_model_{model_code}_{model_name}"
-        markup.add(
-            types.InlineKeyboardButton(display_name, callback_data=callback_data)
-        )
+    markup = taxonomy_keyboards.lookup(f"kcar_models_{maker_code}", models)
+    if markup is None:
+        items = []
+        for item in models:
+            model_name = item.get("modelGrpNm", "Без названия")
+            model_code = item.get("modelGrpCd", "")
+
+            # Переводим название модели
+            translated_model_name = translate_smartly(model_name)
+
+            # Формируем отображаемое имя
+            display_name = model_name
+            if (
+                model_name != translated_model_name
+                and translated_model_name != model_name
+            ):
+                display_name = f"{translated_model_name} ({model_name})"
+
+            callback_data = pack_callback(
+                "kcar_model_", code=model_code, name=model_name
+            )
+            items.append(
+                KeyboardItem(display_name, callback_data, item.get("count", 0))
+            )
+        markup = taxonomy_keyboards.store(f"kcar_models_{maker_code}", models, items)
 
     bot.send_message(
         call.message.chat.id,
@@ -2962,13 +3477,15 @@ def handle_kcar_brand_selection(call):
     )
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("kcar_model_"))
+@callback_router.prefix("kcar_model_")
 def handle_kcar_model_selection(call):
     """Обработчик выбора модели автомобиля на KCar"""
     # Парсим данные из callback_data
-    parts = call.data.split("_", 3)
-    model_code = parts[2]
-    model_name = parts[3] if len(parts) > 3 else "Неизвестно"
+    node = unpack_callback(call, "kcar_model_")
+    if node is None:
+        return
+    model_code = node["code"]
+    model_name = node["name"]
 
     # Сохраняем выбранную модель у пользователя для дальнейшего использования
     user_id = call.from_user.id
@@ -3012,7 +3529,7 @@ def handle_kcar_model_selection(call):
         if gen_name != translated_gen_name and translated_gen_name != gen_name:
             display_text = f"{translated_gen_name} ({gen_name}) {gen_year}"
 
-        callback_data = f"kcar_gen_{gen_code}_{gen_name}"
+        callback_data = pack_callback("kcar_gen_", code=gen_code, name=gen_name)
 
         markup.add(
             types.InlineKeyboardButton(display_text, callback_data=callback_data)
@@ -3034,13 +3551,15 @@ def handle_kcar_model_selection(call):
     )
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("kcar_gen_"))
+@callback_router.prefix("kcar_gen_")
 def handle_kcar_generation_selection(call):
     """Обработчик выбора поколения автомобиля на KCar"""
     # Парсим данные из callback_data
-    parts = call.data.split("_", 3)
-    gen_code = parts[2]
-    gen_name = parts[3] if len(parts) > 3 else "Неизвестно"
+    node = unpack_callback(call, "kcar_gen_")
+    if node is None:
+        return
+    gen_code = node["code"]
+    gen_name = node["name"]
 
     # Сохраняем выбранное поколение у пользователя для дальнейшего использования
     user_id = call.from_user.id
@@ -3170,7 +3689,9 @@ def handle_kcar_generation_selection(call):
         ):
             display_text = f"{translated_config_name} ({config_name}) ({count} шт.)"
 
-        callback_data = f"kcar_config_{config_code}_{config_name}"
+        callback_data = pack_callback(
+            "kcar_config_", code=config_code, name=config_name
+        )
 
         markup.add(
             types.InlineKeyboardButton(display_text, callback_data=callback_data)
@@ -3215,13 +3736,15 @@ def handle_kcar_generation_selection(call):
     )
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("kcar_config_"))
+@callback_router.prefix("kcar_config_")
 def handle_kcar_configuration_selection(call):
     """Обработчик выбора конфигурации автомобиля на KCar"""
     # Парсим данные из callback_data
-    parts = call.data.split("_", 3)
-    config_code = parts[2]
-    config_name = parts[3] if len(parts) > 3 else "Неизвестно"
+    node = unpack_callback(call, "kcar_config_")
+    if node is None:
+        return
+    config_code = node["code"]
+    config_name = node["name"]
 
     print(f"✅ DEBUG kcar_config_selection - raw data:")
     print(f"config_code: {config_code}")
@@ -3375,19 +3898,11 @@ def handle_kcar_configuration_selection(call):
     if "kcar_generation_end_year" not in user_search_data[user_id]:
         user_search_data[user_id]["kcar_generation_end_year"] = end_year
 
-    # Показываем выбор года от
-    year_markup = types.InlineKeyboardMarkup(row_width=3)
-
-    # Добавляем года от начала производства поколения до его конца или текущего года
-    year_range = list(range(start_year, min(display_end_year, current_year) + 1))
-    print(f"⚙️ DEBUG kcar_config_selection - year range for buttons: {year_range}")
-
-    for year in year_range:
-        year_markup.add(
-            types.InlineKeyboardButton(
-                f"{year}", callback_data=f"kcar_year_from_{year}"
-            )
-        )
+    # Показываем выбор года от: года от начала производства поколения до его
+    # конца или текущего года
+    year_markup = year_keyboard(
+        "kcar_year_from_", start_year, min(display_end_year, current_year)
+    )
 
     # Определяем, как отображать названия
     display_maker_name = translated_maker_name
@@ -3416,7 +3931,7 @@ def handle_kcar_configuration_selection(call):
     )
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("kcar_year_from_"))
+@callback_router.prefix("kcar_year_from_")
 def handle_kcar_year_from_selection(call):
     """Обработчик выбора начального года для KCar"""
     # Парсим выбранный год
@@ -3460,7 +3975,7 @@ def handle_kcar_year_from_selection(call):
     )
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("kcar_year_to_"))
+@callback_router.prefix("kcar_year_to_")
 def handle_kcar_year_to_selection(call):
     """Обработчик выбора конечного года для KCar"""
     # Парсим выбранный год
@@ -3474,13 +3989,7 @@ def handle_kcar_year_to_selection(call):
     user_search_data[user_id]["kcar_year_to"] = year_to
 
     # Показываем выбор минимального пробега
-    mileage_markup = types.InlineKeyboardMarkup(row_width=3)
-    for mileage in [0, 10000, 20000, 30000, 50000, 70000, 100000]:
-        mileage_markup.add(
-            types.InlineKeyboardButton(
-                f"{mileage} км", callback_data=f"kcar_mileage_from_{mileage}"
-            )
-        )
+    mileage_markup = mileage_keyboard("kcar_mileage_from_", MILEAGE_FROM_STEPS)
 
     bot.send_message(
         call.message.chat.id,
@@ -3489,9 +3998,7 @@ def handle_kcar_year_to_selection(call):
     )
 
 
-@bot.callback_query_handler(
-    func=lambda call: call.data.startswith("kcar_mileage_from_")
-)
+@callback_router.prefix("kcar_mileage_from_")
 def handle_kcar_mileage_from_selection(call):
     """Обработчик выбора минимального пробега для KCar"""
     # Парсим выбранный пробег
@@ -3505,16 +4012,9 @@ def handle_kcar_mileage_from_selection(call):
     user_search_data[user_id]["kcar_mileage_from"] = mileage_from
 
     # Показываем выбор максимального пробега
-    mileage_markup = types.InlineKeyboardMarkup(row_width=3)
-    mileage_from_int = int(mileage_from)
-
-    for mileage in [50000, 100000, 150000, 200000, 250000, 300000]:
-        if mileage > mileage_from_int:
-            mileage_markup.add(
-                types.InlineKeyboardButton(
-                    f"{mileage} км", callback_data=f"kcar_mileage_to_{mileage}"
-                )
-            )
+    mileage_markup = mileage_keyboard(
+        "kcar_mileage_to_", MILEAGE_TO_STEPS, int(mileage_from)
+    )
 
     bot.send_message(
         call.message.chat.id,
@@ -3523,7 +4023,7 @@ def handle_kcar_mileage_from_selection(call):
     )
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("kcar_mileage_to_"))
+@callback_router.prefix("kcar_mileage_to_")
 def handle_kcar_mileage_to_selection(call):
     """Обработчик выбора максимального пробега для KCar"""
     # Парсим выбранный пробег
@@ -3537,19 +4037,7 @@ def handle_kcar_mileage_to_selection(call):
     user_search_data[user_id]["kcar_mileage_to"] = mileage_to
 
     # Показываем выбор цвета
-    markup = types.InlineKeyboardMarkup(row_width=2)
-
-    # Добавляем вариант "Любой"
-    markup.add(types.InlineKeyboardButton("Любой", callback_data="kcar_color_Любой"))
-
-    # Добавляем доступные цвета
-    for kr_name, ru_name in KCAR_COLOR_TRANSLATIONS.items():
-        if kr_name != "Любой":  # Исключаем "Любой", так как мы его уже добавили выше
-            markup.add(
-                types.InlineKeyboardButton(
-                    ru_name, callback_data=f"kcar_color_{kr_name}"
-                )
-            )
+    markup = KCAR_COLOR_KEYBOARD
 
     bot.send_message(
         call.message.chat.id,
@@ -3558,7 +4046,7 @@ def handle_kcar_mileage_to_selection(call):
     )
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("kcar_color_"))
+@callback_router.prefix("kcar_color_")
 def handle_kcar_color_selection(call):
     """Обработчик выбора цвета для KCar"""
     # Парсим выбранный цвет
@@ -3711,7 +4199,7 @@ def handle_kcar_color_selection(call):
             # Если есть изображение, отправляем фото с описанием
             if car["img_url"]:
                 try:
-                    bot.send_photo(
+                    send_cached_photo(
                         call.message.chat.id,
                         car["img_url"],
                         caption=car_message,
@@ -3781,183 +4269,40 @@ def search_kcar_cars_by_html(
     Возвращает:
     list: Список автомобилей с информацией
     """
-    # Базовый поисковый запрос
-    base_search_cond = {
-        "wr_eq_mnuftr_cd": mnuftr_cd,
-        "wr_eq_model_grp_cd": model_grp_cd,
-        "wr_eq_model_cd": model_cd,
-    }
-
-    # Добавляем дополнительные параметры, если они указаны
-    if year_from and year_to:
-        base_search_cond["wr_bt_prdcn_year"] = f"{year_from},{year_to}"
-
-    if mileage_from is not None and mileage_to is not None:
-        base_search_cond["wr_bt_accent_km"] = f"{mileage_from},{mileage_to}"
-
-    # Добавляем параметр цвета, если выбран конкретный цвет (не "Любой")
-    if color and color != "Любой":
-        # Находим корейское название цвета среди ключей словаря
-        for kr_color, ru_color in KCAR_COLOR_TRANSLATIONS.items():
-            if kr_color == color:
-                # Здесь предполагается, что код цвета может потребоваться позже
-                # Сейчас используем просто корейское название
-                base_search_cond["wr_eq_extl_color_nm"] = kr_color
-                break
-
-    # Преобразуем словарь в JSON строку и кодируем для URL
-    search_cond = urllib.parse.quote(json.dumps(base_search_cond))
-
-    # Формируем URL для запроса
-    url = f"https://www.kcar.com/bc/search?searchCond={search_cond}"
-
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-    }
+    # Цвет передаём, только если выбран конкретный цвет (не "Любой")
+    if color not in KCAR_COLOR_TRANSLATIONS:
+        color = None
 
     try:
-        print(f"DEBUG: Отправка запроса на URL: {url}")
-        response = requests.get(url, headers=headers)
-
-        if response.status_code != 200:
-            print(f"Ошибка при получении страницы: {response.status_code}")
-            return []
-
-        soup = BeautifulSoup(response.text, "html.parser")
-
-        # Ищем блок с автомобилями
-        car_list_wrap = soup.select_one("div.carListWrap")
-        if not car_list_wrap:
-            print("Не найден блок с автомобилями (div.carListWrap)")
-            return []
-
-        # Извлекаем все блоки с автомобилями
-        car_list_boxes = car_list_wrap.select("div.carListBox")
-        if not car_list_boxes:
-            print("Не найдены блоки с автомобилями (div.carListBox)")
-            # Проверяем, содержит ли блок сообщение о пустых результатах
-            empty_result = car_list_wrap.select_one("div.empty-car-list")
-            if empty_result:
-                print("Найдено сообщение о пустых результатах")
-            return []
-
-        print(f"DEBUG: Найдено {len(car_list_boxes)} автомобилей")
-
-        results = []
-        for box in car_list_boxes[:5]:  # Ограничиваем до 5 результатов
-            try:
-                # Извлекаем данные об автомобиле
-                # Название автомобиля
-                car_name_elem = box.select_one("div.carName p.carTit a")
-                car_name = car_name_elem.text.strip() if car_name_elem else "Неизвестно"
-                # Переводим название автомобиля
-                translated_car_name = translate_smartly(car_name)
-
-                # Получаем ссылку на автомобиль
-                car_link = car_name_elem.get("href", "") if car_name_elem else ""
-                if car_link:
-                    car_link = f"https://www.kcar.com{car_link}"
-
-                # Цена
-                car_exp_elem = box.select_one("div.carExpIn p.carExp")
-                car_price = car_exp_elem.text.strip() if car_exp_elem else "Неизвестно"
-
-                # Детали автомобиля (год, пробег, тип топлива)
-                car_details_elem = box.select_one("p.detailCarCon")
-                car_details = []
-                if car_details_elem:
-                    for span in car_details_elem.select("span"):
-                        car_details.append(span.text.strip())
-
-                # Проверяем что у нас есть достаточно деталей
-                year = car_details[0] if len(car_details) > 0 else "Неизвестно"
-                mileage = car_details[1] if len(car_details) > 1 else "Неизвестно"
-                fuel_type = car_details[2] if len(car_details) > 2 else "Неизвестно"
-                location = car_details[3] if len(car_details) > 3 else "Неизвестно"
-
-                # Переводим данные
-                translated_fuel_type = translate_smartly(fuel_type)
-                translated_location = translate_smartly(location)
-
-                # Изображение автомобиля
-                img_elem = box.select_one("div.carListImg a img")
-                img_url = img_elem.get("src", "") if img_elem else ""
-
-                # Проверяем ссылку на изображение, если она относительная, добавляем домен
-                if img_url and not img_url.startswith(("http://", "https://")):
-                    img_url = f"https://www.kcar.com{img_url}"
-
-                # Краткое описание автомобиля
-                car_desc_elem = box.select_one("div.carSimcDesc")
-                car_desc = car_desc_elem.text.strip() if car_desc_elem else ""
-                # Переводим описание
-                translated_desc = translate_smartly(car_desc)
-
-                # Получаем дополнительные метки (VIP, 360 и т.д.)
-                car_labels = []
-                free_delivery = box.select_one("span.stateDlvy")
-                if free_delivery:
-                    car_labels.append("Бесплатная доставка")
-
-                car_360 = box.select_one("span.car360Img")
-                if car_360:
-                    car_labels.append("360° обзор")
-
-                # Проверяем наличие специальных опций
-                special_options = box.select("ul.infoTooltip li button")
-                for option in special_options:
-                    option_text = option.text.strip()
-                    if option_text:
-                        translated_option = translate_smartly(option_text)
-                        car_labels.append(translated_option)
-
-                results.append(
-                    {
-                        "title": translated_car_name,
-                        "original_title": car_name,
-                        "price": car_price,
-                        "year": year,
-                        "mileage": mileage,
-                        "fuel_type": translated_fuel_type,
-                        "original_fuel_type": fuel_type,
-                        "location": translated_location,
-                        "original_location": location,
-                        "description": translated_desc,
-                        "original_description": car_desc,
-                        "link": car_link,
-                        "img_url": img_url,
-                        "labels": car_labels,
-                    }
-                )
-                print(f"DEBUG: Успешно обработан автомобиль {car_name}")
-            except Exception as e:
-                print(f"Ошибка при парсинге автомобиля: {e}")
-                continue
-
-        return results
+        cars = kcar.search(
+            mnuftr_cd,
+            model_grp_cd,
+            model_cd,
+            year_from=year_from,
+            year_to=year_to,
+            mileage_from=mileage_from,
+            mileage_to=mileage_to,
+            color=color,
+        )
     except Exception as e:
         print(f"Ошибка при поиске автомобилей на KCar через HTML: {e}")
         return []
 
+    # Переводим данные, оригиналы оставляем рядом
+    for car in cars:
+        for field in ("title", "fuel_type", "location", "description"):
+            car[f"original_{field}"] = car[field]
+            car[field] = translate_smartly(car[field])
+        car["labels"] = [translate_smartly(label) for label in car["labels"]]
+    return cars
 
-def get_kcar_year_to_keyboard(start_year, end_year):
-    """Создает клавиатуру с диапазоном лет от start_year до end_year для выбора конечного года"""
-    year_markup = types.InlineKeyboardMarkup(row_width=3)
-
-    print(
-        f"⚙️ DEBUG get_kcar_year_to_keyboard - Creating keyboard with range: {start_year} to {end_year}"
-    )
-
-    # Добавляем все года от начального до конечного
-    for year in range(start_year, end_year + 1):
-        year_markup.add(
-            types.InlineKeyboardButton(f"{year}", callback_data=f"kcar_year_to_{year}")
-        )
 
-    return year_markup
+def get_kcar_year_to_keyboard(start_year, end_year):
+    """Клавиатура с диапазоном лет от start_year до end_year для выбора конечного года"""
+    return year_keyboard("kcar_year_to_", start_year, end_year)
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("price_from_"))
+@callback_router.prefix("price_from_")
 def handle_price_from_selection(call):
     user_id = call.from_user.id
 
@@ -3984,35 +4329,10 @@ def handle_price_from_selection(call):
     # Получаем сохраненные данные
     user_data = user_search_data[user_id]
 
-    # Отображаем выбор максимальной цены
-    markup = types.InlineKeyboardMarkup(row_width=3)
-
-    # Добавляем кнопку "Любая" для максимальной цены
-    markup.add(types.InlineKeyboardButton("Любая", callback_data="price_to_any"))
-
-    # Добавляем кнопки с диапазоном цен от 1 до 100 млн вон
+    # Отображаем выбор максимальной цены: «Любая» и цены от 1 до 100 млн вон.
     # Если выбрана минимальная цена, начинаем с нее
     min_price_value = 0 if price_from is None else price_from // 100
-
-    price_ranges = [
-        p
-        for p in [1, 5, 10, 15, 20, 25, 30, 35, 40, 45, 50, 60, 70, 80, 90, 100]
-        if p > min_price_value
-    ]
-
-    buttons = []
-    for price in price_ranges:
-        price_param = price * 100  # Конвертация в параметр API (1 млн = 100)
-        buttons.append(
-            types.InlineKeyboardButton(
-                f"{price} млн", callback_data=f"price_to_{price_param}"
-            )
-        )
-
-    # Добавляем кнопки группами по 3
-    for i in range(0, len(buttons), 3):
-        row = buttons[i : i + 3]
-        markup.row(*row)
+    markup = price_keyboard("price_to_", min_price_value)
 
     # Формируем текст с выбранными параметрами
     selected_color_ru = (
@@ -4035,7 +4355,7 @@ def handle_price_from_selection(call):
     )
 
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("price_to_"))
+@callback_router.prefix("price_to_")
 def handle_price_to_selection(call):
     user_id = call.from_user.id
 
@@ -4132,32 +4452,36 @@ def handle_price_to_selection(call):
         reply_markup=markup,
     )
 
-    # Сохраняем запрос пользователя
-    if user_id not in user_requests:
-        user_requests[user_id] = []
-
-    user_requests[user_id].append(
-        {
-            "manufacturer": manufacturer,
-            "model_group": model_group,
-            "model": model,
-            "trim": trim,
-            "year_from": year_from,
-            "year_to": year_to,
-            "mileage_from": mileage_from,
-            "mileage_to": mileage_to,
-            "color": selected_color_kr,
-            "price_from": price_from,
-            "price_to": price_to,
-        }
-    )
+    # Сохраняем запрос пользователя. Ключи в файле — строки, поэтому и здесь
+    # используем строковый user_id, иначе новый запрос затирал бы старые
+    user_key = str(user_id)
+    with user_locks(user_key):
+        subscription_id = uuid.uuid4().hex[:8]
+        user_requests.setdefault(user_key, []).append(
+            {
+                "id": subscription_id,
+                "manufacturer": manufacturer,
+                "model_group": model_group,
+                "model": model,
+                "trim": trim,
+                "year_from": year_from,
+                "year_to": year_to,
+                "mileage_from": mileage_from,
+                "mileage_to": mileage_to,
+                "color": selected_color_kr,
+                "price_from": price_from,
+                "price_to": price_to,
+                "digest": False,
+            }
+        )
 
     save_requests(user_requests)
+    encar_prefetch.record((manufacturer, model_group, model))
 
-    # Запускаем поиск в отдельном потоке
-    threading.Thread(
-        target=check_for_new_cars,
-        args=(
+    # Запускаем опрос подписки в общем цикле поллеров
+    poll_scheduler.schedule(
+        subscription_id,
+        check_for_new_cars(
             call.from_user.id,  # user_id для параметров поиска
             call.message.chat.id,  # chat_id для отправки сообщений
             manufacturer.strip(),
@@ -4171,22 +4495,54 @@ def handle_price_to_selection(call):
             "" if selected_color_kr == "all" else selected_color_kr.strip(),
             price_from,
             price_to,
+            subscription_id,
         ),
-        daemon=True,
-    ).start()
+    )
 
 
 # Запуск бота
 if __name__ == "__main__":
     from datetime import datetime
 
+    if sys.argv[1:] == ["export-taxonomy"]:
+        export_taxonomy()
+        sys.exit(0)
+
+    if WEBHOOK_URL and not WEBHOOK_SECRET:
+        print("❌ Режим вебхука требует WEBHOOK_SECRET, запуск остановлен")
+        sys.exit(1)
+
     print("=" * 50)
     print(
         f"🚀 [UniTrading Bot] Запуск бота — {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
     )
     print("📦 Загрузка сохранённых запросов пользователей...")
     load_requests()
+    encar_prefetch.rebuild(saved_request_paths())
     print("✅ Запросы успешно загружены.")
+    load_watches()
+    print(f"👁 Отслеживаемых автомобилей: {len(car_watches)}")
+    load_photo_cache()
+    taxonomy_cache.load()
+    print(f"📚 Справочников в кэше: {len(taxonomy_cache)}")
+    load_taxonomy_snapshot()
+    for index in TAXONOMY_INDEXES.values():
+        index.start(interval=TAXONOMY_CRAWL_INTERVAL, on_update=save_taxonomy_snapshot)
+    threading.Thread(target=watch_poller, daemon=True).start()
     print("🤖 Бот запущен и ожидает команды...")
     print("=" * 50)
-    bot.infinity_polling()
+    if WEBHOOK_URL:
+        from webhook import run_webhook
+
+        run_webhook(
+            bot,
+            WEBHOOK_URL,
+            path=WEBHOOK_PATH,
+            host=WEBHOOK_HOST,
+            port=WEBHOOK_PORT,
+            secret_token=WEBHOOK_SECRET,
+            max_pending=WEBHOOK_MAX_PENDING,
+        )
+    else:
+        bot.remove_webhook()
+        bot.infinity_polling()
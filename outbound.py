@@ -0,0 +1,303 @@
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import requests
+import telebot
+from telebot.apihelper import ApiTelegramException
+
+# Приоритеты очереди: ответы на действия пользователя идут раньше уведомлений
+PRIORITY_INTERACTIVE = 0
+PRIORITY_ALERT = 1
+
+# Ограничения Bot API: ~30 сообщений в секунду всего, ~1 в секунду в личный
+# чат (с небольшим всплеском) и ~20 в минуту в группу
+GLOBAL_RATE = 30
+GLOBAL_BURST = 30
+PRIVATE_CHAT_RATE = 1
+PRIVATE_CHAT_BURST = 3
+GROUP_CHAT_RATE = 20 / 60
+GROUP_CHAT_BURST = 3
+
+_thread_priority = threading.local()
+
+
+def set_thread_priority(priority):
+    """Приоритет всех отправок из текущего потока (например, для поллеров)"""
+    _thread_priority.value = priority
+
+
+def get_thread_priority():
+    return getattr(_thread_priority, "value", PRIORITY_INTERACTIVE)
+
+
+class TokenBucket:
+    """
+    Корзина токенов: rate токенов в секунду, не больше capacity сразу.
+
+    Args:
+        rate: Скорость пополнения, токенов в секунду
+        capacity: Размер корзины (допустимый всплеск)
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        elapsed = now - self.updated_at
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, now):
+        """Сколько ждать до появления токена (0 — токен есть прямо сейчас)"""
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, seconds, now):
+        """Telegram попросил подождать (retry_after) — не тратим токены до этого"""
+        self.blocked_until = max(self.blocked_until, now + seconds)
+        self.tokens = 0
+
+    def is_idle(self, now):
+        return (
+            now >= self.blocked_until
+            and self.wait_time(now) == 0
+            and (self.tokens >= self.capacity)
+        )
+
+
+class _Job:
+    __slots__ = ("chat_id", "func", "args", "kwargs", "priority", "future", "attempts")
+
+    def __init__(self, chat_id, func, args, kwargs, priority):
+        self.chat_id = chat_id
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.priority = priority
+        self.future = Future()
+        self.attempts = 0
+
+
+class OutboundQueue:
+    """
+    Общая очередь исходящих запросов к Telegram.
+
+    Глобальная корзина токенов ограничивает общий поток, корзины по чатам —
+    поток в каждый чат. Задачи с более высоким приоритетом (ответы
+    пользователю) обгоняют уведомления. В один чат одновременно
+    выполняется не больше одной задачи, поэтому части дайджеста или
+    альбома приходят в том порядке, в котором их отправили; разные чаты
+    обслуживаются параллельно. Ошибка 429 не теряет сообщение: чат и
+    общий поток приостанавливаются на retry_after, а задача остаётся
+    первой в очереди своего чата.
+
+    Args:
+        workers: Сколько запросов к Bot API выполнять параллельно
+        max_retries: Сколько раз повторять задачу при 429 и ошибках соединения
+    """
+
+    def __init__(self, workers=8, max_retries=10):
+        self.max_retries = max_retries
+        self._global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_BURST)
+        self._chat_buckets = {}
+        self._chat_jobs = {}  # chat_id -> куча (priority, seq, job)
+        self._ready = []  # (priority, seq, chat_id)
+        self._delayed = []  # (ready_at, seq, chat_id)
+        # Чаты, которые уже ждут в _ready/_delayed или выполняют задачу
+        self._scheduled = set()
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="outbound"
+        )
+        self._last_cleanup = time.monotonic()
+        threading.Thread(target=self._scheduler, daemon=True).start()
+
+    def submit(self, chat_id, func, *args, priority=None, **kwargs):
+        """Ставит вызов Bot API в очередь и сразу возвращает Future"""
+        if priority is None:
+            priority = get_thread_priority()
+        job = _Job(chat_id, func, args, kwargs, priority)
+        with self._cond:
+            jobs = self._chat_jobs.setdefault(chat_id, [])
+            heapq.heappush(jobs, (priority, next(self._seq), job))
+            if chat_id not in self._scheduled:
+                self._scheduled.add(chat_id)
+                self._schedule_chat(chat_id)
+                self._cond.notify()
+        return job.future
+
+    def call(self, chat_id, func, *args, priority=None, **kwargs):
+        """Как submit, но дожидается результата (или исключения) вызова"""
+        return self.submit(chat_id, func, *args, priority=priority, **kwargs).result()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            # Отрицательные chat_id — группы и каналы, у них лимит строже
+            if isinstance(chat_id, int) and chat_id < 0:
+                bucket = TokenBucket(GROUP_CHAT_RATE, GROUP_CHAT_BURST)
+            else:
+                bucket = TokenBucket(PRIVATE_CHAT_RATE, PRIVATE_CHAT_BURST)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _schedule_chat(self, chat_id, delay=0):
+        """Ставит чат в очередь по его первой задаче (вызывать под _cond)"""
+        jobs = self._chat_jobs.get(chat_id)
+        if not jobs:
+            self._chat_jobs.pop(chat_id, None)
+            self._scheduled.discard(chat_id)
+            return
+        priority, seq, _ = jobs[0]
+        if delay > 0:
+            heapq.heappush(self._delayed, (time.monotonic() + delay, seq, chat_id))
+        else:
+            heapq.heappush(self._ready, (priority, seq, chat_id))
+
+    def _cleanup_buckets(self, now):
+        # Удаляем корзины давно молчащих чатов, чтобы словарь не рос бесконечно
+        if now - self._last_cleanup < 60:
+            return
+        self._last_cleanup = now
+        for chat_id in [
+            chat_id
+            for chat_id, bucket in self._chat_buckets.items()
+            if bucket.is_idle(now) and chat_id not in self._scheduled
+        ]:
+            del self._chat_buckets[chat_id]
+
+    def _scheduler(self):
+        while True:
+            with self._cond:
+                now = time.monotonic()
+                while self._delayed and self._delayed[0][0] <= now:
+                    _, _, chat_id = heapq.heappop(self._delayed)
+                    self._schedule_chat(chat_id)
+
+                if not self._ready:
+                    timeout = self._delayed[0][0] - now if self._delayed else None
+                    self._cond.wait(timeout)
+                    continue
+
+                global_wait = self._global_bucket.wait_time(now)
+                if global_wait > 0:
+                    self._cond.wait(global_wait)
+                    continue
+
+                _, seq, chat_id = heapq.heappop(self._ready)
+                chat_bucket = self._chat_bucket(chat_id)
+                chat_wait = chat_bucket.wait_time(now)
+                if chat_wait > 0:
+                    # Этот чат пока занят — остальные чаты не ждут его
+                    heapq.heappush(self._delayed, (now + chat_wait, seq, chat_id))
+                    continue
+
+                _, _, job = heapq.heappop(self._chat_jobs[chat_id])
+                chat_bucket.take(now)
+                self._global_bucket.take(now)
+                self._cleanup_buckets(now)
+
+            self._executor.submit(self._run, job)
+
+    def _run(self, job):
+        retry_after = None
+        try:
+            if not job.future.done():
+                retry_after = self._execute(job)
+        finally:
+            with self._cond:
+                if retry_after is not None:
+                    # Задача возвращается первой в очередь своего чата
+                    job.attempts += 1
+                    heapq.heappush(
+                        self._chat_jobs.setdefault(job.chat_id, []),
+                        (job.priority, -1, job),
+                    )
+                self._schedule_chat(job.chat_id, delay=retry_after or 0)
+                self._cond.notify()
+
+    def _execute(self, job):
+        """Выполняет задачу; возвращает паузу перед повтором или None"""
+        try:
+            result = job.func(*job.args, **job.kwargs)
+        except ApiTelegramException as e:
+            if e.error_code == 429 and job.attempts < self.max_retries:
+                retry_after = (
+                    (e.result_json or {}).get("parameters", {}).get("retry_after", 1)
+                )
+                print(
+                    f"⏳ Telegram просит подождать {retry_after} с (чат {job.chat_id})"
+                )
+                # Флуд-контроль Telegram общий: притормаживаем и остальные чаты
+                with self._cond:
+                    now = time.monotonic()
+                    self._chat_bucket(job.chat_id).block(retry_after, now)
+                    self._global_bucket.block(retry_after, now)
+                return retry_after
+            job.future.set_exception(e)
+        except requests.exceptions.ReadTimeout as e:
+            # Запрос ушёл, но ответа не дождались: Telegram мог уже доставить
+            # сообщение, и повтор прислал бы его второй раз
+            print(f"⚠️ Нет ответа Telegram (чат {job.chat_id}), без повтора: {e}")
+            job.future.set_exception(e)
+        except requests.exceptions.ConnectionError as e:
+            # Сюда же относится ConnectTimeout: соединения не было — повтор безопасен
+            if job.attempts < self.max_retries:
+                return min(2**job.attempts, 60)
+            job.future.set_exception(e)
+        except Exception as e:
+            job.future.set_exception(e)
+        else:
+            job.future.set_result(result)
+        return None
+
+
+class QueuedTeleBot(telebot.TeleBot):
+    """
+    TeleBot, отправляющий сообщения через OutboundQueue. Обработчики
+    вызывают bot.send_message как раньше и получают тот же результат,
+    но темп отправки и повторы при 429 берёт на себя очередь.
+    """
+
+    def __init__(self, *args, outbound=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.outbound = outbound or OutboundQueue()
+
+    def send_message(self, chat_id, *args, **kwargs):
+        return self.outbound.call(
+            chat_id, super().send_message, chat_id, *args, **kwargs
+        )
+
+    def send_photo(self, chat_id, *args, **kwargs):
+        return self.outbound.call(chat_id, super().send_photo, chat_id, *args, **kwargs)
+
+    def send_media_group(self, chat_id, *args, **kwargs):
+        return self.outbound.call(
+            chat_id, super().send_media_group, chat_id, *args, **kwargs
+        )
+
+    def edit_message_text(self, *args, **kwargs):
+        chat_id = kwargs.get("chat_id", args[1] if len(args) > 1 else None)
+        return self.outbound.call(chat_id, super().edit_message_text, *args, **kwargs)
+
+    def edit_message_reply_markup(self, *args, **kwargs):
+        chat_id = kwargs.get("chat_id", args[0] if args else None)
+        return self.outbound.call(
+            chat_id, super().edit_message_reply_markup, *args, **kwargs
+        )
@@ -0,0 +1,577 @@
+import json
+import threading
+import time
+import urllib.parse
+from abc import ABC, abstractmethod
+
+from bs4 import BeautifulSoup
+
+from listings import Listing
+from taxonomy import TaxonomyIndex
+
+ENCAR_NAV_URL = "https://encar-proxy.habsida.net/api/nav?count=true&q={query}&inav=%7CMetadata%7CSort"
+ENCAR_DETAIL_URL = "https://api.encar.com/v1/readside/vehicle/{listing_id}"
+KBCHACHACHA_URL = "https://www.kbchachacha.com/public"
+KCAR_API_URL = "https://api.kcar.com/bc/search/group"
+KCAR_SEARCH_URL = "https://www.kcar.com/bc/search?searchCond={search_cond}"
+
+# Общие условия поиска KCar: все типы продажи, все регионы
+KCAR_BASE_PAYLOAD = {
+    "wr_eq_sell_dcd": "ALL",
+    "wr_in_multi_columns": "cntr_rgn_cd|cntr_cd",
+}
+
+# Сколько объявлений показывать из результатов поиска по HTML
+SEARCH_RESULTS_LIMIT = 5
+
+
+class PlatformAdapter(ABC):
+    """
+    Общий интерфейс площадки для мастера поиска: справочник и карточка
+    объявления.
+
+    Поиск в интерфейс не входит: у каждой площадки свои фильтры (Encar —
+    готовый URL каталога, KBChaChaCha и KCar — коды из справочника), а в
+    Listing приводится только каталог Encar, который опрашивают поллеры
+    подписок (см. EncarAdapter.search_async).
+
+    Справочник у всех площадок — дерево из четырёх уровней (марка →
+    модель → поколение → комплектация). Площадка реализует только
+    загрузку уровня (методы из TAXONOMY_LEVELS), а кэш с фоновым
+    обновлением, объединение одинаковых запросов и индекс дерева
+    подключаются здесь, одинаково для всех площадок: запрос мастера идёт
+    индекс → кэш → площадка, а обход индекса — прямо на площадку в своём
+    ограниченном пуле и записывает ответы в кэш.
+
+    Args:
+        client: UpstreamClient для запросов к площадке
+        cache: TaxonomyCache для уровней справочника
+        concurrency: Сколько запросов одновременно при обходе справочника
+    """
+
+    name = None
+
+    # Методы загрузки уровней справочника: путь из depth элементов -> узлы
+    TAXONOMY_LEVELS = ("manufacturers", "models", "generations", "trims")
+
+    # Поле узла каждого уровня, которое становится следующим элементом пути
+    node_keys = ()
+
+    def __init__(self, client, cache, concurrency=4):
+        self.client = client
+        self.index = TaxonomyIndex(concurrency=concurrency)
+        self._levels = []
+        for depth, level in enumerate(self.TAXONOMY_LEVELS):
+            getter, name = getattr(self, level), f"{self.name}.{level}"
+            loader = self.index.level(
+                depth,
+                node_key=self.node_keys[depth],
+                crawl=cache.fetched(getter, name=name),
+            )(cache.cached(getter, name=name))
+            self._levels.append(loader)
+
+    def taxonomy(self, *path):
+        """
+        Узлы справочника под путём path: из индекса, из кэша или с
+        площадки. Пустой список — площадка недоступна.
+        """
+        return self._levels[len(path)](*path)
+
+    @abstractmethod
+    def manufacturers(self):
+        """Марки"""
+
+    @abstractmethod
+    def models(self, manufacturer):
+        """Модели марки"""
+
+    @abstractmethod
+    def generations(self, manufacturer, model_group):
+        """Поколения модели"""
+
+    @abstractmethod
+    def trims(self, manufacturer, model_group, model):
+        """Комплектации поколения"""
+
+    def detail(self, listing_id):
+        """Карточка объявления или None, если площадка её не отдаёт"""
+        return None
+
+
+class EncarAdapter(PlatformAdapter):
+    """
+    Encar: справочник из nav-эндпоинта прокси, поиск по каталогу,
+    карточки через readside API.
+
+    Карточки запрашиваются с ограничением частоты: не чаще раза в
+    request_delay секунд на весь процесс.
+
+    Args:
+        photo_limit: Сколько фотографий сохранять в Listing
+        request_delay: Пауза между запросами карточек, в секундах
+    """
+
+    name = "encar"
+    node_keys = ("DisplayValue",) * 4
+
+    def __init__(
+        self, client, cache, concurrency=4, photo_limit=None, request_delay=0.5
+    ):
+        super().__init__(client, cache, concurrency)
+        self.photo_limit = photo_limit
+        self.request_delay = request_delay
+        self._rate_lock = threading.Lock()
+        self._next_request_at = 0.0
+
+    def _nav_facets(self, query, node_index, depth):
+        """
+        Узлы уровня depth из ответа nav: от списка марок спускаемся по
+        выбранным (IsSelected) узлам depth раз.
+        """
+        response = self.client.get(ENCAR_NAV_URL.format(query=query))
+        data = response.json()
+        facets = (
+            data.get("iNav", {})
+            .get("Nodes", [])[node_index]
+            .get("Facets", [])[0]
+            .get("Refinements", {})
+            .get("Nodes", [])[0]
+            .get("Facets", [])
+        )
+        for _ in range(depth):
+            selected = next((item for item in facets if item.get("IsSelected")), None)
+            if not selected:
+                return []
+            facets = (
+                selected.get("Refinements", {}).get("Nodes", [])[0].get("Facets", [])
+            )
+        return facets
+
+    def manufacturers(self):
+        query = "(And.Hidden.N._.SellType.%EC%9D%BC%EB%B0%98._.CarType.A.)"
+        try:
+            manufacturers = self._nav_facets(query, 2, 0)
+            manufacturers.sort(
+                key=lambda x: x.get("Metadata", {}).get("EngName", [""])[0]
+            )
+            return manufacturers
+        except Exception as e:
+            print("Ошибка при получении марок:", e)
+            return []
+
+    def models(self, manufacturer):
+        query = f"(And.Hidden.N._.SellType.%EC%9D%BC%EB%B0%98._.(C.CarType.A._.Manufacturer.{manufacturer}.))"
+        try:
+            return self._nav_facets(query, 2, 1)
+        except Exception as e:
+            print(f"Ошибка при получении моделей для {manufacturer}:", e)
+            return []
+
+    def generations(self, manufacturer, model_group):
+        query = f"(And.Hidden.N._.SellType.%EC%9D%BC%EB%B0%98._.(C.CarType.A._.(C.Manufacturer.{manufacturer}._.ModelGroup.{model_group}.)))"
+        try:
+            return self._nav_facets(query, 2, 2)
+        except Exception as e:
+            print(
+                f"Ошибка при получении поколений для {manufacturer}, {model_group}:", e
+            )
+            return []
+
+    def trims(self, manufacturer, model_group, model):
+        query = f"(And.Hidden.N._.(C.CarType.A._.(C.Manufacturer.{manufacturer}._.(C.ModelGroup.{model_group}._.Model.{model}.))))"
+        try:
+            return self._nav_facets(query, 1, 3)
+        except Exception as e:
+            print(
+                f"Ошибка при получении комплектаций для {manufacturer}, {model_group}, {model}:",
+                e,
+            )
+            return []
+
+    def parse_catalog(self, data):
+        """
+        Объявления из ответа каталога сразу в виде Listing: вложенные списки
+        и метаданные (Trust, ServiceMark и т. п.) отбрасываются при разборе.
+        """
+        return [
+            Listing.from_encar(item, photo_limit=self.photo_limit)
+            for item in data.get("SearchResults", [])
+        ]
+
+    async def search_async(self, async_client, url):
+        """
+        Объявления каталога по готовому URL поиска (см. build_encar_url)
+        через AsyncUpstreamClient поллеров.
+
+        Returns:
+            Кортеж (response, список Listing); список — None, если статус не 200
+        """
+        return await async_client.get_json(url, project=self.parse_catalog)
+
+    def rate_limited_get(self, url, **kwargs):
+        """
+        GET-запрос с ограничением частоты: карточки для уведомлений,
+        проверки продажи и отслеживания авто идут одним потоком запросов
+        и не умножают нагрузку на Encar.
+        """
+        with self._rate_lock:
+            wait = self._next_request_at - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            self._next_request_at = time.monotonic() + self.request_delay
+
+        return self.client.get(url, **kwargs)
+
+    def detail_response(self, listing_id, headers=None):
+        """
+        Ответ readside API по карточке целиком — когда важен статус (404 —
+        снято с продажи) или нужны условные запросы (ETag / 304).
+        """
+        return self.rate_limited_get(
+            ENCAR_DETAIL_URL.format(listing_id=listing_id), headers=headers
+        )
+
+    def detail(self, listing_id):
+        response = self.detail_response(listing_id)
+        if response.status_code != 200:
+            return None
+        return response.json()
+
+    async def detail_async(self, async_client, listing_id):
+        """
+        Карточка через AsyncUpstreamClient поллеров (частоту ограничивает
+        его семафор на хост) или None, если карточка недоступна.
+        """
+        response = await async_client.get(
+            ENCAR_DETAIL_URL.format(listing_id=listing_id)
+        )
+        if response.status_code != 200:
+            return None
+        return response.json()
+
+
+class KBChaChaChaAdapter(PlatformAdapter):
+    """KBChaChaCha: справочник из JSON-эндпоинтов, поиск по HTML списка"""
+
+    name = "kbchachacha"
+    node_keys = ("makerCode", "classCode", "carCode", "modelCode")
+
+    def manufacturers(self):
+        url = f"{KBCHACHACHA_URL}/search/carMaker.json?page=1&sort=-orderDate"
+        try:
+            data = self.client.get(url).json()
+            # Получаем список как импортных (수입), так и корейских (국산) производителей
+            import_manufacturers = data.get("result", {}).get("수입", [])
+            korean_manufacturers = data.get("result", {}).get("국산", [])
+            manufacturers = korean_manufacturers + import_manufacturers
+            manufacturers.sort(key=lambda x: x.get("makerName", ""))
+            return manufacturers
+        except Exception as e:
+            print("Ошибка при получении марок из KbChaChaCha:", e)
+            return []
+
+    def models(self, maker_code):
+        url = f"{KBCHACHACHA_URL}/search/carClass.json?makerCode={maker_code}&page=1&sort=-orderDate"
+        try:
+            models = self.client.get(url).json().get("result", {}).get("code", [])
+            models.sort(key=lambda x: x.get("className", ""))
+            return models
+        except Exception as e:
+            print(f"Ошибка при получении моделей с KbChaChaCha для {maker_code}:", e)
+            return []
+
+    def generations(self, maker_code, class_code):
+        url = f"{KBCHACHACHA_URL}/search/carName.json?makerCode={maker_code}&page=1&sort=-orderDate&classCode={class_code}"
+        try:
+            data = self.client.get(url).json()
+            generations = data.get("result", {}).get("code", [])
+            generations.sort(key=lambda x: x.get("carOrder", 999))
+            return generations
+        except Exception as e:
+            print(
+                f"Ошибка при получении поколений с KbChaChaCha для {maker_code}/{class_code}:",
+                e,
+            )
+            return []
+
+    def trims(self, maker_code, class_code, car_code):
+        url = f"{KBCHACHACHA_URL}/search/carModel.json?makerCode={maker_code}&page=1&sort=-orderDate&classCode={class_code}&carCode={car_code}"
+        try:
+            data = self.client.get(url).json()
+            trims = data.get("result", {}).get("codeModel", [])
+            trims.sort(key=lambda x: x.get("modelOrder", 999))
+            return trims
+        except Exception as e:
+            print(
+                f"Ошибка при получении конфигураций с KbChaChaCha для {maker_code}/{class_code}/{car_code}:",
+                e,
+            )
+            return []
+
+    def search(
+        self,
+        maker_code,
+        class_code,
+        car_code,
+        model_code,
+        year_from=None,
+        year_to=None,
+        mileage_from=None,
+        mileage_to=None,
+        color_code=None,
+    ):
+        """
+        Первые SEARCH_RESULTS_LIMIT объявлений из HTML списка. Возвращает
+        словари с полями title, year, mileage, region, price, link, img_url
+        и car_seq — как на сайте, без перевода.
+        """
+        url = f"{KBCHACHACHA_URL}/search/list.empty?makerCode={maker_code}&page=1&sort=-orderDate&classCode={class_code}&carCode={car_code}&modelCode={model_code}"
+
+        # Добавляем дополнительные параметры, если они указаны
+        if year_from and year_to:
+            url += f"&regiDay={year_from},{year_to}"
+
+        if mileage_from is not None and mileage_to is not None:
+            url += f"&km={mileage_from},{mileage_to}"
+
+        if color_code:
+            url += f"&color={color_code}"
+
+        print(f"DEBUG: Отправка запроса на URL: {url}")
+        response = self.client.get(url)
+        soup = BeautifulSoup(response.text, "html.parser")
+
+        results = []
+        for area in soup.select("div.list-in.type-wd-list div.area")[
+            :SEARCH_RESULTS_LIMIT
+        ]:
+            try:
+                car_seq = area.get("data-car-seq", "")
+                car_title = area.select_one("div.con div.item strong.tit")
+
+                # Год, пробег и регион
+                data_line = area.select_one("div.con div.item div.data-line")
+                details = (
+                    [span.text.strip() for span in data_line.select("span")]
+                    if data_line
+                    else []
+                )
+
+                price_elem = area.select_one(
+                    "div.con div.item div.sort-wrap strong.pay span.price"
+                )
+                img_elem = area.select_one("div.thumnail a.item span.item__img img")
+
+                results.append(
+                    {
+                        "car_seq": car_seq,
+                        "title": car_title.text.strip() if car_title else "Неизвестно",
+                        "year": details[0] if len(details) > 0 else "Неизвестно",
+                        "mileage": details[1] if len(details) > 1 else "Неизвестно",
+                        "region": details[2] if len(details) > 2 else "Неизвестно",
+                        "price": (
+                            price_elem.text.strip() if price_elem else "Неизвестно"
+                        ),
+                        "link": f"{KBCHACHACHA_URL}/car/detail.kbc?carSeq={car_seq}",
+                        "img_url": img_elem.get("src", "") if img_elem else "",
+                    }
+                )
+            except Exception as e:
+                print(f"Ошибка при парсинге автомобиля: {e}")
+                continue
+
+        return results
+
+
+class KCarAdapter(PlatformAdapter):
+    """KCar: справочник из API группировок, поиск по HTML страницы поиска"""
+
+    name = "kcar"
+    node_keys = ("mnuftrCd", "modelGrpCd", "modelCd", "grdCd")
+
+    def _group(self, group, **conditions):
+        payload = dict(KCAR_BASE_PAYLOAD, **conditions)
+        response = self.client.post(f"{KCAR_API_URL}/{group}", json=payload)
+        return response.json().get("data", [])
+
+    @staticmethod
+    def _available(items):
+        # Оставляем только позиции, которые реально есть в продаже, популярные первыми
+        items = [item for item in items if item.get("count", 0) > 0]
+        items.sort(key=lambda x: x.get("count", 0), reverse=True)
+        return items
+
+    def manufacturers(self):
+        try:
+            manufacturers = self._group("mnuftr")
+            manufacturers.sort(key=lambda x: x.get("mnuftrEnm", ""))
+            return manufacturers
+        except Exception as e:
+            print("Ошибка при получении марок из KCar:", e)
+            return []
+
+    def models(self, maker_code):
+        try:
+            models = self._group("modelGrp", wr_eq_mnuftr_cd=maker_code)
+            models.sort(key=lambda x: x.get("modelGrpNm", ""))
+            return [model for model in models if model.get("count", 0) > 0]
+        except Exception as e:
+            print(f"Ошибка при получении моделей с KCar для {maker_code}:", e)
+            return []
+
+    def generations(self, maker_code, model_code):
+        try:
+            return self._available(
+                self._group(
+                    "model", wr_eq_mnuftr_cd=maker_code, wr_eq_model_grp_cd=model_code
+                )
+            )
+        except Exception as e:
+            print(
+                f"Ошибка при получении поколений с KCar для {maker_code}/{model_code}:",
+                e,
+            )
+            return []
+
+    def trims(self, maker_code, model_group_code, model_code):
+        try:
+            return self._available(
+                self._group(
+                    "grd",
+                    wr_eq_mnuftr_cd=maker_code,
+                    wr_eq_model_grp_cd=model_group_code,
+                    wr_eq_model_cd=model_code,
+                )
+            )
+        except Exception as e:
+            print(
+                f"Ошибка при получении конфигураций с KCar для {maker_code}/{model_group_code}/{model_code}:",
+                e,
+            )
+            return []
+
+    def search(
+        self,
+        mnuftr_cd,
+        model_grp_cd,
+        model_cd,
+        year_from=None,
+        year_to=None,
+        mileage_from=None,
+        mileage_to=None,
+        color=None,
+    ):
+        """
+        Первые SEARCH_RESULTS_LIMIT объявлений со страницы поиска.
+        Возвращает словари с полями title, price, year, mileage, fuel_type,
+        location, description, link, img_url и labels — как на сайте, без
+        перевода. color — корейское название цвета кузова.
+        """
+        search_cond = {
+            "wr_eq_mnuftr_cd": mnuftr_cd,
+            "wr_eq_model_grp_cd": model_grp_cd,
+            "wr_eq_model_cd": model_cd,
+        }
+        if year_from and year_to:
+            search_cond["wr_bt_prdcn_year"] = f"{year_from},{year_to}"
+        if mileage_from is not None and mileage_to is not None:
+            search_cond["wr_bt_accent_km"] = f"{mileage_from},{mileage_to}"
+        if color:
+            search_cond["wr_eq_extl_color_nm"] = color
+
+        url = KCAR_SEARCH_URL.format(
+            search_cond=urllib.parse.quote(json.dumps(search_cond))
+        )
+        print(f"DEBUG: Отправка запроса на URL: {url}")
+        response = self.client.get(url)
+
+        if response.status_code != 200:
+            print(f"Ошибка при получении страницы: {response.status_code}")
+            return []
+
+        soup = BeautifulSoup(response.text, "html.parser")
+
+        car_list_wrap = soup.select_one("div.carListWrap")
+        if not car_list_wrap:
+            print("Не найден блок с автомобилями (div.carListWrap)")
+            return []
+
+        car_list_boxes = car_list_wrap.select("div.carListBox")
+        if not car_list_boxes:
+            print("Не найдены блоки с автомобилями (div.carListBox)")
+            if car_list_wrap.select_one("div.empty-car-list"):
+                print("Найдено сообщение о пустых результатах")
+            return []
+
+        print(f"DEBUG: Найдено {len(car_list_boxes)} автомобилей")
+
+        results = []
+        for box in car_list_boxes[:SEARCH_RESULTS_LIMIT]:
+            try:
+                car_name_elem = box.select_one("div.carName p.carTit a")
+                car_name = car_name_elem.text.strip() if car_name_elem else "Неизвестно"
+
+                car_link = car_name_elem.get("href", "") if car_name_elem else ""
+                if car_link:
+                    car_link = f"https://www.kcar.com{car_link}"
+
+                car_exp_elem = box.select_one("div.carExpIn p.carExp")
+
+                # Год, пробег, тип топлива и площадка
+                car_details_elem = box.select_one("p.detailCarCon")
+                car_details = (
+                    [span.text.strip() for span in car_details_elem.select("span")]
+                    if car_details_elem
+                    else []
+                )
+
+                # Относительную ссылку на изображение дополняем доменом
+                img_elem = box.select_one("div.carListImg a img")
+                img_url = img_elem.get("src", "") if img_elem else ""
+                if img_url and not img_url.startswith(("http://", "https://")):
+                    img_url = f"https://www.kcar.com{img_url}"
+
+                car_desc_elem = box.select_one("div.carSimcDesc")
+
+                # Дополнительные метки (доставка, 360° и специальные опции)
+                labels = []
+                if box.select_one("span.stateDlvy"):
+                    labels.append("Бесплатная доставка")
+                if box.select_one("span.car360Img"):
+                    labels.append("360° обзор")
+                for option in box.select("ul.infoTooltip li button"):
+                    if option.text.strip():
+                        labels.append(option.text.strip())
+
+                results.append(
+                    {
+                        "title": car_name,
+                        "price": (
+                            car_exp_elem.text.strip() if car_exp_elem else "Неизвестно"
+                        ),
+                        "year": (
+                            car_details[0] if len(car_details) > 0 else "Неизвестно"
+                        ),
+                        "mileage": (
+                            car_details[1] if len(car_details) > 1 else "Неизвестно"
+                        ),
+                        "fuel_type": (
+                            car_details[2] if len(car_details) > 2 else "Неизвестно"
+                        ),
+                        "location": (
+                            car_details[3] if len(car_details) > 3 else "Неизвестно"
+                        ),
+                        "description": (
+                            car_desc_elem.text.strip() if car_desc_elem else ""
+                        ),
+                        "link": car_link,
+                        "img_url": img_url,
+                        "labels": labels,
+                    }
+                )
+                print(f"DEBUG: Успешно обработан автомобиль {car_name}")
+            except Exception as e:
+                print(f"Ошибка при парсинге автомобиля: {e}")
+                continue
+
+        return results
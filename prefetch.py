@@ -0,0 +1,113 @@
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Prefetcher:
+    """
+    Упреждающая загрузка следующего шага мастера.
+
+    Пока пользователь выбирает из списка (например, моделей марки),
+    в фоне прогреваются кэши для самых вероятных вариантов следующего
+    шага. Вероятность — как часто вариант встречается в сохранённых
+    запросах пользователей. Чтобы прогрев не умножал нагрузку на
+    площадку, у каждого пользователя есть бюджет: не больше budget
+    загрузок за window секунд.
+
+    Args:
+        loaders: Словарь глубина -> функция шага; функция глубины d
+            принимает путь из d элементов (марка, модель, ...)
+        top_n: Сколько самых популярных вариантов прогревать за шаг
+        budget: Сколько загрузок разрешено одному пользователю за окно
+        window: Окно бюджета, в секундах
+        workers: Сколько загрузок выполнять одновременно
+        is_warm: Необязательная проверка path -> bool: данные уже в памяти,
+            загружать не нужно
+    """
+
+    def __init__(self, loaders, top_n=3, budget=10, window=60, workers=2, is_warm=None):
+        self.loaders = loaders
+        self.top_n = top_n
+        self.budget = budget
+        self.window = window
+        self.is_warm = is_warm
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="prefetch"
+        )
+        self._frequencies = {}  # путь -> Counter следующих выборов
+        self._spent = {}  # user_id -> deque времени загрузок
+        self._lock = threading.Lock()
+
+    def rebuild(self, paths):
+        """Пересчитывает частоты выбора по путям сохранённых запросов"""
+        frequencies = {}
+        for path in paths:
+            for depth in range(len(path)):
+                parent = tuple(path[:depth])
+                frequencies.setdefault(parent, Counter())[path[depth]] += 1
+        with self._lock:
+            self._frequencies = frequencies
+
+    def record(self, path):
+        """Учитывает новый сохранённый запрос"""
+        with self._lock:
+            for depth in range(len(path)):
+                parent = tuple(path[:depth])
+                self._frequencies.setdefault(parent, Counter())[path[depth]] += 1
+
+    def _take_budget(self, user_id, now):
+        spent = self._spent.get(user_id)
+        if spent is None:
+            spent = self._spent[user_id] = deque()
+        while spent and now - spent[0] >= self.window:
+            spent.popleft()
+        if len(spent) >= self.budget:
+            return False
+        spent.append(now)
+        return True
+
+    def _trim_budgets(self, now):
+        # Пользователи, чьё окно бюджета истекло, больше не занимают память
+        expired = [
+            user_id
+            for user_id, spent in self._spent.items()
+            if not spent or now - spent[-1] >= self.window
+        ]
+        for user_id in expired:
+            del self._spent[user_id]
+
+    def after_step(self, user_id, path):
+        """
+        Вызывается после показа шага мастера с выбранным путём path:
+        прогревает следующий шаг для top_n самых частых вариантов.
+        """
+        loader = self.loaders.get(len(path) + 1)
+        if loader is None:
+            return
+
+        path = tuple(path)
+        now = time.monotonic()
+        with self._lock:
+            self._trim_budgets(now)
+            counter = self._frequencies.get(path)
+            if not counter:
+                return
+            candidates = []
+            for choice, _ in counter.most_common(self.top_n):
+                next_path = path + (choice,)
+                if self.is_warm is not None and self.is_warm(next_path):
+                    continue
+                if not self._take_budget(user_id, now):
+                    break
+                candidates.append(next_path)
+
+        for next_path in candidates:
+            self._executor.submit(self._load, loader, next_path)
+
+    @staticmethod
+    def _load(loader, path):
+        try:
+            loader(*path)
+        except Exception as e:
+            print(f"⚠️ Ошибка упреждающей загрузки {path}: {e}")
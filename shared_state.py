@@ -0,0 +1,61 @@
+import threading
+import zlib
+from collections import OrderedDict
+
+
+class StripedLock:
+    """
+    Набор блокировок, выбираемых по ключу (user_id, Id автомобиля и т.п.).
+
+    Операции над одним ключом выполняются по очереди, а над разными
+    ключами — параллельно (кроме редких совпадений полосы), поэтому
+    обработчики разных пользователей не ждут друг друга на одной
+    глобальной блокировке.
+
+    Args:
+        stripes: Количество полос (отдельных блокировок)
+    """
+
+    def __init__(self, stripes=64):
+        self._locks = [threading.RLock() for _ in range(stripes)]
+
+    def __call__(self, key):
+        # crc32 вместо hash(): стабильно между процессами и для строк, и для чисел
+        index = zlib.crc32(str(key).encode("utf-8")) % len(self._locks)
+        return self._locks[index]
+
+
+def snapshot_dict(data):
+    """
+    Копия словаря для сериализации в JSON, пока другие потоки его меняют.
+    dict.copy() и list(...) выполняются атомарно под GIL, так что
+    json.dump не упадёт с "dictionary changed size during iteration".
+    """
+    return {
+        key: list(value) if isinstance(value, list) else value
+        for key, value in data.copy().items()
+    }
+
+
+class BoundedDict(OrderedDict):
+    """
+    Словарь с ограничением размера: при записи ключ становится самым
+    свежим, а при превышении max_size удаляются самые старые записи.
+    Подходит для кэшей по Id объявлений, которые иначе растут всё время
+    работы бота.
+
+    Args:
+        max_size: Сколько записей хранить
+    """
+
+    def __init__(self, max_size):
+        super().__init__()
+        self.max_size = max_size
+        self._lock = threading.RLock()
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            super().__setitem__(key, value)
+            self.move_to_end(key)
+            while len(self) > self.max_size:
+                self.popitem(last=False)
@@ -0,0 +1,415 @@
+import functools
+import json
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Объединение одинаковых одновременных запросов (singleflight).
+
+    Если несколько потоков одновременно запрашивают один и тот же ключ
+    (например, список моделей одной марки), запрос к площадке выполняет
+    только первый из них, а остальные ждут и получают тот же результат
+    (или то же исключение). Как только запрос завершился, ключ
+    освобождается — следующий вызов снова идёт к площадке.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        """Выполняет func(*args, **kwargs) или ждёт уже идущий вызов с тем же key"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def coalesce(self, func):
+        """Декоратор: одновременные вызовы func с одинаковыми аргументами объединяются"""
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = (func.__qualname__, args, tuple(sorted(kwargs.items())))
+            return self.do(key, func, *args, **kwargs)
+
+        return wrapper
+
+
+class TaxonomyCache:
+    """
+    Кэш справочников площадок (марки, модели, поколения, комплектации)
+    с семантикой stale-while-revalidate.
+
+    Свежее значение (моложе ttl) отдаётся сразу. Устаревшее — тоже
+    отдаётся сразу, а в фоне запускается обновление; ждать площадку
+    приходится только при первом обращении к ключу. Пустой ответ
+    (getter вернул [] из-за ошибки площадки) не кэшируется и не
+    затирает уже сохранённые данные. Загрузки одного ключа объединяются
+    через SingleFlight, а фоновые обновления идут в небольшом общем пуле
+    потоков: каждый ключ ставится в очередь не больше одного раза.
+
+    Кэш сохраняется в JSON-файл (не чаще раза в save_interval секунд)
+    и читается при запуске, поэтому после перезапуска шаги мастера
+    сразу отвечают из кэша.
+
+    Args:
+        path: Файл снимка кэша (None — без сохранения на диск)
+        ttl: Через сколько секунд значение считается устаревшим
+        save_interval: Минимальный интервал между сохранениями, в секундах
+        flight: SingleFlight для объединения загрузок
+        refresh_workers: Сколько фоновых обновлений выполнять одновременно
+    """
+
+    def __init__(
+        self,
+        path=None,
+        ttl=6 * 60 * 60,
+        save_interval=60,
+        flight=None,
+        refresh_workers=2,
+    ):
+        self.path = path
+        self.ttl = ttl
+        self.save_interval = save_interval
+        self.flight = flight or SingleFlight()
+        self._entries = {}  # ключ -> (время загрузки, значение)
+        self._refreshing = set()
+        self._refresher = ThreadPoolExecutor(
+            max_workers=refresh_workers, thread_name_prefix="taxonomy-refresh"
+        )
+        self._lock = threading.Lock()
+        self._save_timer = None
+
+    def get(self, key, loader):
+        """Значение по ключу; loader() вызывается при промахе или в фоне для обновления"""
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None:
+            return self._load(key, loader)
+
+        loaded_at, value = entry
+        if time.time() - loaded_at >= self.ttl:
+            self._refresh_in_background(key, loader)
+        return value
+
+    def cached(self, func, name=None):
+        """
+        Обёртка getter-а справочника; ключ — name (по умолчанию имя
+        функции) и аргументы.
+        """
+        name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            return self.get(self._key(name, args), lambda: func(*args))
+
+        return wrapper
+
+    def fetched(self, func, name=None):
+        """
+        Обёртка getter-а, которая всегда идёт на площадку (минуя свежесть
+        кэша) и записывает ответ в кэш под тем же ключом, что и cached().
+        Для фонового обхода справочника, которому нужны актуальные данные.
+        """
+        name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            return self._load(self._key(name, args), lambda: func(*args))
+
+        return wrapper
+
+    @staticmethod
+    def _key(name, args):
+        return "|".join([name, *map(str, args)])
+
+    def _load(self, key, loader):
+        value = self.flight.do(key, loader)
+        if value:
+            self._store(key, value)
+        return value
+
+    def _refresh_in_background(self, key, loader):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        self._refresher.submit(self._refresh, key, loader)
+
+    def _refresh(self, key, loader):
+        try:
+            self._load(key, loader)
+        except Exception as e:
+            print(f"⚠️ Не удалось обновить справочник {key}: {e}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def _store(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            if self.path is None:
+                return
+            if self._save_timer is None:
+                self._save_timer = threading.Timer(self.save_interval, self.save)
+                self._save_timer.daemon = True
+                self._save_timer.start()
+
+    def save(self):
+        """Записывает снимок кэша на диск (через временный файл)"""
+        with self._lock:
+            self._save_timer = None
+            entries = dict(self._entries)
+        if self.path is None:
+            return
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entries, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f"⚠️ Ошибка при сохранении {self.path}: {e}")
+
+    def load(self):
+        """Читает снимок кэша с диска; записи сохраняют своё время загрузки"""
+        if self.path is None or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except Exception as e:
+            print(f"⚠️ Не удалось загрузить {self.path}: {e}")
+            return
+        with self._lock:
+            for key, (loaded_at, value) in entries.items():
+                self._entries.setdefault(key, (loaded_at, value))
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+class TaxonomyIndex:
+    """
+    Полное дерево справочника площадки (марка → модель → поколение →
+    комплектация) в памяти, собранное фоновым обходом.
+
+    Каждый уровень дерева регистрируется декоратором level(depth):
+    функция уровня принимает путь от корня (например, марку и модель)
+    и возвращает список узлов-детей, а поле node_key узла становится
+    следующим элементом пути. Пока путь есть в индексе, вызов отвечает
+    из памяти без запроса к площадке; иначе вызывается сама функция
+    (обычно через кэш). Обход использует отдельную функцию crawl, которая
+    всегда идёт на площадку, — иначе обход читал бы устаревшие значения
+    кэша. Обход идёт сразу по нескольким веткам, но не больше concurrency
+    запросов одновременно.
+
+    Обход инкрементальный: если узел не изменился с прошлого обхода
+    (включая число объявлений), его поддерево не перезапрашивается.
+    Полный обход выполняется раз в full_every обходов.
+
+    В индексе узлы хранятся без вложенных Refinements — только
+    DisplayValue, Count, Metadata (EngName, ModelStartDate,
+    ModelEndDate, ...) и т. п.
+
+    Args:
+        concurrency: Сколько запросов обхода выполнять одновременно
+        node_key: Поле узла, образующее путь к его детям (по умолчанию
+            для всех уровней)
+        strip_keys: Поля узла, которые не сохраняются в индексе
+    """
+
+    def __init__(
+        self, concurrency=4, node_key="DisplayValue", strip_keys=("Refinements",)
+    ):
+        self.concurrency = concurrency
+        self.node_key = node_key
+        self.strip_keys = strip_keys
+        self._loaders = {}
+        self._node_keys = {}
+        self._children = {}  # путь -> список узлов-детей
+        self._nodes = {}  # путь -> узел
+
+    def level(self, depth, node_key=None, crawl=None):
+        """
+        Декоратор функции уровня depth (0 — корень, путь из depth
+        элементов); node_key переопределяет поле пути для этого уровня,
+        crawl — функция загрузки уровня для обхода (по умолчанию сама
+        функция уровня).
+        """
+
+        def decorator(func):
+            self._loaders[depth] = crawl or func
+            self._node_keys[depth] = node_key or self.node_key
+
+            @functools.wraps(func)
+            def wrapper(*path):
+                children = self._children.get(path)
+                if children is not None:
+                    return children
+                return func(*path)
+
+            return wrapper
+
+        return decorator
+
+    def children(self, *path):
+        """Дети узла по пути или None, если ветка ещё не обойдена"""
+        return self._children.get(path)
+
+    def node(self, *path):
+        """Узел по пути от корня или None"""
+        return self._nodes.get(path)
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def _strip(self, node):
+        return {k: v for k, v in node.items() if k not in self.strip_keys}
+
+    def _child_path(self, path, node):
+        return path + (node.get(self._node_keys[len(path)]),)
+
+    def crawl(self, full=False):
+        """
+        Обходит дерево и атомарно подменяет индекс. Узлы, пропавшие из
+        ответа площадки, удаляются вместе с поддеревом. Ветки, которые не
+        удалось загрузить (пустой ответ или ошибка), остаются из прошлого
+        обхода.
+
+        Returns:
+            Кортеж (число узлов, запрошено веток, пропущено из-за ошибок)
+        """
+        previous_children = self._children
+        children = dict(previous_children)
+        nodes = dict(self._nodes)
+        depth_count = len(self._loaders)
+        fetched = failed = 0
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            pending = {pool.submit(self._loaders[0]): ()}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path = pending.pop(future)
+                    fetched += 1
+                    try:
+                        items = future.result()
+                    except Exception as e:
+                        print(f"⚠️ Ошибка обхода справочника {path}: {e}")
+                        items = None
+                    if not items:
+                        failed += 1
+                        continue
+
+                    level_nodes = [self._strip(item) for item in items]
+                    # Узлы, которых больше нет на площадке, удаляются вместе
+                    # с поддеревом — иначе мастер предлагал бы их вечно
+                    current = {self._child_path(path, item) for item in level_nodes}
+                    for item in children.get(path) or ():
+                        child_path = self._child_path(path, item)
+                        if child_path not in current:
+                            self._drop_subtree(children, nodes, child_path)
+                    children[path] = level_nodes
+                    for item in level_nodes:
+                        child_path = self._child_path(path, item)
+                        unchanged = nodes.get(child_path) == item
+                        nodes[child_path] = item
+                        if len(child_path) >= depth_count:
+                            continue
+                        # Узел не изменился — поддерево берём из прошлого обхода
+                        if not full and unchanged and child_path in previous_children:
+                            continue
+                        future = pool.submit(
+                            self._loaders[len(child_path)], *child_path
+                        )
+                        pending[future] = child_path
+
+        self._children = children
+        self._nodes = nodes
+        return len(nodes), fetched, failed
+
+    @staticmethod
+    def _drop_subtree(children, nodes, path):
+        depth = len(path)
+        for mapping in (children, nodes):
+            for key in [key for key in mapping if key[:depth] == path]:
+                del mapping[key]
+
+    def export(self):
+        """Индекс в виде списка [путь, дети] для сохранения в снимок"""
+        return [[list(path), items] for path, items in self._children.items()]
+
+    def restore(self, entries):
+        """Загружает индекс из export(); узлы восстанавливаются по путям"""
+        children, nodes = {}, {}
+        for path, items in entries:
+            path = tuple(path)
+            children[path] = items
+            if len(path) in self._node_keys:
+                for item in items:
+                    nodes[self._child_path(path, item)] = item
+        self._children = children
+        self._nodes = nodes
+
+    def start(self, interval=24 * 60 * 60, full_every=7, on_update=None):
+        """
+        Запускает фоновый обход: сразу и затем раз в interval секунд.
+        on_update вызывается после каждого обхода.
+        """
+
+        def run():
+            crawls = 0
+            while True:
+                started = time.monotonic()
+                try:
+                    # Первый обход инкрементальный: если индекс загружен
+                    # из снимка, перезапрашиваются только изменившиеся ветки
+                    full = crawls > 0 and crawls % full_every == 0
+                    count, fetched, failed = self.crawl(full=full)
+                    print(
+                        f"🌳 Справочник проиндексирован: {count} узлов, "
+                        f"запрошено веток {fetched}, с ошибкой {failed}, "
+                        f"{time.monotonic() - started:.0f} с"
+                    )
+                    if on_update is not None:
+                        on_update()
+                except Exception as e:
+                    print(f"⚠️ Ошибка индексации справочника: {e}")
+                crawls += 1
+                time.sleep(interval)
+
+        threading.Thread(target=run, daemon=True).start()
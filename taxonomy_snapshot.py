@@ -0,0 +1,95 @@
+import json
+import mmap
+import os
+import struct
+import time
+
+from upstream import json_loads
+
+try:
+    import msgpack
+except ImportError:  # без msgpack снимок пишется и читается в JSON
+    msgpack = None
+
+SNAPSHOT_MAGIC = b"TAXS"
+SNAPSHOT_VERSION = 1
+
+FORMAT_JSON = 0
+FORMAT_MSGPACK = 1
+
+# Заголовок: магия, версия формата, кодировка данных, время создания
+_HEADER = struct.Struct("<4sBBd")
+
+
+def write_snapshot(path, indexes):
+    """
+    Сохраняет справочники площадок в один файл снимка.
+
+    Файл — заголовок фиксированного размера и данные в msgpack (он в
+    requirements.txt) или, если пакета нет, в JSON. Запись атомарная:
+    через временный файл.
+
+    Args:
+        path: Путь к файлу снимка
+        indexes: Словарь имя площадки -> TaxonomyIndex
+
+    Returns:
+        Размер снимка в байтах
+    """
+    data = {name: index.export() for name, index in indexes.items()}
+    if msgpack is not None:
+        payload, encoding = msgpack.packb(data, use_bin_type=True), FORMAT_MSGPACK
+    else:
+        payload = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+        payload, encoding = payload.encode("utf-8"), FORMAT_JSON
+
+    header = _HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, encoding, time.time())
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(header)
+        f.write(payload)
+    os.replace(tmp_path, path)
+    return len(header) + len(payload)
+
+
+def read_snapshot(path, indexes):
+    """
+    Загружает снимок в индексы площадок.
+
+    Файл отображается в память (mmap): msgpack разбирается прямо из
+    отображения, без чтения файла в буфер; запасной JSON-вариант
+    копируется в bytes перед разбором. Снимок другой версии или с
+    неизвестной кодировкой пропускается.
+
+    Args:
+        path: Путь к файлу снимка
+        indexes: Словарь имя площадки -> TaxonomyIndex
+
+    Returns:
+        Время создания снимка (unix time) или None, если снимок не загружен
+    """
+    if not os.path.exists(path) or os.path.getsize(path) <= _HEADER.size:
+        return None
+
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        magic, version, encoding, created_at = _HEADER.unpack(m[: _HEADER.size])
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            print(f"⚠️ Снимок справочников {path} другой версии, пропускаем")
+            return None
+
+        payload = memoryview(m)[_HEADER.size :]
+        try:
+            if encoding == FORMAT_MSGPACK and msgpack is not None:
+                data = msgpack.unpackb(payload, raw=False)
+            elif encoding == FORMAT_JSON:
+                data = json_loads(bytes(payload))
+            else:
+                print(f"⚠️ Снимок справочников {path}: не поддерживается кодировка")
+                return None
+        finally:
+            payload.release()
+
+    for name, index in indexes.items():
+        if name in data:
+            index.restore(data[name])
+    return created_at
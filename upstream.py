@@ -0,0 +1,190 @@
+import importlib.util
+import json
+import threading
+import time
+from collections import deque
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:  # orjson необязателен: без него работает стандартный json
+    orjson = None
+
+BROWSER_USER_AGENT = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+)
+
+# Сжатие ответов: br запрашиваем, только если установлен пакет brotli
+# (он в requirements.txt) — иначе ответ не удалось бы распаковать
+ACCEPT_ENCODING = (
+    "gzip, deflate, br"
+    if importlib.util.find_spec("brotli") or importlib.util.find_spec("brotlicffi")
+    else "gzip, deflate"
+)
+
+
+def json_loads(raw):
+    """Разбор JSON из bytes или str: orjson, если установлен, иначе json"""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+# Заголовки по умолчанию для каждой площадки
+PLATFORM_HEADERS = {
+    "encar": {"User-Agent": "Mozilla/5.0"},
+    "kbchachacha": {"User-Agent": BROWSER_USER_AGENT},
+    "kcar": {"User-Agent": BROWSER_USER_AGENT},
+}
+
+# Какой площадке принадлежит хост
+HOST_PLATFORMS = {
+    "encar-proxy.habsida.net": "encar",
+    "api.encar.com": "encar",
+    "www.kbchachacha.com": "kbchachacha",
+    "api.kcar.com": "kcar",
+    "www.kcar.com": "kcar",
+}
+
+
+class LatencyMetrics:
+    """
+    Задержки запросов по хостам: число запросов, ошибок и перцентили
+    по последним sample_size замерам.
+
+    Args:
+        sample_size: Сколько последних замеров хранить на хост
+    """
+
+    def __init__(self, sample_size=500):
+        self.sample_size = sample_size
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def record(self, host, elapsed, error=False):
+        with self._lock:
+            stats = self._hosts.get(host)
+            if stats is None:
+                stats = {
+                    "count": 0,
+                    "errors": 0,
+                    "samples": deque(maxlen=self.sample_size),
+                }
+                self._hosts[host] = stats
+            stats["count"] += 1
+            if error:
+                stats["errors"] += 1
+            stats["samples"].append(elapsed)
+
+    def snapshot(self):
+        """Сводка по хостам: count, errors, p50, p95, max (в секундах)"""
+        with self._lock:
+            hosts = {
+                host: (stats["count"], stats["errors"], sorted(stats["samples"]))
+                for host, stats in self._hosts.items()
+            }
+        summary = {}
+        for host, (count, errors, samples) in hosts.items():
+            if not samples:
+                continue
+            summary[host] = {
+                "count": count,
+                "errors": errors,
+                "p50": samples[len(samples) // 2],
+                "p95": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+                "max": samples[-1],
+            }
+        return summary
+
+
+class UpstreamClient:
+    """
+    Общий HTTP-клиент для всех площадок.
+
+    На каждый хост — своя requests.Session с пулом keep-alive соединений,
+    поэтому повторные запросы не делают новый TCP/TLS-handshake. Заголовки
+    площадки подставляются автоматически, у каждого запроса есть таймауты
+    на соединение и чтение, а задержки собираются в LatencyMetrics и
+    периодически выводятся в лог.
+
+    Args:
+        connect_timeout: Таймаут установки соединения, в секундах
+        read_timeout: Таймаут чтения ответа, в секундах
+        pool_size: Сколько соединений держать на хост
+        retries: Сколько раз повторять запрос при ошибке соединения
+        log_interval: Как часто выводить сводку задержек, в секундах
+    """
+
+    def __init__(
+        self,
+        connect_timeout=5,
+        read_timeout=20,
+        pool_size=20,
+        retries=2,
+        log_interval=600,
+    ):
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_size = pool_size
+        self.retries = retries
+        self.log_interval = log_interval
+        self.metrics = LatencyMetrics()
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._last_log = time.monotonic()
+
+    def _session(self, host):
+        session = self._sessions.get(host)
+        if session is not None:
+            return session
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                platform = HOST_PLATFORMS.get(host)
+                session.headers["Accept-Encoding"] = ACCEPT_ENCODING
+                session.headers.update(PLATFORM_HEADERS.get(platform, {}))
+                # Повторяем только сбои соединения: запрос ещё не дошёл до сервера
+                retry = Retry(total=self.retries, connect=self.retries, read=0)
+                adapter = HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry
+                )
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._sessions[host] = session
+        return session
+
+    def request(self, method, url, **kwargs):
+        host = urlsplit(url).hostname
+        kwargs.setdefault("timeout", self.timeout)
+        started = time.monotonic()
+        error = True
+        try:
+            response = self._session(host).request(method, url, **kwargs)
+            error = response.status_code >= 500
+            return response
+        finally:
+            self.metrics.record(host, time.monotonic() - started, error)
+            self._maybe_log()
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def _maybe_log(self):
+        now = time.monotonic()
+        if now - self._last_log < self.log_interval:
+            return
+        self._last_log = now
+        for host, stats in self.metrics.snapshot().items():
+            print(
+                f"📈 {host}: {stats['count']} запросов, ошибок {stats['errors']}, "
+                f"p50 {stats['p50']:.2f} с, p95 {stats['p95']:.2f} с, "
+                f"max {stats['max']:.2f} с"
+            )
@@ -0,0 +1,138 @@
+import hmac
+import queue
+import threading
+
+import uvicorn
+from fastapi import FastAPI, Request, Response
+from telebot import types
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class UpdateDispatcher:
+    """
+    Ограниченная очередь входящих обновлений между HTTP-обработчиком
+    вебхука и обработчиками бота.
+
+    Вебхук только кладёт обновление в очередь и сразу отвечает Telegram,
+    а один поток передаёт обновления в bot.process_new_updates — те же
+    обработчики, что и при long polling. Поток один, чтобы обновления
+    шли в порядке поступления: параллельность по пользователям даёт
+    KeyedExecutor бота, который сохраняет порядок для каждого из них.
+    Если очередь переполнена, вебхук отвечает 503 и Telegram повторит
+    доставку позже.
+
+    Args:
+        bot: Экземпляр TeleBot с зарегистрированными обработчиками
+        max_pending: Максимальный размер очереди
+    """
+
+    def __init__(self, bot, max_pending=1000):
+        self.bot = bot
+        self._queue = queue.Queue(maxsize=max_pending)
+        threading.Thread(target=self._worker, name="webhook", daemon=True).start()
+
+    def submit(self, update):
+        """Ставит обновление в очередь. False — очередь переполнена"""
+        try:
+            self._queue.put_nowait(update)
+            return True
+        except queue.Full:
+            return False
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def _worker(self):
+        while True:
+            update = self._queue.get()
+            try:
+                self.bot.process_new_updates([update])
+            except Exception as e:
+                print(f"❌ Ошибка обработки обновления {update.update_id}: {e}")
+            finally:
+                self._queue.task_done()
+
+
+def create_webhook_app(bot, dispatcher, path, secret_token):
+    """
+    Создаёт FastAPI-приложение, принимающее обновления Telegram.
+
+    Args:
+        bot: Экземпляр TeleBot
+        dispatcher: UpdateDispatcher, куда передаются обновления
+        path: Путь вебхука, например /telegram/webhook
+        secret_token: Значение заголовка X-Telegram-Bot-Api-Secret-Token,
+            переданное в setWebhook. Обязательно: без него любой, кто знает
+            адрес, мог бы прислать поддельное обновление от имени менеджера
+
+    Returns:
+        FastAPI: Приложение для uvicorn
+    """
+    if not secret_token:
+        raise ValueError("Для вебхука нужен secret_token (WEBHOOK_SECRET)")
+
+    app = FastAPI(docs_url=None, redoc_url=None, openapi_url=None)
+
+    @app.post(path)
+    async def receive_update(request: Request):
+        received = request.headers.get(SECRET_TOKEN_HEADER, "")
+        if not hmac.compare_digest(received.encode(), secret_token.encode()):
+            return Response(status_code=401)
+
+        try:
+            update = types.Update.de_json(await request.json())
+        except Exception as e:
+            print(f"⚠️ Некорректное обновление в вебхуке: {e}")
+            return Response(status_code=400)
+
+        if not dispatcher.submit(update):
+            print("⚠️ Очередь обновлений переполнена, Telegram повторит доставку")
+            return Response(status_code=503)
+        return Response(status_code=200)
+
+    @app.get("/healthz")
+    async def healthz():
+        return {"ok": True, "pending": dispatcher.pending()}
+
+    return app
+
+
+def run_webhook(
+    bot,
+    url,
+    path="/telegram/webhook",
+    host="0.0.0.0",
+    port=8080,
+    secret_token=None,
+    max_pending=1000,
+    max_connections=40,
+):
+    """
+    Регистрирует вебхук в Telegram и запускает uvicorn (блокирующий вызов).
+
+    Args:
+        bot: Экземпляр TeleBot
+        url: Публичный адрес сервиса (https://example.com), к нему
+            добавляется path
+        path: Путь вебхука
+        host: Адрес, на котором слушает uvicorn
+        port: Порт uvicorn
+        secret_token: Секрет для заголовка X-Telegram-Bot-Api-Secret-Token
+            (обязателен)
+        max_pending: Размер очереди обновлений
+        max_connections: Сколько одновременных соединений разрешить Telegram
+    """
+    dispatcher = UpdateDispatcher(bot, max_pending=max_pending)
+    app = create_webhook_app(bot, dispatcher, path, secret_token)
+
+    bot.remove_webhook()
+    bot.set_webhook(
+        url=url.rstrip("/") + path,
+        secret_token=secret_token,
+        max_connections=max_connections,
+        allowed_updates=["message", "callback_query"],
+    )
+    print(f"🌐 Вебхук зарегистрирован: {url.rstrip('/')}{path}")
+
+    uvicorn.run(app, host=host, port=port, log_level="warning")
@@ -0,0 +1,369 @@
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from telebot.storage.base_storage import StateContext, StateStorageBase
+
+
+class WizardSession(dict):
+    """
+    Данные одного мастера поиска. Ведёт себя как обычный dict, но после
+    каждого изменения сохраняет себя в хранилище — поэтому обработчики
+    продолжают писать в user_search_data[user_id][...] как раньше.
+    """
+
+    def __init__(self, store, key, data=None):
+        super().__init__(data or {})
+        self._store = store
+        self._key = key
+
+    def _persist(self):
+        self._store._persist(self._key, self)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._persist()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._persist()
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._persist()
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def pop(self, key, *args):
+        result = super().pop(key, *args)
+        self._persist()
+        return result
+
+    def clear(self):
+        super().clear()
+        self._persist()
+
+
+class WizardStateStore:
+    """
+    Хранилище состояний мастера поиска с TTL на сессию, ограничением
+    числа сессий в памяти (LRU) и необязательным SQLite-файлом, чтобы
+    незавершённые мастера переживали перезапуск бота.
+
+    Изменения сессий сразу видны в памяти, а в SQLite их пачками пишет
+    отдельный поток (не реже раза в flush_interval секунд). Обработчики
+    не ждут диска и не стоят друг за другом на общей блокировке, пока
+    идёт commit; несколько изменений одной сессии за шаг мастера
+    превращаются в одну запись.
+
+    Args:
+        namespace: Имя набора сессий внутри SQLite-файла
+        ttl: Время жизни сессии без изменений, в секундах
+        max_sessions: Сколько сессий держать в памяти одновременно
+        db_path: Путь к SQLite-файлу или None, чтобы хранить только в памяти
+        sweep_interval: Как часто удалять просроченные сессии, в секундах
+        flush_interval: Как часто записывать изменения в SQLite, в секундах
+    """
+
+    def __init__(
+        self,
+        namespace,
+        ttl=6 * 3600,
+        max_sessions=5000,
+        db_path=None,
+        sweep_interval=300,
+        flush_interval=0.5,
+    ):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.sweep_interval = sweep_interval
+        self.flush_interval = flush_interval
+
+        self._sessions = OrderedDict()  # key -> (WizardSession, updated_at)
+        self._lock = threading.RLock()
+        self._last_sweep = time.time()
+        self._db = None
+        self._db_lock = threading.Lock()
+        # Изменения, ещё не записанные в SQLite: key -> (JSON, updated_at)
+        # или None для удаления; _flushing — пачка, которую пишут сейчас
+        self._pending = {}
+        self._flushing = {}
+        self._sweep_before = None
+        self._wakeup = threading.Event()
+
+        if db_path:
+            self._open_db(db_path)
+        if self._db is not None:
+            threading.Thread(
+                target=self._writer, name=f"wizard-{namespace}", daemon=True
+            ).start()
+            atexit.register(self.flush)
+
+    def _open_db(self, db_path):
+        try:
+            directory = os.path.dirname(db_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            # WAL: запись на каждое изменение не ждёт fsync всего файла
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS wizard_sessions ("
+                "namespace TEXT NOT NULL, key TEXT NOT NULL, data TEXT NOT NULL, "
+                "updated_at REAL NOT NULL, PRIMARY KEY (namespace, key))"
+            )
+            self._db.commit()
+        except Exception as e:
+            print(f"⚠️ Не удалось открыть {db_path}, состояния только в памяти: {e}")
+            self._db = None
+
+    def _is_expired(self, updated_at, now=None):
+        return (now or time.time()) - updated_at > self.ttl
+
+    def _load(self, key):
+        """Достаём сессию из памяти, а при промахе — из очереди записи или SQLite"""
+        entry = self._sessions.get(key)
+        if entry is not None:
+            session, updated_at = entry
+            if self._is_expired(updated_at):
+                self._delete(key)
+                return None
+            self._sessions.move_to_end(key)
+            return session
+
+        if self._db is None:
+            return None
+
+        # Сессия могла быть вытеснена из памяти раньше, чем попала на диск
+        if key in self._pending:
+            row = self._pending[key]
+        elif key in self._flushing:
+            row = self._flushing[key]
+        else:
+            with self._db_lock:
+                row = self._db.execute(
+                    "SELECT data, updated_at FROM wizard_sessions "
+                    "WHERE namespace = ? AND key = ?",
+                    (self.namespace, json.dumps(key)),
+                ).fetchone()
+        if row is None:
+            return None
+        if self._is_expired(row[1]):
+            self._delete(key)
+            return None
+
+        session = WizardSession(self, key, json.loads(row[0]))
+        self._remember(key, session, row[1])
+        return session
+
+    def _remember(self, key, session, updated_at):
+        self._sessions[key] = (session, updated_at)
+        self._sessions.move_to_end(key)
+        # Вытесняем из памяти самые давно использованные сессии; в SQLite
+        # они остаются до истечения TTL и поднимаются обратно по запросу
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+
+    def _persist(self, key, session):
+        with self._lock:
+            now = time.time()
+            self._remember(key, session, now)
+            if self._db is not None:
+                self._pending[key] = (json.dumps(session, ensure_ascii=False), now)
+                self._wakeup.set()
+            self._maybe_sweep(now)
+
+    def _delete(self, key):
+        self._sessions.pop(key, None)
+        if self._db is not None:
+            self._pending[key] = None
+            self._wakeup.set()
+
+    def _writer(self):
+        while True:
+            self._wakeup.wait()
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        """Записывает накопленные изменения в SQLite одной транзакцией"""
+        if self._db is None:
+            return
+        with self._lock:
+            self._wakeup.clear()
+            batch, self._pending = self._pending, {}
+            self._flushing = batch
+            sweep_before, self._sweep_before = self._sweep_before, None
+        if not batch and sweep_before is None:
+            return
+
+        upserts = [
+            (self.namespace, json.dumps(key), row[0], row[1])
+            for key, row in batch.items()
+            if row is not None
+        ]
+        deletes = [
+            (self.namespace, json.dumps(key))
+            for key, row in batch.items()
+            if row is None
+        ]
+        try:
+            with self._db_lock:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO wizard_sessions "
+                    "(namespace, key, data, updated_at) VALUES (?, ?, ?, ?)",
+                    upserts,
+                )
+                self._db.executemany(
+                    "DELETE FROM wizard_sessions WHERE namespace = ? AND key = ?",
+                    deletes,
+                )
+                if sweep_before is not None:
+                    self._db.execute(
+                        "DELETE FROM wizard_sessions "
+                        "WHERE namespace = ? AND updated_at < ?",
+                        (self.namespace, sweep_before),
+                    )
+                self._db.commit()
+        except Exception as e:
+            print(f"⚠️ Ошибка сохранения состояний мастера ({self.namespace}): {e}")
+        finally:
+            with self._lock:
+                self._flushing = {}
+
+    def _maybe_sweep(self, now):
+        if now - self._last_sweep >= self.sweep_interval:
+            self.sweep(now)
+
+    def sweep(self, now=None):
+        """Удаляет все брошенные (просроченные) сессии из памяти и SQLite"""
+        with self._lock:
+            now = now or time.time()
+            self._last_sweep = now
+            expired = [
+                key
+                for key, (_, updated_at) in self._sessions.items()
+                if self._is_expired(updated_at, now)
+            ]
+            for key in expired:
+                del self._sessions[key]
+            if self._db is not None:
+                # Из SQLite просроченные записи удалит поток записи
+                self._sweep_before = now - self.ttl
+                self._wakeup.set()
+            if expired:
+                print(
+                    f"🧹 Удалено брошенных сессий мастера ({self.namespace}): {len(expired)}"
+                )
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._load(key) is not None
+
+    def __getitem__(self, key):
+        with self._lock:
+            session = self._load(key)
+            if session is None:
+                raise KeyError(key)
+            return session
+
+    def __setitem__(self, key, value):
+        session = WizardSession(self, key, value)
+        session._persist()
+
+    def __delitem__(self, key):
+        with self._lock:
+            if self._load(key) is None:
+                raise KeyError(key)
+            self._delete(key)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+    def get(self, key, default=None):
+        with self._lock:
+            session = self._load(key)
+            return default if session is None else session
+
+    def pop(self, key, default=None):
+        with self._lock:
+            session = self._load(key)
+            if session is None:
+                return default
+            self._delete(key)
+            return session
+
+
+class WizardStateStorage(StateStorageBase):
+    """
+    FSM-хранилище telebot поверх WizardStateStore — замена
+    StateMemoryStorage, которая не теряет состояния при перезапуске.
+    """
+
+    def __init__(self, store):
+        super().__init__()
+        self.store = store
+
+    @staticmethod
+    def _key(chat_id, user_id):
+        return f"{chat_id}:{user_id}"
+
+    def set_state(self, chat_id, user_id, state):
+        if hasattr(state, "name"):
+            state = state.name
+        key = self._key(chat_id, user_id)
+        record = self.store.get(key)
+        if record is None:
+            self.store[key] = {"state": state, "data": {}}
+        else:
+            record["state"] = state
+        return True
+
+    def delete_state(self, chat_id, user_id):
+        key = self._key(chat_id, user_id)
+        if key in self.store:
+            del self.store[key]
+            return True
+        return False
+
+    def get_state(self, chat_id, user_id):
+        record = self.store.get(self._key(chat_id, user_id))
+        return record["state"] if record else None
+
+    def get_data(self, chat_id, user_id):
+        record = self.store.get(self._key(chat_id, user_id))
+        return record["data"] if record else None
+
+    def reset_data(self, chat_id, user_id):
+        record = self.store.get(self._key(chat_id, user_id))
+        if record is None:
+            return False
+        record["data"] = {}
+        return True
+
+    def set_data(self, chat_id, user_id, key, value):
+        record = self.store.get(self._key(chat_id, user_id))
+        if record is None:
+            raise RuntimeError(f"StateStorage: key {key} does not exist.")
+        data = dict(record["data"])
+        data[key] = value
+        record["data"] = data
+        return True
+
+    def get_interactive_data(self, chat_id, user_id):
+        return StateContext(self, chat_id, user_id)
+
+    def save(self, chat_id, user_id, data):
+        record = self.store.get(self._key(chat_id, user_id))
+        if record is not None:
+            record["data"] = data